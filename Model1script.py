@@ -4,9 +4,25 @@ from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.core import QgsProcessingParameterVectorLayer
 from qgis.core import QgsProcessingParameterField
 from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterEnum
 from qgis.core import QgsProcessingParameterFeatureSink
+from qgis.core import QgsProcessingParameterFileDestination
+from qgis.core import QgsProcessingUtils
+from qgis.core import QgsWkbTypes
 import processing
 
+from oilspill import dag
+from oilspill import geometry
+from oilspill import kernel
+from oilspill import layers
+from oilspill import profiling
+from oilspill import weathering
+from oilspill.grid import Grid
+from oilspill.sampling import GridEnvironment
+
+
+RESAMPLING = ['bilinear', 'nearest']
+
 
 class OilSpillModellingFirstStage(QgsProcessingAlgorithm):
 
@@ -22,208 +38,190 @@ class OilSpillModellingFirstStage(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterNumber('timespanbetweenstages', 'Timespan between stages', type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=100, defaultValue=1))
         self.addParameter(QgsProcessingParameterNumber('volumen', 'Volume in litres', type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=1e+06, defaultValue=2000))
         self.addParameter(QgsProcessingParameterFeatureSink('OutputFirstStageModell', 'Output first stage modell', type=QgsProcessing.TypeVectorAnyGeometry, createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterEnum('interpolation', 'Velocity interpolation', options=['GDAL inverse distance (all points)', 'Sparse inverse distance (precomputed weights)'], defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('idwneighbours', 'Sparse inverse distance: nearest mesh points per cell', type=QgsProcessingParameterNumber.Integer, minValue=1, defaultValue=12))
+        self.addParameter(QgsProcessingParameterNumber('idwradius', 'Sparse inverse distance: search radius (0 = unlimited)', type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterEnum('resampling', 'Sampling of the grids at the particles', options=['Bilinear', 'Nearest neighbour'], defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('particles', 'Particle budget (0 = one particle per litre)', type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterFileDestination('profile', 'Step timings (JSON, or Chrome trace for *.trace.json)', fileFilter='JSON (*.json)', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterNumber('workers', 'Concurrent child algorithms (0 = one per core, 1 = one after the other)', type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=1))
         self.addParameter(QgsProcessingParameterNumber('timemin', 'Time since spill in minutes (>=1)', type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=1440, defaultValue=0))
 
     def processAlgorithm(self, parameters, context, model_feedback):
-        # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
-        # overall progress through the model
-        feedback = QgsProcessingMultiStepFeedback(12, model_feedback)
+        # The child algorithms are declared as a graph with one output key per
+        # step; with more than one worker the independent branches (depth
+        # grid, velocity grids, seeding) run concurrently
+        graph = dag.Graph()
         results = {}
-        outputs = {}
-
-        # Gitter (Nächster Nachbar)
-        alg_params = {
-            'ANGLE': 0,
-            'DATA_TYPE': 5,
-            'INPUT': parameters['depthlayer'],
-            'NODATA': 0,
-            'OPTIONS': '',
-            'RADIUS_1': 0,
-            'RADIUS_2': 0,
-            'Z_FIELD': parameters['date'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['GitterNchsterNachbar'] = processing.run('gdal:gridnearestneighbor', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(1)
-        if feedback.isCanceled():
-            return {}
-
-        # Puffer
-        alg_params = {
-            'DISSOLVE': False,
-            'DISTANCE': QgsProperty.fromExpression('((@volumen/1000 )*4/(pi()*3))^(1/3)'),
-            'END_CAP_STYLE': 0,
-            'INPUT': parameters['sourcepoint2'],
-            'JOIN_STYLE': 0,
-            'MITER_LIMIT': 2,
-            'SEGMENTS': 10,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['Puffer'] = processing.run('native:buffer', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(2)
-        if feedback.isCanceled():
-            return {}
-
-        # Zufällige Punkte in Polygonen
-        alg_params = {
-            'EXPRESSION': ' @volumen ',
-            'INPUT': outputs['Puffer']['OUTPUT'],
-            'MIN_DISTANCE': 0,
-            'STRATEGY': 0,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ZuflligePunkteInPolygonen'] = processing.run('qgis:randompointsinsidepolygons', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(3)
-        if feedback.isCanceled():
-            return {}
-
-        # Gitter (Inverse Distanz zu einer Potenz)
-        alg_params = {
-            'ANGLE': 0,
-            'DATA_TYPE': 5,
-            'INPUT': parameters['coordeventy'],
-            'MAX_POINTS': 0,
-            'MIN_POINTS': 0,
-            'NODATA': 0,
-            'OPTIONS': '',
-            'POWER': 2,
-            'RADIUS_1': 0,
-            'RADIUS_2': 0,
-            'SMOOTHING': 0,
-            'Z_FIELD': parameters['date'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['GitterInverseDistanzZuEinerPotenz'] = processing.run('gdal:gridinversedistance', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(4)
-        if feedback.isCanceled():
-            return {}
-
-        # Gitter (Inverse Distanz zu einer Potenz)
-        alg_params = {
-            'ANGLE': 0,
-            'DATA_TYPE': 5,
-            'INPUT': parameters['coordeventx'],
-            'MAX_POINTS': 0,
-            'MIN_POINTS': 0,
-            'NODATA': 0,
-            'OPTIONS': '',
-            'POWER': 2,
-            'RADIUS_1': 0,
-            'RADIUS_2': 0,
-            'SMOOTHING': 0,
-            'Z_FIELD': parameters['date'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['GitterInverseDistanzZuEinerPotenz'] = processing.run('gdal:gridinversedistance', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(5)
-        if feedback.isCanceled():
-            return {}
-
-        # Felder überarbeiten
-        alg_params = {
-            'FIELDS_MAPPING': [{'expression': '"id"', 'length': 10, 'name': 'id', 'precision': 0, 'type': 4}],
-            'INPUT': outputs['ZuflligePunkteInPolygonen']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FelderBerarbeiten'] = processing.run('qgis:refactorfields', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        # Sparse inverse distance builds the weights once per mesh and reuses
+        # them for both velocity components and for later runs
+        sparse = self.parameterAsEnum(parameters, 'interpolation', context) == 1
+        neighbours = self.parameterAsInt(parameters, 'idwneighbours', context)
+        radius = self.parameterAsDouble(parameters, 'idwradius', context)
+        # With a particle budget every particle carries a share of the volume
+        # and evaporation reduces that instead of removing particles
+        budget = self.parameterAsInt(parameters, 'particles', context)
+        # 100 - floor((5.91 + 0.045 * @temperature) * ln(@timemin)), evaluated
+        # with the parameter values
+        keep = int(weathering.kept_percent(self.parameterAsDouble(parameters, 'temperature', context), self.parameterAsDouble(parameters, 'timemin', context)))
+        # ((@volumen/1000)*4/(pi()*3))^(1/3), the radius of the "Puffer"
+        buffer_radius = float(weathering.initial_radius(self.parameterAsDouble(parameters, 'volumen', context)))
+        # Layers are read here, in the thread of the algorithm
+        depth_signature = layers.source_signature(self.parameterAsVectorLayer(parameters, 'depthlayer', context))
+        velocity = {}
+        for name in ('coordeventx', 'coordeventy'):
+            layer = self.parameterAsVectorLayer(parameters, name, context)
+            if sparse:
+                velocity[name] = layers.point_values(layer, parameters['date']) + ('{}_{}'.format(layer.name(), parameters['date']), layer.crs().toWkt())
+            else:
+                velocity[name] = layers.source_signature(layer)
+
+        def gitter_depth(outputs, context, feedback):
+            # Gitter (Nächster Nachbar)
+            alg_params = {
+                'ANGLE': 0,
+                'DATA_TYPE': 5,
+                'INPUT': parameters['depthlayer'],
+                'NODATA': 0,
+                'OPTIONS': '',
+                'RADIUS_1': 0,
+                'RADIUS_2': 0,
+                'Z_FIELD': parameters['date'],
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            return layers.cached_run('gdal:gridnearestneighbor', alg_params, depth_signature, context, feedback)
+
+        graph.add('GitterNchsterNachbar', gitter_depth)
+
+        def puffer(outputs, context, feedback):
+            # Puffer
+            alg_params = {
+                'DISSOLVE': False,
+                'DISTANCE': buffer_radius,
+                'END_CAP_STYLE': 0,
+                'INPUT': parameters['sourcepoint2'],
+                'JOIN_STYLE': 0,
+                'MITER_LIMIT': 2,
+                'SEGMENTS': 10,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            return processing.run('native:buffer', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+
+        graph.add('Puffer', puffer)
+
+        def zufallige_punkte(outputs, context, feedback):
+            # Zufällige Punkte in Polygonen
+            alg_params = {
+                'EXPRESSION': str(budget) if budget else ' @volumen ',
+                'INPUT': outputs['Puffer']['OUTPUT'],
+                'MIN_DISTANCE': 0,
+                'STRATEGY': 0,
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            return processing.run('qgis:randompointsinsidepolygons', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+
+        graph.add('ZuflligePunkteInPolygonen', zufallige_punkte, after=['Puffer'])
+
+        def gitter_velocity(name):
+            def run(outputs, context, feedback):
+                # Gitter (Inverse Distanz zu einer Potenz)
+                if sparse:
+                    x, y, values, raster, crs = velocity[name]
+                    return {'OUTPUT': layers.sparse_idw_points(x, y, values, raster, crs, neighbours=neighbours, radius=radius)}
+                alg_params = {
+                    'ANGLE': 0,
+                    'DATA_TYPE': 5,
+                    'INPUT': parameters[name],
+                    'MAX_POINTS': 0,
+                    'MIN_POINTS': 0,
+                    'NODATA': 0,
+                    'OPTIONS': '',
+                    'POWER': 2,
+                    'RADIUS_1': 0,
+                    'RADIUS_2': 0,
+                    'SMOOTHING': 0,
+                    'Z_FIELD': parameters['date'],
+                    'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+                }
+                return layers.cached_run('gdal:gridinversedistance', alg_params, velocity[name], context, feedback)
+            return run
+
+        graph.add('GitterInverseDistanzY', gitter_velocity('coordeventy'))
+        graph.add('GitterInverseDistanzX', gitter_velocity('coordeventx'))
+
+        # Felder überarbeiten is not needed: only the id of the random points
+        # is read into the particle arrays
+        selection = 'ZuflligePunkteInPolygonen'
+
+        if not budget:
+            def zufallige_auswahl(outputs, context, feedback):
+                # Zufällige Auswahl
+                alg_params = {
+                    'INPUT': outputs['ZuflligePunkteInPolygonen']['OUTPUT'],
+                    'METHOD': 1,
+                    'NUMBER': keep
+                }
+                return processing.run('qgis:randomselection', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+
+            graph.add('ZuflligeAuswahl', zufallige_auswahl, after=['ZuflligePunkteInPolygonen'])
+
+            def gewahlte_objekte(outputs, context, feedback):
+                # Gewählte Objekte exportieren
+                alg_params = {
+                    'INPUT': outputs['ZuflligeAuswahl']['OUTPUT'],
+                    'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+                }
+                return processing.run('native:saveselectedfeatures', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+
+            selection = graph.add('GewhlteObjekteExportieren', gewahlte_objekte, after=['ZuflligeAuswahl'])
 
-        feedback.setCurrentStep(6)
-        if feedback.isCanceled():
-            return {}
-
-        # Add raster values to features
-        alg_params = {
-            'GRIDS': [outputs['GitterNchsterNachbar']['OUTPUT'],outputs['GitterInverseDistanzZuEinerPotenz']['OUTPUT'],outputs['GitterInverseDistanzZuEinerPotenz']['OUTPUT']],
-            'RESAMPLING': 0,
-            'SHAPES': parameters['perimetercrude'],
-            'RESULT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['AddRasterValuesToFeatures'] = processing.run('saga:addrastervaluestofeatures', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(7)
-        if feedback.isCanceled():
-            return {}
-
-        # Verschieben
-        alg_params = {
-            'DELTA_M': 0,
-            'DELTA_X': QgsProperty.fromExpression('(sqrt((pi()*1.21^2*(((@volumen/1000)^2*9.81*0.1793*((1/60)* @timemin )^1.5)/0.000001139^0.5)^(1/3))/pi()))/60
-* sin(azimuth( make_point( @tankpoint_minx ,  @tankpoint_miny), $geometry))*60* @timespanbetweenstages'),
-            'DELTA_Y': QgsProperty.fromExpression('(sqrt((pi()*1.21^2*(((@volumen/1000)^2*9.81*0.1793*((1/60)* @timemin )^1.5)/0.000001139^0.5)^(1/3))/pi()))/60 * cos(azimuth( make_point( @tankpoint_minx ,  @tankpoint_miny), $geometry))*60* @timespanbetweenstages'),
-            'DELTA_Z': 0,
-            'INPUT': outputs['FelderBerarbeiten']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['Verschieben'] = processing.run('native:translategeometry', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(8)
-        if feedback.isCanceled():
-            return {}
-
-        # Zufällige Auswahl
-        alg_params = {
-            'INPUT': outputs['Verschieben']['OUTPUT'],
-            'METHOD': 1,
-            'NUMBER': QgsExpression('100- (floor( (5.91 + 0.045 *@temperature )*ln(@timemin)))').evaluate()
-        }
-        outputs['ZuflligeAuswahl'] = processing.run('qgis:randomselection', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(9)
-        if feedback.isCanceled():
-            return {}
-
-        # Gewählte Objekte exportieren
-        alg_params = {
-            'INPUT': outputs['ZuflligeAuswahl']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['GewhlteObjekteExportieren'] = processing.run('native:saveselectedfeatures', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(10)
-        if feedback.isCanceled():
-            return {}
-
-        # Attribute nach Position zusammenfügen
-        alg_params = {
-            'DISCARD_NONMATCHING': True,
-            'INPUT': outputs['GewhlteObjekteExportieren']['OUTPUT'],
-            'JOIN': outputs['AddRasterValuesToFeatures']['RESULT'],
-            'JOIN_FIELDS': None,
-            'METHOD': 0,
-            'PREDICATE': 0,
-            'PREFIX': '',
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['AttributeNachPositionZusammenfgen'] = processing.run('qgis:joinattributesbylocation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(11)
-        if feedback.isCanceled():
+        # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
+        # overall progress through the model
+        feedback = QgsProcessingMultiStepFeedback(len(graph) + 1, model_feedback)
+        profiler = profiling.Profiler()
+        outputs = layers.run_graph(graph, context, feedback, self.parameterAsInt(parameters, 'workers', context) or None, profiler)
+        if outputs is None or feedback.isCanceled():
             return {}
 
         # Verschieben
-        alg_params = {
-            'DELTA_M': 0,
-            'DELTA_X': QgsProperty.fromExpression('CASE 
-WHEN "OUTPUT_2" > 0  
-THEN "OUTPUT" * 60 *  @timespanbetweenstages 
-ELSE 0
-END'),
-            'DELTA_Y': QgsProperty.fromExpression('CASE 
-WHEN "OUTPUT_2" > 0 
-THEN  "OUTPUT_1" * 60 *  @timespanbetweenstages 
-ELSE 0
-END'),
-            'DELTA_Z': 0,
-            'INPUT': outputs['AttributeNachPositionZusammenfgen']['OUTPUT'],
-            'OUTPUT': parameters['OutputFirstStageModell']
-        }
-        outputs['Verschieben'] = processing.run('native:translategeometry', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['OutputFirstStageModell'] = outputs['Verschieben']['OUTPUT']
+        step = profiler.start('Verschieben')
+        # Spreading away from the tank, then advection with the depth and
+        # velocity sampled at every particle's own position.  The spreading
+        # distance is computed once for the stage.
+        tank = self.parameterAsVectorLayer(parameters, 'tankpoint', context).extent()
+        selected = QgsProcessingUtils.mapLayerFromString(outputs[selection]['OUTPUT'], context)
+        particles = layers.layer_particles(selected)
+        x = particles.x
+        y = particles.y
+        timespan = self.parameterAsDouble(parameters, 'timespanbetweenstages', context)
+        kernel.translate(
+            x, y,
+            origin=(tank.xMinimum(), tank.yMinimum()),
+            distance=weathering.spreading_distance(self.parameterAsDouble(parameters, 'volumen', context), self.parameterAsDouble(parameters, 'timemin', context), timespan)
+        )
+        environment = GridEnvironment(
+            Grid.read(outputs['GitterInverseDistanzX']['OUTPUT']),
+            Grid.read(outputs['GitterInverseDistanzY']['OUTPUT']),
+            Grid.read(outputs['GitterNchsterNachbar']['OUTPUT']),
+            method=RESAMPLING[self.parameterAsEnum(parameters, 'resampling', context)],
+            perimeter=layers.layer_rings(self.parameterAsVectorLayer(parameters, 'perimetercrude', context))
+        )
+        # Particles outside the perimeter are discarded like by the join with
+        # DISCARD_NONMATCHING, dry ones inside stay where they are
+        inside = geometry.inside(x, y, environment.perimeter)
+        velocityx, velocityy, depth = environment.values(x, y)
+        kernel.translate(x, y, velocityx=velocityx, velocityy=velocityy, timespan=timespan, advect=kernel.wet(depth, 0))
+        count = len(particles)
+        particles.keep(inside)
+        if budget:
+            particles.mass[:] = self.parameterAsDouble(parameters, 'volumen', context) / budget * keep / 100
+        sink, dest_id = self.parameterAsSink(parameters, 'OutputFirstStageModell', context, layers.id_fields(bool(budget)), QgsWkbTypes.Point, selected.crs())
+        layers.write_particles(sink, particles, bool(budget))
+        results['OutputFirstStageModell'] = dest_id
+        feedback.setCurrentStep(len(graph) + 1)
+        feedback.pushInfo(profiler.summary(profiler.stop(step, inputs=count, outputs=len(particles))))
+        if parameters.get('profile'):
+            results['profile'] = profiler.write(self.parameterAsFileOutput(parameters, 'profile', context))
         return results
 
     def name(self):
@@ -2,20 +2,40 @@ from qgis.core import QgsProcessing
 from qgis.core import QgsProcessingAlgorithm
 from qgis.core import QgsProcessingMultiStepFeedback
 from qgis.core import QgsProcessingParameterVectorLayer
-from qgis.core import QgsProcessingParameterString
 from qgis.core import QgsProcessingParameterExpression
 from qgis.core import QgsProcessingParameterField
 from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterEnum
 from qgis.core import QgsProcessingParameterFeatureSink
+from qgis.core import QgsProcessingParameterFileDestination
+from qgis.core import QgsProcessingParameterRasterDestination
+from qgis.core import QgsProcessingUtils
+from qgis.core import QgsExpression
+from qgis.core import QgsWkbTypes
 import processing
 
+from oilspill import dag
+from oilspill import fill
+from oilspill import gridded
+from oilspill import kernel
+from oilspill import layers
+from oilspill import profiling
+from oilspill import weathering
+from oilspill.geometry import SlickHull
+from oilspill.grid import Grid
+from oilspill.sampling import GridEnvironment
+from oilspill.stagestore import StageStore
+
+
+RESAMPLING = ['bilinear', 'nearest']
+
 
 class OilSpillSecondStageModelFinalVersion(QgsProcessingAlgorithm):
 
     def initAlgorithm(self, config=None):
         self.addParameter(QgsProcessingParameterVectorLayer('breaklines', 'Houses breaklines polygons', types=[QgsProcessing.TypeVector], defaultValue=None))
+        self.addParameter(QgsProcessingParameterNumber('obstaclecellsize', 'Cell size of the houses raster in metres', type=QgsProcessingParameterNumber.Double, minValue=0.05, maxValue=100, defaultValue=1))
         self.addParameter(QgsProcessingParameterVectorLayer('depth', 'Depth', types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
-        self.addParameter(QgsProcessingParameterString('id', 'id', multiLine=False, defaultValue='id'))
         self.addParameter(QgsProcessingParameterVectorLayer('percedingspillstage', 'Perceding spill stage', types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
         self.addParameter(QgsProcessingParameterVectorLayer('perimeter', 'Perimeter', types=[QgsProcessing.TypeVectorPolygon], defaultValue=None))
         self.addParameter(QgsProcessingParameterExpression('temperatureinc', 'Temperature in °C', parentLayerParameterName='', defaultValue='13.7'))
@@ -25,367 +45,179 @@ class OilSpillSecondStageModelFinalVersion(QgsProcessingAlgorithm):
         self.addParameter(QgsProcessingParameterVectorLayer('velocityx', 'Velocity x', types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
         self.addParameter(QgsProcessingParameterVectorLayer('velocityy', 'Velocity y', types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
         self.addParameter(QgsProcessingParameterExpression('volumeofthespillinlitres', 'Volume of the spill in litres', parentLayerParameterName='', defaultValue='2000'))
+        self.addParameter(QgsProcessingParameterFileDestination('profile', 'Step timings (JSON, or Chrome trace for *.trace.json)', fileFilter='JSON (*.json)', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterNumber('workers', 'Concurrent child algorithms (0 = one per core, 1 = one after the other)', type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=1))
+        self.addParameter(QgsProcessingParameterNumber('courant', 'Adaptive sub-steps: largest share of a grid cell crossed per sub-step (0 = one step)', type=QgsProcessingParameterNumber.Double, minValue=0, maxValue=10, defaultValue=0))
+        self.addParameter(QgsProcessingParameterEnum('integrator', 'Advection integrator', options=['Euler', 'Runge-Kutta 2 (midpoint)', 'Runge-Kutta 4'], defaultValue=0))
+        self.addParameter(QgsProcessingParameterEnum('resampling', 'Sampling of the grids at the particles', options=['Bilinear', 'Nearest neighbour'], defaultValue=0))
         self.addParameter(QgsProcessingParameterFeatureSink('OutputSecondStage', 'Output second stage', type=QgsProcessing.TypeVectorAnyGeometry, createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterNumber('rastercellsize', 'Thickness and concentration cell size in metres', type=QgsProcessingParameterNumber.Double, minValue=0.1, defaultValue=2))
+        self.addParameter(QgsProcessingParameterNumber('density', 'Oil density in kg/l', type=QgsProcessingParameterNumber.Double, minValue=0.5, maxValue=1.5, defaultValue=gridded.DENSITY))
+        self.addParameter(QgsProcessingParameterRasterDestination('OutputThickness', 'Oil thickness (mm)', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('OutputConcentration', 'Oil concentration (g/m²)', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterFileDestination('stagestore', 'GeoPackage the stage is appended to (all stages in one layer)', fileFilter='GeoPackage (*.gpkg)', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterFeatureSink('OutputHull', 'Slick hull', type=QgsProcessing.TypeVectorPolygon, optional=True, createByDefault=False, defaultValue=None))
 
     def processAlgorithm(self, parameters, context, model_feedback):
-        # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
-        # overall progress through the model
-        feedback = QgsProcessingMultiStepFeedback(24, model_feedback)
+        # The child algorithms are declared as a graph with one output key per
+        # step; with more than one worker the three grids and the random
+        # selection run concurrently
+        graph = dag.Graph()
         results = {}
-        outputs = {}
-
-        # Gitter (Nächster Nachbar)
-        alg_params = {
-            'ANGLE': 0,
-            'DATA_TYPE': 5,
-            'INPUT': parameters['depth'],
-            'NODATA': 0,
-            'OPTIONS': '',
-            'RADIUS_1': 0,
-            'RADIUS_2': 0,
-            'Z_FIELD': parameters['timeaffterspillinminutes'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['GitterNchsterNachbar'] = processing.run('gdal:gridnearestneighbor', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(1)
-        if feedback.isCanceled():
-            return {}
-
-        # Gitter (Nächster Nachbar)
-        alg_params = {
-            'ANGLE': 0,
-            'DATA_TYPE': 5,
-            'INPUT': parameters['velocityy'],
-            'NODATA': 0,
-            'OPTIONS': '',
-            'RADIUS_1': 0,
-            'RADIUS_2': 0,
-            'Z_FIELD': parameters['timeaffterspillinminutes'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['GitterNchsterNachbar'] = processing.run('gdal:gridnearestneighbor', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(2)
-        if feedback.isCanceled():
-            return {}
-
-        # Zufällige Auswahl
-        alg_params = {
-            'INPUT': parameters['percedingspillstage'],
-            'METHOD': 1,
-            'NUMBER': QgsExpression('100- floor( (5.91 + 0.045 *@temperatureinc  )*ln(@timemin) - ((5.91 + 0.045 * @temperatureinc )*ln(@timemin-1)))').evaluate()
-        }
-        outputs['ZuflligeAuswahl'] = processing.run('qgis:randomselection', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(3)
-        if feedback.isCanceled():
-            return {}
-
-        # Gewählte Objekte exportieren
-        alg_params = {
-            'INPUT': outputs['ZuflligeAuswahl']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['GewhlteObjekteExportieren'] = processing.run('native:saveselectedfeatures', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(4)
-        if feedback.isCanceled():
-            return {}
-
-        # Gitter (Nächster Nachbar)
-        alg_params = {
-            'ANGLE': 0,
-            'DATA_TYPE': 5,
-            'INPUT': parameters['velocityx'],
-            'NODATA': 0,
-            'OPTIONS': '',
-            'RADIUS_1': 0,
-            'RADIUS_2': 0,
-            'Z_FIELD': parameters['timeaffterspillinminutes'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['GitterNchsterNachbar'] = processing.run('gdal:gridnearestneighbor', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(5)
-        if feedback.isCanceled():
-            return {}
-
-        # Minimale begrenzende Geometrie
-        alg_params = {
-            'FIELD': None,
-            'INPUT': outputs['GewhlteObjekteExportieren']['OUTPUT'],
-            'TYPE': 3,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['MinimaleBegrenzendeGeometrie'] = processing.run('qgis:minimumboundinggeometry', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(6)
-        if feedback.isCanceled():
-            return {}
-
-        # Felder überarbeiten
-        alg_params = {
-            'FIELDS_MAPPING': [{'expression': '"id"', 'length': 10, 'name': 'id', 'precision': 0, 'type': 4}],
-            'INPUT': outputs['GewhlteObjekteExportieren']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FelderBerarbeiten'] = processing.run('qgis:refactorfields', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(7)
-        if feedback.isCanceled():
-            return {}
-
-        # "Leerwert" füllen
-        alg_params = {
-            'BAND': 1,
-            'DISTANCE': 10,
-            'INPUT': outputs['GitterNchsterNachbar']['OUTPUT'],
-            'ITERATIONS': 0,
-            'MASK_LAYER': None,
-            'NO_MASK': False,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['LeerwertFllen'] = processing.run('gdal:fillnodata', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(8)
-        if feedback.isCanceled():
-            return {}
-
-        # "Leerwert" füllen
-        alg_params = {
-            'BAND': 1,
-            'DISTANCE': 10,
-            'INPUT': outputs['GitterNchsterNachbar']['OUTPUT'],
-            'ITERATIONS': 0,
-            'MASK_LAYER': None,
-            'NO_MASK': False,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['LeerwertFllen'] = processing.run('gdal:fillnodata', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(9)
-        if feedback.isCanceled():
-            return {}
-
-        # Zentroide
-        alg_params = {
-            'ALL_PARTS': False,
-            'INPUT': outputs['MinimaleBegrenzendeGeometrie']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['Zentroide'] = processing.run('native:centroids', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(10)
-        if feedback.isCanceled():
-            return {}
-
-        # Add raster values to features
-        alg_params = {
-            'GRIDS': [outputs['LeerwertFllen']['OUTPUT'],outputs['LeerwertFllen']['OUTPUT'],outputs['GitterNchsterNachbar']['OUTPUT']],
-            'RESAMPLING': 0,
-            'SHAPES': parameters['perimeter'],
-            'RESULT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['AddRasterValuesToFeatures'] = processing.run('saga:addrastervaluestofeatures', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(11)
-        if feedback.isCanceled():
-            return {}
+        # Particles that carry mass (first stage run with a particle budget)
+        # lose mass instead of being removed
+        mass = layers.has_mass(self.parameterAsVectorLayer(parameters, 'percedingspillstage', context))
+        # 100 - floor(E(@timemin) - E(@timemin - 1)), evaluated with the
+        # parameter values
+        temperature = QgsExpression(self.parameterAsExpression(parameters, 'temperatureinc', context)).evaluate()
+        timemin = QgsExpression(self.parameterAsExpression(parameters, 'timemin', context)).evaluate()
+        keep = int(weathering.kept_percent(temperature, timemin, max(timemin - 1, 1)))
+        # Layers are read here, in the thread of the algorithm
+        signatures = {name: layers.source_signature(self.parameterAsVectorLayer(parameters, name, context)) for name in ('depth', 'velocityx', 'velocityy')}
+
+        def gitter(name):
+            def run(outputs, context, feedback):
+                # Gitter (Nächster Nachbar)
+                alg_params = {
+                    'ANGLE': 0,
+                    'DATA_TYPE': 5,
+                    'INPUT': parameters[name],
+                    'NODATA': 0,
+                    'OPTIONS': '',
+                    'RADIUS_1': 0,
+                    'RADIUS_2': 0,
+                    'Z_FIELD': parameters['timeaffterspillinminutes'],
+                    'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+                }
+                return layers.cached_run('gdal:gridnearestneighbor', alg_params, signatures[name], context, feedback)
+            return run
+
+        graph.add('GitterNchsterNachbar', gitter('depth'))
+        graph.add('GitterNchsterNachbarY', gitter('velocityy'))
+        graph.add('GitterNchsterNachbarX', gitter('velocityx'))
+        selection = 'percedingspillstage'
+
+        if not mass:
+            def zufallige_auswahl(outputs, context, feedback):
+                # Zufällige Auswahl
+                alg_params = {
+                    'INPUT': parameters['percedingspillstage'],
+                    'METHOD': 1,
+                    'NUMBER': keep
+                }
+                return processing.run('qgis:randomselection', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+
+            # Selects on the input layer, which may be a project layer
+            graph.add('ZuflligeAuswahl', zufallige_auswahl, home=True)
+
+            def gewahlte_objekte(outputs, context, feedback):
+                # Gewählte Objekte exportieren
+                alg_params = {
+                    'INPUT': outputs['ZuflligeAuswahl']['OUTPUT'],
+                    'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+                }
+                return processing.run('native:saveselectedfeatures', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+
+            selection = graph.add('GewhlteObjekteExportieren', gewahlte_objekte, after=['ZuflligeAuswahl'])
+
+        def selected_output(outputs):
+            return outputs[selection]['OUTPUT'] if selection in outputs else parameters[selection]
 
-        # Attribute nach Position zusammenfügen
-        alg_params = {
-            'DISCARD_NONMATCHING': False,
-            'INPUT': outputs['FelderBerarbeiten']['OUTPUT'],
-            'JOIN': outputs['AddRasterValuesToFeatures']['RESULT'],
-            'JOIN_FIELDS': None,
-            'METHOD': 1,
-            'PREDICATE': 0,
-            'PREFIX': '',
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['AttributeNachPositionZusammenfgen'] = processing.run('qgis:joinattributesbylocation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(12)
-        if feedback.isCanceled():
-            return {}
-
-        # Verschieben
-        alg_params = {
-            'DELTA_M': 0,
-            'DELTA_X': QgsProperty.fromExpression('CASE 
-WHEN "OUTPUT_2" > 0  THEN 
-(sqrt((pi()*1.21^2*(((@volumeofthespillinlitres/1000)^2*9.81*0.1793*((1/60)* @timemin )^1.5)/0.000001139^0.5)^(1/3))/pi()))/60 * sin(azimuth( make_point( @Zentroide_OUTPUT_maxx , @Zentroide_OUTPUT_maxy ), $geometry))*60* @timespan
-ELSE 0
-END'),
-            'DELTA_Y': QgsProperty.fromExpression('CASE 
-WHEN "OUTPUT_2" > 0  THEN 
-(sqrt((pi()*1.21^2*(((@volumeofthespillinlitres/1000)^2*9.81*0.1793*((1/60)* @timemin )^1.5)/0.000001139^0.5)^(1/3))/pi()))/60 * cos(azimuth( make_point( @Zentroide_OUTPUT_maxx , @Zentroide_OUTPUT_maxy ), $geometry))*60* @timespan
-ELSE 0
-END'),
-            'DELTA_Z': 0,
-            'INPUT': outputs['AttributeNachPositionZusammenfgen']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['Verschieben'] = processing.run('native:translategeometry', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(13)
-        if feedback.isCanceled():
-            return {}
-
-        # Felder überarbeiten
-        alg_params = {
-            'FIELDS_MAPPING': [{'expression': '"id"', 'length': 10, 'name': 'id', 'precision': 0, 'type': 4}],
-            'INPUT': outputs['Verschieben']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FelderBerarbeiten'] = processing.run('qgis:refactorfields', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(14)
-        if feedback.isCanceled():
-            return {}
-
-        # Attribute nach Position zusammenfügen
-        alg_params = {
-            'DISCARD_NONMATCHING': False,
-            'INPUT': outputs['FelderBerarbeiten']['OUTPUT'],
-            'JOIN': outputs['AddRasterValuesToFeatures']['RESULT'],
-            'JOIN_FIELDS': None,
-            'METHOD': 0,
-            'PREDICATE': 0,
-            'PREFIX': '',
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['AttributeNachPositionZusammenfgen'] = processing.run('qgis:joinattributesbylocation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(15)
-        if feedback.isCanceled():
+        # Use a multi-step feedback, so that individual child algorithm progress reports are adjusted for the
+        # overall progress through the model
+        feedback = QgsProcessingMultiStepFeedback(len(graph) + 2, model_feedback)
+        profiler = profiling.Profiler()
+        outputs = layers.run_graph(graph, context, feedback, self.parameterAsInt(parameters, 'workers', context) or None, profiler)
+        if outputs is None or feedback.isCanceled():
             return {}
 
         # Verschieben
-        alg_params = {
-            'DELTA_M': 0,
-            'DELTA_X': QgsProperty.fromExpression('CASE 
-WHEN "OUTPUT_2" > 0.001 
-THEN "OUTPUT" * 60 *  @timespan
-ELSE 0
-END'),
-            'DELTA_Y': QgsProperty.fromExpression('CASE 
-WHEN "OUTPUT_2" > 0.001 
-THEN "OUTPUT_1" * 60 *  @timespan
-ELSE 0
-END'),
-            'DELTA_Z': 0,
-            'INPUT': outputs['AttributeNachPositionZusammenfgen']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['Verschieben'] = processing.run('native:translategeometry', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(16)
-        if feedback.isCanceled():
-            return {}
-
-        # Minimale begrenzende Geometrie
-        alg_params = {
-            'FIELD': None,
-            'INPUT': outputs['Verschieben']['OUTPUT'],
-            'TYPE': 3,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['MinimaleBegrenzendeGeometrie'] = processing.run('qgis:minimumboundinggeometry', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(17)
-        if feedback.isCanceled():
-            return {}
-
-        # Difference
-        alg_params = {
-            'A': outputs['MinimaleBegrenzendeGeometrie']['OUTPUT'],
-            'B': parameters['breaklines'],
-            'SPLIT': True,
-            'RESULT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['Difference'] = processing.run('saga:difference', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(18)
-        if feedback.isCanceled():
-            return {}
-
-        # Nach Position extrahieren
-        alg_params = {
-            'INPUT': outputs['Verschieben']['OUTPUT'],
-            'INTERSECT': parameters['breaklines'],
-            'PREDICATE': 2,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['NachPositionExtrahieren'] = processing.run('native:extractbylocation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(19)
-        if feedback.isCanceled():
-            return {}
-
-        # Attribute nach Position zusammenfügen
-        alg_params = {
-            'DISCARD_NONMATCHING': True,
-            'INPUT': outputs['Verschieben']['OUTPUT'],
-            'JOIN': parameters['breaklines'],
-            'JOIN_FIELDS': None,
-            'METHOD': 1,
-            'PREDICATE': 5,
-            'PREFIX': ''
-        }
-        outputs['AttributeNachPositionZusammenfgen'] = processing.run('qgis:joinattributesbylocation', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(20)
-        if feedback.isCanceled():
-            return {}
-
-        # Zufällige Punkte in Polygonen
-        alg_params = {
-            'EXPRESSION': outputs['AttributeNachPositionZusammenfgen']['JOINED_COUNT'],
-            'INPUT': outputs['Difference']['RESULT'],
-            'MIN_DISTANCE': 0,
-            'STRATEGY': 0,
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['ZuflligePunkteInPolygonen'] = processing.run('qgis:randompointsinsidepolygons', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(21)
-        if feedback.isCanceled():
-            return {}
-
-        # Duplikate nach Attribut löschen
-        alg_params = {
-            'FIELDS': parameters['id'],
-            'INPUT': outputs['ZuflligePunkteInPolygonen']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['DuplikateNachAttributLschen'] = processing.run('native:removeduplicatesbyattribute', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(22)
-        if feedback.isCanceled():
-            return {}
-
-        # Felder überarbeiten
-        alg_params = {
-            'FIELDS_MAPPING': [{'expression': '"id"', 'length': 10, 'name': 'id', 'precision': 0, 'type': 4}],
-            'INPUT': outputs['DuplikateNachAttributLschen']['OUTPUT'],
-            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
-        }
-        outputs['FelderBerarbeiten'] = processing.run('qgis:refactorfields', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-
-        feedback.setCurrentStep(23)
-        if feedback.isCanceled():
-            return {}
-
-        # Vektorlayer zusammenführen
-        alg_params = {
-            'CRS': None,
-            'LAYERS': [outputs['NachPositionExtrahieren']['OUTPUT'],outputs['FelderBerarbeiten']['OUTPUT']],
-            'OUTPUT': parameters['OutputSecondStage']
-        }
-        outputs['VektorlayerZusammenfhren'] = processing.run('native:mergevectorlayers', alg_params, context=context, feedback=feedback, is_child_algorithm=True)
-        results['OutputSecondStage'] = outputs['VektorlayerZusammenfhren']['OUTPUT']
+        step = profiler.start('Verschieben')
+        # Spreading away from the slick centroid, then advection, each with
+        # the depth and velocity sampled at every particle's own position.
+        # The spreading distance is computed once for the stage, the centroid
+        # of the convex hull straight from the particle coordinates.
+        selected = QgsProcessingUtils.mapLayerFromString(selected_output(outputs), context)
+        particles = layers.layer_particles(selected)
+        x = particles.x
+        y = particles.y
+        center = SlickHull().centroid(x, y) if len(particles) else (0, 0)
+        timespan = self.parameterAsDouble(parameters, 'timespan', context)
+        volume = QgsExpression(self.parameterAsExpression(parameters, 'volumeofthespillinlitres', context)).evaluate()
+        # "Leerwert" füllen: the nodata cells of the velocity grids are filled
+        # from an index map that is built once per nodata pattern
+        environment = GridEnvironment(
+            fill.filled(Grid.read(outputs['GitterNchsterNachbarX']['OUTPUT'])),
+            fill.filled(Grid.read(outputs['GitterNchsterNachbarY']['OUTPUT'])),
+            Grid.read(outputs['GitterNchsterNachbar']['OUTPUT']),
+            method=RESAMPLING[self.parameterAsEnum(parameters, 'resampling', context)],
+            perimeter=layers.layer_rings(self.parameterAsVectorLayer(parameters, 'perimeter', context))
+        )
+        x0 = x.copy()
+        y0 = y.copy()
+        depth = environment.values(x, y)[2]
+        kernel.translate(
+            x, y,
+            origin=tuple(center),
+            distance=weathering.spreading_distance(volume, timemin, timespan),
+            spread=kernel.wet(depth, 0)
+        )
+        # One Euler step as in the model, or CFL limited sub-steps along which
+        # particles entering a house are deflected right away
+        courant = self.parameterAsDouble(parameters, 'courant', context) or None
+        obstacles = layers.layer_obstacles(
+            self.parameterAsVectorLayer(parameters, 'breaklines', context),
+            self.parameterAsDouble(parameters, 'obstaclecellsize', context)
+        )
+        _, substeps = kernel.advect(
+            x, y, environment.values, timespan, 0.001,
+            integrator=kernel.INTEGRATORS[self.parameterAsEnum(parameters, 'integrator', context)],
+            courant=courant, cellsize=environment.cellsize if courant else None,
+            obstacles=obstacles if courant else None
+        )
+        if courant:
+            feedback.pushInfo('Advection in {} sub-steps'.format(substeps))
+
+        feedback.setCurrentStep(len(graph) + 1)
+        if feedback.isCanceled():
+            return {}
+
+        feedback.pushInfo(profiler.summary(profiler.stop(step, inputs=len(particles), outputs=len(particles))))
+
+        # Häuser
+        step = profiler.start('Häuser')
+        # Particles that ended up inside a house slide along its wall instead
+        # of being placed again at random in the slick hull minus the houses
+        if obstacles is not None:
+            hit = obstacles.deflect(x0, y0, x, y)
+            feedback.pushInfo('{} particles deflected by houses'.format(int(hit.sum())))
+        if mass:
+            particles.mass *= keep / 100
+        litres = particles.mass if mass else None
+        sink, dest_id = self.parameterAsSink(parameters, 'OutputSecondStage', context, layers.id_fields(mass), QgsWkbTypes.Point, selected.crs())
+        layers.write_particles(sink, particles, mass)
+        results['OutputSecondStage'] = dest_id
+        if parameters.get('stagestore'):
+            with StageStore(self.parameterAsFileOutput(parameters, 'stagestore', context), selected.crs().toWkt(), layers.crs_epsg(selected.crs())) as stages:
+                stages.append(timemin, particles.ids, x, y, litres)
+            results['stagestore'] = stages.path
+        hull_sink, hull_id = self.parameterAsSink(parameters, 'OutputHull', context, layers.hull_fields(), QgsWkbTypes.Polygon, selected.crs())
+        if hull_sink is not None:
+            layers.write_hull(hull_sink, SlickHull().ring(x, y))
+            results['OutputHull'] = hull_id
+        # Thickness and concentration on a grid over the perimeter; without
+        # mass every particle stands for one litre
+        products = [name for name in gridded.PRODUCTS if parameters.get('Output' + name.capitalize())]
+        if products:
+            spec = gridded.spec_around(environment.perimeter, self.parameterAsDouble(parameters, 'rastercellsize', context))
+            grids = gridded.grids(spec, x, y, litres if mass else 1.0, products, self.parameterAsDouble(parameters, 'density', context))
+            for name, grid in grids.items():
+                key = 'Output' + name.capitalize()
+                results[key] = grid.write(self.parameterAsOutputLayer(parameters, key, context), selected.crs().toWkt())
+        feedback.setCurrentStep(len(graph) + 2)
+        feedback.pushInfo(profiler.summary(profiler.stop(step, inputs=len(particles), outputs=len(particles))))
+        if parameters.get('profile'):
+            results['profile'] = profiler.write(self.parameterAsFileOutput(parameters, 'profile', context))
         return results
 
     def name(self):
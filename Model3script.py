@@ -0,0 +1,360 @@
+import os
+
+from qgis.core import QgsProcessing
+from qgis.core import QgsProcessingAlgorithm
+from qgis.core import QgsProcessingMultiStepFeedback
+from qgis.core import QgsProcessingParameterVectorLayer
+from qgis.core import QgsProcessingParameterField
+from qgis.core import QgsProcessingParameterNumber
+from qgis.core import QgsProcessingParameterEnum
+from qgis.core import QgsProcessingParameterFolderDestination
+from qgis.core import QgsProcessingParameterFile
+from qgis.core import QgsProcessingParameterFileDestination
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingParameterFeatureSink
+from qgis.core import QgsProcessingParameterRasterDestination
+from qgis.core import QgsFeatureSink
+from qgis.core import QgsVectorFileWriter
+from qgis.core import QgsWkbTypes
+
+from oilspill import checkpoint
+from oilspill import gridded
+from oilspill import kernel
+from oilspill import layers
+from oilspill.ensemble import Ensemble
+from oilspill.grid import Grid
+from oilspill.grid import GridSpec
+from oilspill.sampling import CubeEnvironment
+from oilspill.sampling import GridEnvironment
+from oilspill.simulation import Simulation
+from oilspill.stagestore import StageStore
+from oilspill.tiles import TiledSimulation
+from oilspill.tiles import Tiling
+
+
+RESAMPLING = ['bilinear', 'nearest']
+
+
+class OilSpillSimulation(QgsProcessingAlgorithm):
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterVectorLayer('coordeventx', 'Velocity x ', types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
+        self.addParameter(QgsProcessingParameterVectorLayer('coordeventy', 'Velocity y', types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
+        self.addParameter(QgsProcessingParameterField('date', 'Time after the spill in minutes', type=QgsProcessingParameterField.Any, parentLayerParameterName='coordeventx', allowMultiple=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterVectorLayer('depthlayer', 'Depthlayer', types=[QgsProcessing.TypeVector], defaultValue=None))
+        self.addParameter(QgsProcessingParameterVectorLayer('perimetercrude', 'Perimeter', types=[QgsProcessing.TypeVectorPolygon], defaultValue=None))
+        self.addParameter(QgsProcessingParameterVectorLayer('breaklines', 'Houses breaklines polygons', types=[QgsProcessing.TypeVector], optional=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterNumber('obstaclecellsize', 'Cell size of the houses raster in metres', type=QgsProcessingParameterNumber.Double, minValue=0.05, maxValue=100, defaultValue=1))
+        self.addParameter(QgsProcessingParameterVectorLayer('sourcepoint2', 'Pouring point outside the building ', types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
+        self.addParameter(QgsProcessingParameterVectorLayer('tankpoint', 'Location of the heating oil tank', types=[QgsProcessing.TypeVectorPoint], defaultValue=None))
+        self.addParameter(QgsProcessingParameterNumber('temperature', 'Temperature in °C', type=QgsProcessingParameterNumber.Double, minValue=-50, maxValue=50, defaultValue=13.74))
+        self.addParameter(QgsProcessingParameterNumber('volumen', 'Volume in litres', type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=1e+06, defaultValue=2000))
+        self.addParameter(QgsProcessingParameterNumber('particles', 'Particle budget (0 = one particle per litre)', type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterEnum('interpolation', 'Velocity interpolation', options=['GDAL inverse distance (all points)', 'Sparse inverse distance (precomputed weights)'], defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('idwneighbours', 'Sparse inverse distance: nearest mesh points per cell', type=QgsProcessingParameterNumber.Integer, minValue=1, defaultValue=12))
+        self.addParameter(QgsProcessingParameterNumber('idwradius', 'Sparse inverse distance: search radius (0 = unlimited)', type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterEnum('sampling', 'Velocity sampling', options=['Rasterized grids', 'Triangulated mesh points (no gridding)'], defaultValue=0))
+        self.addParameter(QgsProcessingParameterEnum('resampling', 'Sampling of the grids at the particles', options=['Bilinear', 'Nearest neighbour'], defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('starttime', 'Start time since spill in minutes (>=1)', type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=1440, defaultValue=1))
+        self.addParameter(QgsProcessingParameterNumber('endtime', 'End time since spill in minutes', type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=1440, defaultValue=60))
+        self.addParameter(QgsProcessingParameterNumber('timestep', 'Timespan between stages', type=QgsProcessingParameterNumber.Double, minValue=1, maxValue=100, defaultValue=1))
+        self.addParameter(QgsProcessingParameterNumber('courant', 'Adaptive sub-steps: largest share of a grid cell crossed per sub-step (0 = one step per stage)', type=QgsProcessingParameterNumber.Double, minValue=0, maxValue=10, defaultValue=0))
+        self.addParameter(QgsProcessingParameterEnum('integrator', 'Advection integrator', options=['Euler', 'Runge-Kutta 2 (midpoint)', 'Runge-Kutta 4'], defaultValue=0))
+        self.addParameter(QgsProcessingParameterFolderDestination('velocitycube', 'Velocity cube folder (all time columns, memory-mapped)', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterFolderDestination('snapshots', 'Folder for per-stage snapshots', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterFileDestination('stagestore', 'GeoPackage with the particles of all stages in one layer', fileFilter='GeoPackage (*.gpkg)', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterFolderDestination('rasters', 'Folder for per-stage thickness and concentration rasters', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterEnum('rasterproducts', 'Per-stage rasters', options=['Thickness (mm) and concentration (g/m²)', 'Thickness (mm)', 'Concentration (g/m²)'], defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('rastercellsize', 'Per-stage raster cell size in metres', type=QgsProcessingParameterNumber.Double, minValue=0.1, defaultValue=2))
+        self.addParameter(QgsProcessingParameterNumber('density', 'Oil density in kg/l', type=QgsProcessingParameterNumber.Double, minValue=0.5, maxValue=1.5, defaultValue=gridded.DENSITY))
+        self.addParameter(QgsProcessingParameterFolderDestination('checkpoints', 'Folder for per-stage checkpoints', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterEnum('resume', 'Resume', options=['No, start at the first stage', 'From the latest checkpoint', 'From the checkpoint at the resume time'], defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('resumetime', 'Resume time in minutes', type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterFile('resumefolder', 'Resume from checkpoints in (empty = checkpoint folder)', behavior=QgsProcessingParameterFile.Folder, optional=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterNumber('members', 'Ensemble members (1 = single run)', type=QgsProcessingParameterNumber.Integer, minValue=1, maxValue=10000, defaultValue=1))
+        self.addParameter(QgsProcessingParameterNumber('workers', 'Worker processes for ensembles and tiles (0 = all cores)', type=QgsProcessingParameterNumber.Integer, minValue=0, defaultValue=0))
+        self.addParameter(QgsProcessingParameterNumber('tilecolumns', 'Tiles across the perimeter (1 x 1 = one domain)', type=QgsProcessingParameterNumber.Integer, minValue=1, maxValue=64, defaultValue=1))
+        self.addParameter(QgsProcessingParameterNumber('tilerows', 'Tiles along the perimeter', type=QgsProcessingParameterNumber.Integer, minValue=1, maxValue=64, defaultValue=1))
+        self.addParameter(QgsProcessingParameterNumber('tilehalo', 'Tile halo in metres (at least the way of a particle in one stage)', type=QgsProcessingParameterNumber.Double, minValue=0, defaultValue=100))
+        self.addParameter(QgsProcessingParameterNumber('seed', 'Random seed (-1 = random)', type=QgsProcessingParameterNumber.Integer, minValue=-1, defaultValue=-1))
+        self.addParameter(QgsProcessingParameterNumber('ensemblecellsize', 'Ensemble raster cell size in metres', type=QgsProcessingParameterNumber.Double, minValue=0.1, defaultValue=2))
+        self.addParameter(QgsProcessingParameterFeatureSink('OutputSimulation', 'Output simulation', type=QgsProcessing.TypeVectorPoint, optional=True, createByDefault=True, defaultValue=None))
+        self.addParameter(QgsProcessingParameterFeatureSink('OutputHull', 'Slick hull', type=QgsProcessing.TypeVectorPolygon, optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('OutputProbability', 'Ensemble probability of presence', optional=True, createByDefault=False, defaultValue=None))
+        self.addParameter(QgsProcessingParameterRasterDestination('OutputFootprints', 'Ensemble percentile footprints (10/50/90)', optional=True, createByDefault=False, defaultValue=None))
+
+    def processAlgorithm(self, parameters, context, model_feedback):
+        # The environment is prepared once with child algorithms, the stages
+        # then run in memory
+        feedback = QgsProcessingMultiStepFeedback(5, model_feedback)
+        results = {}
+
+        obstacles = None
+        breaklines = self.parameterAsVectorLayer(parameters, 'breaklines', context)
+        if breaklines is not None:
+            obstacles = layers.layer_obstacles(breaklines, self.parameterAsDouble(parameters, 'obstaclecellsize', context))
+
+        if self.parameterAsEnum(parameters, 'sampling', context) == 1:
+            environment = self.mesh_environment(parameters, context, feedback, obstacles)
+        elif parameters.get('velocitycube'):
+            environment = self.cube_environment(parameters, context, feedback)
+        else:
+            environment = self.static_environment(parameters, context, feedback)
+
+        feedback.setCurrentStep(3)
+        if environment is None or feedback.isCanceled():
+            return {}
+
+        source = self.parameterAsVectorLayer(parameters, 'sourcepoint2', context)
+        tank = self.parameterAsVectorLayer(parameters, 'tankpoint', context)
+        source_point = next(source.getFeatures()).geometry().asPoint()
+        tank_extent = tank.extent()
+
+        seed = self.parameterAsInt(parameters, 'seed', context)
+        seed = None if seed < 0 else seed
+        arguments = dict(
+            environment=environment,
+            volume=self.parameterAsDouble(parameters, 'volumen', context),
+            temperature=self.parameterAsDouble(parameters, 'temperature', context),
+            timespan=self.parameterAsDouble(parameters, 'timestep', context),
+            source=(source_point.x(), source_point.y()),
+            tank=(tank_extent.xMinimum(), tank_extent.yMinimum()),
+            obstacles=obstacles,
+            particles=self.parameterAsInt(parameters, 'particles', context),
+            integrator=kernel.INTEGRATORS[self.parameterAsEnum(parameters, 'integrator', context)],
+            courant=self.parameterAsDouble(parameters, 'courant', context)
+        )
+
+        members = self.parameterAsInt(parameters, 'members', context)
+        if members > 1:
+            return self.run_ensemble(parameters, context, feedback, arguments, members, seed, source.crs())
+
+        columns = self.parameterAsInt(parameters, 'tilecolumns', context)
+        rows = self.parameterAsInt(parameters, 'tilerows', context)
+        if columns * rows > 1:
+            # Large perimeters: the particles move in tiles on worker processes
+            tiling = Tiling.around(environment.perimeter, columns, rows, self.parameterAsDouble(parameters, 'tilehalo', context))
+            simulation = TiledSimulation(seed=seed, tiling=tiling, workers=self.parameterAsInt(parameters, 'workers', context) or None, **arguments)
+        else:
+            simulation = Simulation(seed=seed, **arguments)
+
+        # Checkpoints of the stages; resuming from another folder branches a
+        # "what-if" run off an earlier one with the parameters given now
+        checkpoints = None
+        if parameters.get('checkpoints'):
+            checkpoints = checkpoint.Writer(self.parameterAsString(parameters, 'checkpoints', context))
+        resume = self.parameterAsEnum(parameters, 'resume', context)
+        if resume:
+            folder = self.parameterAsFile(parameters, 'resumefolder', context) or (checkpoints.directory if checkpoints else None)
+            if not folder:
+                raise QgsProcessingException('Resuming needs a checkpoint folder')
+            try:
+                checkpoint.restore(simulation, folder, self.parameterAsDouble(parameters, 'resumetime', context) if resume == 2 else None)
+            except FileNotFoundError as error:
+                raise QgsProcessingException(str(error))
+            feedback.pushInfo('Resuming after the stage at {} minutes'.format(simulation.time))
+
+        fields = layers.id_fields(mass=True)
+        crs = source.crs()
+
+        snapshots = None
+        if parameters.get('snapshots'):
+            snapshots = self.parameterAsString(parameters, 'snapshots', context)
+            os.makedirs(snapshots, exist_ok=True)
+
+        # Thickness and concentration on a fixed grid over the perimeter,
+        # written alongside or instead of the point snapshots
+        rasters = None
+        if parameters.get('rasters'):
+            rasters = gridded.StageRasters(
+                self.parameterAsString(parameters, 'rasters', context),
+                gridded.spec_around(environment.perimeter, self.parameterAsDouble(parameters, 'rastercellsize', context)),
+                crs.toWkt(),
+                [gridded.PRODUCTS, ['thickness'], ['concentration']][self.parameterAsEnum(parameters, 'rasterproducts', context)],
+                self.parameterAsDouble(parameters, 'density', context)
+            )
+
+        # All stages appended to one layer instead of a file per stage
+        stages = None
+        if parameters.get('stagestore'):
+            stages = StageStore(self.parameterAsFileOutput(parameters, 'stagestore', context), crs.toWkt(), layers.crs_epsg(crs))
+
+        def write_snapshot(time, state):
+            if checkpoints is not None:
+                checkpoints(time, state)
+            if stages is not None:
+                stages(time, state)
+            if rasters is not None:
+                rasters(time, state)
+            if snapshots is None:
+                return
+            path = os.path.join(snapshots, 'stage_{:07.1f}.gpkg'.format(time))
+            writer = QgsVectorFileWriter.create(path, fields, QgsWkbTypes.Point, crs, context.transformContext(), QgsVectorFileWriter.SaveVectorOptions())
+            writer.addFeatures(list(layers.features(fields, *state.particles, mass=state.mass)), QgsFeatureSink.FastInsert)
+            del writer
+
+        try:
+            simulation.run(
+                self.parameterAsDouble(parameters, 'starttime', context),
+                self.parameterAsDouble(parameters, 'endtime', context),
+                feedback=feedback,
+                on_stage=write_snapshot
+            )
+        finally:
+            if stages is not None:
+                stages.close()
+
+        feedback.setCurrentStep(4)
+        if feedback.isCanceled():
+            return {}
+
+        sink, dest_id = self.parameterAsSink(parameters, 'OutputSimulation', context, fields, QgsWkbTypes.Point, crs)
+        if sink is not None:
+            layers.write_particles(sink, simulation.store, fields=fields)
+            results['OutputSimulation'] = dest_id
+        hull_sink, hull_id = self.parameterAsSink(parameters, 'OutputHull', context, layers.hull_fields(), QgsWkbTypes.Polygon, crs)
+        if hull_sink is not None:
+            layers.write_hull(hull_sink, simulation.hull())
+            results['OutputHull'] = hull_id
+        if rasters is not None:
+            results['rasters'] = rasters.directory
+        if stages is not None:
+            results['stagestore'] = stages.path
+        return results
+
+    def run_ensemble(self, parameters, context, feedback, arguments, members, seed, crs):
+        # Members run in worker processes, only the rasters come back
+        extent = self.parameterAsVectorLayer(parameters, 'perimetercrude', context).extent()
+        setup = dict(
+            arguments,
+            start=self.parameterAsDouble(parameters, 'starttime', context),
+            end=self.parameterAsDouble(parameters, 'endtime', context),
+            spec=GridSpec.with_cellsize(
+                extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum(),
+                self.parameterAsDouble(parameters, 'ensemblecellsize', context)
+            )
+        )
+        ensemble = Ensemble(setup, members, seed, self.parameterAsInt(parameters, 'workers', context) or None)
+        ensemble.run(feedback)
+
+        feedback.setCurrentStep(4)
+        if feedback.isCanceled():
+            return {}
+
+        for level, area in ensemble.area_percentiles().items():
+            feedback.pushInfo('P{} footprint area: {:.1f} m²'.format(level, area))
+        results = {}
+        if parameters.get('OutputProbability'):
+            results['OutputProbability'] = ensemble.probability.write(self.parameterAsOutputLayer(parameters, 'OutputProbability', context), crs.toWkt())
+        if parameters.get('OutputFootprints'):
+            results['OutputFootprints'] = ensemble.footprints().write(self.parameterAsOutputLayer(parameters, 'OutputFootprints', context), crs.toWkt())
+        return results
+
+    def static_environment(self, parameters, context, feedback):
+        # Grid the single time column once
+        outputs = {}
+
+        # Gitter (Nächster Nachbar)
+        alg_params = {
+            'ANGLE': 0,
+            'DATA_TYPE': 5,
+            'INPUT': parameters['depthlayer'],
+            'NODATA': 0,
+            'OPTIONS': '',
+            'RADIUS_1': 0,
+            'RADIUS_2': 0,
+            'Z_FIELD': parameters['date'],
+            'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+        }
+        outputs['GitterDepth'] = layers.cached_run('gdal:gridnearestneighbor', alg_params, layers.source_signature(self.parameterAsVectorLayer(parameters, 'depthlayer', context)), context, feedback)
+
+        feedback.setCurrentStep(1)
+        if feedback.isCanceled():
+            return None
+
+        # Gitter (Inverse Distanz zu einer Potenz)
+        sparse = self.parameterAsEnum(parameters, 'interpolation', context) == 1
+        for key, layer in (('GitterVelocityX', 'coordeventx'), ('GitterVelocityY', 'coordeventy')):
+            if sparse:
+                outputs[key] = {'OUTPUT': layers.sparse_idw(
+                    self.parameterAsVectorLayer(parameters, layer, context), parameters['date'],
+                    neighbours=self.parameterAsInt(parameters, 'idwneighbours', context),
+                    radius=self.parameterAsDouble(parameters, 'idwradius', context)
+                )}
+                continue
+            alg_params = {
+                'ANGLE': 0,
+                'DATA_TYPE': 5,
+                'INPUT': parameters[layer],
+                'MAX_POINTS': 0,
+                'MIN_POINTS': 0,
+                'NODATA': 0,
+                'OPTIONS': '',
+                'POWER': 2,
+                'RADIUS_1': 0,
+                'RADIUS_2': 0,
+                'SMOOTHING': 0,
+                'Z_FIELD': parameters['date'],
+                'OUTPUT': QgsProcessing.TEMPORARY_OUTPUT
+            }
+            outputs[key] = layers.cached_run('gdal:gridinversedistance', alg_params, layers.source_signature(self.parameterAsVectorLayer(parameters, layer, context)), context, feedback)
+
+        feedback.setCurrentStep(2)
+        if feedback.isCanceled():
+            return None
+
+        # Particles sample the grids at their own position
+        return GridEnvironment(
+            Grid.read(outputs['GitterVelocityX']['OUTPUT']),
+            Grid.read(outputs['GitterVelocityY']['OUTPUT']),
+            Grid.read(outputs['GitterDepth']['OUTPUT']),
+            method=RESAMPLING[self.parameterAsEnum(parameters, 'resampling', context)],
+            perimeter=layers.layer_rings(self.parameterAsVectorLayer(parameters, 'perimetercrude', context))
+        )
+
+    def cube_environment(self, parameters, context, feedback):
+        # Pack every time column into a memory-mapped cube, the stages then
+        # interpolate the fields in time
+        cube = layers.ingest_cube(
+            self.parameterAsString(parameters, 'velocitycube', context),
+            self.parameterAsVectorLayer(parameters, 'coordeventx', context),
+            self.parameterAsVectorLayer(parameters, 'coordeventy', context),
+            self.parameterAsVectorLayer(parameters, 'depthlayer', context),
+            neighbours=self.parameterAsInt(parameters, 'idwneighbours', context),
+            radius=self.parameterAsDouble(parameters, 'idwradius', context),
+            feedback=feedback
+        )
+        feedback.pushInfo('Velocity cube with {} time slices'.format(len(cube.times)))
+        return CubeEnvironment(
+            cube,
+            method=RESAMPLING[self.parameterAsEnum(parameters, 'resampling', context)],
+            perimeter=layers.layer_rings(self.parameterAsVectorLayer(parameters, 'perimetercrude', context))
+        )
+
+    def mesh_environment(self, parameters, context, feedback, obstacles):
+        # Triangulate the mesh points once; the particles take the values of
+        # the corners of their triangle, all time columns interpolated in time
+        environment = layers.mesh_environment(
+            self.parameterAsVectorLayer(parameters, 'coordeventx', context),
+            self.parameterAsVectorLayer(parameters, 'coordeventy', context),
+            self.parameterAsVectorLayer(parameters, 'depthlayer', context),
+            perimeter=layers.layer_rings(self.parameterAsVectorLayer(parameters, 'perimetercrude', context)),
+            houses=None if obstacles is None else obstacles.buildings
+        )
+        feedback.pushInfo('Mesh with {} triangles'.format(len(environment.mesh['depth'].triangles)))
+        return environment
+
+    def name(self):
+        return '1oil spill simulation'
+
+    def displayName(self):
+        return '1oil spill simulation'
+
+    def group(self):
+        return ''
+
+    def groupId(self):
+        return ''
+
+    def createInstance(self):
+        return OilSpillSimulation()
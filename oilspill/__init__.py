@@ -0,0 +1,6 @@
+"""Shared engine for the oil spill processing scripts.
+
+The Processing scripts (Model1script.py, Model2script.py, ...) stay the
+entry points inside QGIS; the modules of this package hold the parts that
+are shared between them so that a whole simulation can run in one process.
+"""
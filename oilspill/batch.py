@@ -0,0 +1,366 @@
+"""Headless batch runner for many spill scenarios.
+
+    python -m oilspill.batch scenarios.csv \
+        --velocityx meshLaufen_vx.shp --velocityy meshLaufen_vy.shp \
+        --depth meshLaufen_depth.shp --perimeter perimeter.shp \
+        --breaklines breaklinesLaufen.shp --output results.sqlite
+
+The scenario table (CSV, or YAML with a list of mappings) has one row per
+scenario with the columns of :data:`COLUMNS`; only ``sourcex``, ``sourcey``
+and ``volume`` are required.  The environment is read with GDAL/OGR, so no
+QGIS installation or display is needed.  All time columns of the mesh
+layers are packed once into a velocity cube in the raster cache and shared
+by all scenarios and later batches on the same inputs (with ``--sampling
+mesh`` the mesh points are triangulated instead); the scenarios then
+run on a process pool and every stage is written to one
+:class:`~oilspill.results.ResultStore`.  With ``--rasters`` the oil
+thickness and concentration of every stored stage are also written as
+GeoTIFFs on a fixed grid over the perimeter, one folder per scenario.
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import queue
+import sys
+import time as clock
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from oilspill import cache
+from oilspill import cube
+from oilspill import gridded
+from oilspill import kernel
+from oilspill.ensemble import python_executable
+from oilspill.mesh import MeshEnvironment
+from oilspill.obstacles import Obstacles
+from oilspill.results import ResultStore
+from oilspill.sampling import CubeEnvironment
+from oilspill.simulation import Simulation
+from oilspill.weathering import WeatheringTable
+from oilspill.weathering import stage_times
+
+
+# Column name, type and default (None: required)
+COLUMNS = (
+    ('name', str, ''),
+    ('sourcex', float, None),
+    ('sourcey', float, None),
+    ('tankx', float, ''),
+    ('tanky', float, ''),
+    ('volume', float, None),
+    ('temperature', float, 13.74),
+    ('start', float, 1),
+    ('end', float, 60),
+    ('timestep', float, 1),
+    ('spilltime', float, 0),
+    ('particles', int, 0),
+    ('seed', int, ''),
+    ('integrator', str, 'euler'),
+    ('courant', float, 0),
+)
+
+
+def read_table(path):
+    """Scenario rows as dicts of typed values."""
+    if path.lower().endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise SystemExit('Reading YAML scenario tables needs PyYAML')
+        with open(path) as handle:
+            rows = yaml.safe_load(handle) or []
+    else:
+        with open(path, newline='') as handle:
+            rows = list(csv.DictReader(handle))
+    scenarios = []
+    for number, row in enumerate(rows, 1):
+        scenario = {}
+        for name, kind, default in COLUMNS:
+            value = row.get(name)
+            if value is None or value == '':
+                if default is None:
+                    raise SystemExit('Scenario {}: missing {}'.format(number, name))
+                scenario[name] = None if default == '' else default
+            else:
+                scenario[name] = kind(value)
+        scenario['name'] = scenario['name'] or 'scenario_{}'.format(number)
+        if scenario['integrator'] not in kernel.INTEGRATORS:
+            raise SystemExit('Scenario {}: integrator must be one of {}'.format(number, ', '.join(kernel.INTEGRATORS)))
+        # The oil pours out next to the tank unless it is given
+        scenario['tankx'] = scenario['sourcex'] if scenario['tankx'] is None else scenario['tankx']
+        scenario['tanky'] = scenario['sourcey'] if scenario['tanky'] is None else scenario['tanky']
+        scenarios.append(scenario)
+    return scenarios
+
+
+def weathering_table(scenarios):
+    """Evaporation and spreading of the stages of all scenarios, computed once."""
+    times = []
+    for scenario in scenarios:
+        stages = stage_times(scenario['start'], scenario['end'], scenario['timestep'])
+        times.extend([stages, np.maximum(stages - scenario['timestep'], 1)])
+    return WeatheringTable(
+        [scenario['temperature'] for scenario in scenarios], np.concatenate(times),
+        [scenario['volume'] for scenario in scenarios]
+    )
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_mtime, stat.st_size]
+
+
+def signature(path):
+    """Signatures of a point file and, for a shapefile, of its .dbf.
+
+    The attributes of a shapefile are in its .dbf, which saving edited
+    values or adding time columns rewrites without touching the .shp.
+    """
+    signatures = [file_signature(path)]
+    table = os.path.splitext(path)[0] + '.dbf'
+    if path.lower().endswith('.shp') and os.path.exists(table):
+        signatures.append(file_signature(table))
+    return signatures
+
+
+def read_points(path, after=None):
+    """x, y and all numeric time columns of a point file (those later than ``after``)."""
+    from osgeo import ogr
+
+    source = ogr.Open(path)
+    layer = source.GetLayer(0)
+    definition = layer.GetLayerDefn()
+    names = [name for time, name in cube.time_columns(definition.GetFieldDefn(i).GetName() for i in range(definition.GetFieldCount())) if after is None or time > after]
+    xs = []
+    ys = []
+    values = {name: [] for name in names}
+    for feature in layer:
+        geometry = feature.GetGeometryRef()
+        xs.append(geometry.GetX())
+        ys.append(geometry.GetY())
+        for name in names:
+            value = feature.GetField(name)
+            values[name].append(np.nan if value is None else value)
+    return np.asarray(xs, dtype=float), np.asarray(ys, dtype=float), {name: np.asarray(column, dtype=float) for name, column in values.items()}
+
+
+def geometry_rings(geometry, close_lines=False):
+    """Rings of an OGR (multi)polygon, or of closed (multi)lines."""
+    from osgeo import ogr
+
+    kind = ogr.GT_Flatten(geometry.GetGeometryType())
+    if kind in (ogr.wkbMultiPolygon, ogr.wkbMultiLineString, ogr.wkbGeometryCollection):
+        return [ring for index in range(geometry.GetGeometryCount()) for ring in geometry_rings(geometry.GetGeometryRef(index), close_lines)]
+    if kind == ogr.wkbPolygon:
+        return [np.array(geometry.GetGeometryRef(index).GetPoints())[:, :2] for index in range(geometry.GetGeometryCount())]
+    if kind == ogr.wkbLineString and close_lines and geometry.GetPointCount() >= 3:
+        ring = np.array(geometry.GetPoints())[:, :2]
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        return [ring]
+    return []
+
+
+def read_crs(path):
+    """WKT of the spatial reference of a vector file, None if it has none."""
+    from osgeo import ogr
+
+    reference = ogr.Open(path).GetLayer(0).GetSpatialRef()
+    return None if reference is None else reference.ExportToWkt()
+
+
+def read_rings(path, close_lines=False):
+    """One ring list per feature of a polygon (or line) file."""
+    from osgeo import ogr
+
+    source = ogr.Open(path)
+    features = []
+    for feature in source.GetLayer(0):
+        geometry = feature.GetGeometryRef()
+        if geometry is not None:
+            features.append(geometry_rings(geometry, close_lines))
+    return [rings for rings in features if rings]
+
+
+def prepare(arguments, log=print):
+    """Velocity cube (or mesh), perimeter and houses shared by all scenarios."""
+    paths = (arguments.velocityx, arguments.velocityy, arguments.depth)
+    perimeter = [ring for rings in read_rings(arguments.perimeter) for ring in rings]
+    obstacles = None
+    if arguments.breaklines:
+        buildings = read_rings(arguments.breaklines, close_lines=True)
+        if buildings:
+            obstacles = Obstacles.around(buildings, arguments.cellsize)
+    rasters = None
+    if arguments.rasters:
+        rasters = {
+            'directory': arguments.rasters,
+            'spec': gridded.spec_around(perimeter, arguments.raster_cellsize),
+            'crs_wkt': read_crs(arguments.perimeter),
+            'density': arguments.density,
+        }
+    shared = {'perimeter': perimeter, 'obstacles': obstacles, 'method': arguments.resampling, 'rasters': rasters}
+    if arguments.sampling == 'mesh':
+        log('Triangulating the mesh points')
+        tables = {field: read_points(path) for field, path in zip(cube.FIELDS, paths)}
+        shared['mesh'] = MeshEnvironment.from_tables(tables, perimeter, None if obstacles is None else obstacles.buildings)
+        return shared
+    key = cache.RasterCache.key('cube', [signature(path) for path in paths], arguments.neighbours, arguments.radius)
+    cached = cache.default_cache()
+    directory = os.path.join(cached.directory, 'cube_' + key)
+    built = cube.existing(directory, key)
+    if built is None:
+        log('Packing the velocity and depth time series')
+        tables = {field: read_points(path) for field, path in zip(cube.FIELDS, paths)}
+        built = cube.pack(directory, key, tables, arguments.neighbours, arguments.radius, log)
+    else:
+        log('Using the packed velocity cube {}'.format(directory))
+    # The cube counts against the size limit of the cache like its rasters
+    cached.touch(directory)
+    cached.evict(keep=[directory])
+    shared['cube'] = built
+    return shared
+
+
+_shared = None
+_stages = None
+
+
+def _initialize(shared, stages):
+    global _shared, _stages
+    _shared = shared
+    _stages = stages
+
+
+def run_scenario(shared, scenario, every=1, on_stage=None):
+    """Run one scenario, return the number of stages kept.
+
+    Every kept stage is passed to ``on_stage(time, ids, x, y, mass)`` as it
+    is produced, so no stage is held after that.
+    """
+    if shared.get('mesh') is not None:
+        mesh = shared['mesh']
+        environment = MeshEnvironment(mesh.mesh, mesh.series, shared['perimeter'], offset=scenario['spilltime'])
+    else:
+        environment = CubeEnvironment(shared['cube'], shared['method'], shared['perimeter'], offset=scenario['spilltime'])
+    simulation = Simulation(
+        environment, scenario['volume'], scenario['temperature'], scenario['timestep'],
+        (scenario['sourcex'], scenario['sourcey']), (scenario['tankx'], scenario['tanky']),
+        obstacles=shared['obstacles'], seed=scenario['seed'], particles=scenario['particles'],
+        integrator=scenario['integrator'], courant=scenario['courant'], weathering=shared.get('weathering')
+    )
+    count = [0]
+    kept = [0]
+    rasters = None
+    if shared.get('rasters'):
+        settings = shared['rasters']
+        rasters = gridded.StageRasters(os.path.join(settings['directory'], scenario['name']), settings['spec'], settings['crs_wkt'], density=settings['density'])
+
+    def keep(time, state):
+        count[0] += 1
+        if count[0] % every == 0 or time + state.timespan > scenario['end']:
+            kept[0] += 1
+            if on_stage is not None:
+                on_stage(time, state.ids, state.x, state.y, state.mass)
+            if rasters is not None:
+                rasters(time, state)
+
+    simulation.run(scenario['start'], scenario['end'], on_stage=keep)
+    return kept[0]
+
+
+def _scenario(number, scenario, every):
+    # The stages go back to the parent one by one through the queue
+    return run_scenario(_shared, scenario, every, lambda *stage: _stages.put((number,) + stage))
+
+
+def run(scenarios, shared, store, workers=None, every=1, log=print):
+    """Run all scenarios, writing their stages to ``store`` as they are produced."""
+    workers = os.cpu_count() if not workers else workers
+    numbers = {scenario['name']: store.scenario(scenario['name'], scenario) for scenario in scenarios}
+
+    if workers < 2 or len(scenarios) < 2:
+        for scenario in scenarios:
+            number = numbers[scenario['name']]
+            count = run_scenario(shared, scenario, every, lambda *stage: store.append(number, *stage))
+            log('{}: {} stages written'.format(scenario['name'], count))
+        return
+    context = multiprocessing.get_context('spawn')
+    context.set_executable(python_executable())
+    workers = min(workers, len(scenarios))
+    # Bounded, so that workers wait for the store instead of piling up stages
+    stages = context.Queue(2 * workers)
+    written = dict.fromkeys(numbers.values(), 0)
+    finished = set()
+    failures = []
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_initialize, initargs=(shared, stages)) as pool:
+        futures = {pool.submit(_scenario, numbers[scenario['name']], scenario, every): scenario for scenario in scenarios}
+        while len(finished) < len(futures):
+            try:
+                stage = stages.get(timeout=0.1)
+            except queue.Empty:
+                stage = None
+            if stage is not None:
+                store.append(*stage)
+                written[stage[0]] += 1
+            for future, scenario in futures.items():
+                number = numbers[scenario['name']]
+                if number in finished or not future.done():
+                    continue
+                if future.exception() is not None:
+                    failures.append(future.exception())
+                    finished.add(number)
+                elif written[number] == future.result():
+                    log('{}: {} stages written'.format(scenario['name'], written[number]))
+                    finished.add(number)
+        if failures:
+            # Stages of the failed scenarios still on their way
+            while True:
+                try:
+                    stages.get(timeout=0.5)
+                except queue.Empty:
+                    break
+            raise failures[0]
+
+
+def parser():
+    arguments = argparse.ArgumentParser(prog='python -m oilspill.batch', description='Run oil spill scenarios without QGIS.')
+    arguments.add_argument('scenarios', help='CSV or YAML table with one scenario per row')
+    arguments.add_argument('--velocityx', required=True, help='Mesh points with velocity x per time column (minutes)')
+    arguments.add_argument('--velocityy', required=True, help='Mesh points with velocity y per time column')
+    arguments.add_argument('--depth', required=True, help='Mesh points with the depth per time column')
+    arguments.add_argument('--perimeter', required=True, help='Perimeter polygons')
+    arguments.add_argument('--breaklines', help='Houses breaklines (polygons or closed lines)')
+    arguments.add_argument('--output', required=True, help='SQLite result store')
+    arguments.add_argument('--rasters', help='Folder for thickness and concentration GeoTIFFs of the stored stages')
+    arguments.add_argument('--raster-cellsize', type=float, default=2.0, help='Cell size of these rasters')
+    arguments.add_argument('--density', type=float, default=gridded.DENSITY, help='Oil density in kg/l')
+    arguments.add_argument('--workers', type=int, default=0, help='Worker processes (0 = all cores)')
+    arguments.add_argument('--every', type=int, default=1, help='Store every n-th stage (the last one always)')
+    arguments.add_argument('--neighbours', type=int, default=12, help='Inverse distance: nearest mesh points per cell')
+    arguments.add_argument('--radius', type=float, default=0, help='Inverse distance: search radius (0 = unlimited)')
+    arguments.add_argument('--sampling', choices=['grid', 'mesh'], default='grid', help='Velocity cube grids, or the triangulated mesh points without gridding')
+    arguments.add_argument('--resampling', choices=['bilinear', 'nearest'], default='bilinear')
+    arguments.add_argument('--cellsize', type=float, default=1.0, help='Cell size of the houses raster')
+    return arguments
+
+
+def main(argv=None):
+    arguments = parser().parse_args(argv)
+    scenarios = read_table(arguments.scenarios)
+    names = [scenario['name'] for scenario in scenarios]
+    if len(set(names)) != len(names):
+        raise SystemExit('Scenario names must be unique')
+    started = clock.time()
+    shared = prepare(arguments)
+    shared['weathering'] = weathering_table(scenarios)
+    with ResultStore(arguments.output) as store:
+        run(scenarios, shared, store, arguments.workers, max(1, arguments.every))
+    print('{} scenarios in {:.1f} s'.format(len(scenarios), clock.time() - started))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""Benchmark of the stage engine on the Laufen example data.
+
+    python -m oilspill.benchmark --output results.json --baseline baseline.json
+
+The perimeter comes from ``meshLaufen.shp`` and the houses from the closed
+lines of ``breaklinesLaufen.shp``.  Mesh points are laid out regularly in
+the perimeter and carry a synthetic, time-varying flow (a meandering main
+current with an eddy) and a depth with dry banks, packed into a velocity
+cube like real model output.  Every case (particle count x share of the
+houses) runs in a fresh process so that its peak RSS is its own; per-stage
+wall times, peak RSS and throughput in particle stages per second are
+written to JSON.  With a baseline file the cases are compared and slower
+ones beyond the tolerance are reported as regressions (exit code 1).
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time as clock
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from oilspill import cube
+from oilspill import profiling
+from oilspill import shp
+from oilspill.geometry import inside
+from oilspill.obstacles import Obstacles
+from oilspill.sampling import CubeEnvironment
+from oilspill.simulation import Simulation
+from oilspill.tiles import TiledSimulation
+from oilspill.tiles import Tiling
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PARTICLES = (1000, 10000, 100000, 1000000)
+
+HOUSES = (0.0, 0.25, 1.0)
+
+
+def laufen(mesh=None, breaklines=None):
+    """Perimeter rings and house ring lists of the example data."""
+    _, perimeter = shp.read(mesh or os.path.join(ROOT, 'meshLaufen.shp'))
+    _, lines = shp.read(breaklines or os.path.join(ROOT, 'breaklinesLaufen.shp'))
+    houses = [parts for parts in lines if all(len(part) >= 4 and np.array_equal(part[0], part[-1]) for part in parts)]
+    return [ring for parts in perimeter for ring in parts], houses
+
+
+def synthetic_tables(perimeter, spacing=10.0, times=range(0, 181, 10), seed=0):
+    """Point tables of a synthetic flow on regular mesh points in the perimeter."""
+    points = np.concatenate(perimeter)
+    (xmin, ymin), (xmax, ymax) = points.min(axis=0), points.max(axis=0)
+    gx, gy = np.meshgrid(np.arange(xmin, xmax, spacing), np.arange(ymin, ymax, spacing))
+    x = gx.ravel()
+    y = gy.ravel()
+    keep = inside(x, y, perimeter)
+    x = x[keep]
+    y = y[keep]
+    u = (x - xmin) / (xmax - xmin)
+    v = (y - ymin) / (ymax - ymin)
+    random = np.random.default_rng(seed)
+    bed = 0.05 * random.standard_normal(len(x))
+    tables = {'velocityx': (x, y, {}), 'velocityy': (x, y, {}), 'depth': (x, y, {})}
+    for time in times:
+        phase = 2 * np.pi * time / 180
+        # Main current along the reach, meandering in time, plus an eddy
+        # drifting through the domain
+        cx = 0.5 + 0.3 * np.sin(phase)
+        cy = 0.5 + 0.3 * np.cos(phase)
+        distance = np.hypot(u - cx, v - cy) + 1e-3
+        swirl = 0.4 * np.exp(-(distance / 0.15) ** 2)
+        vx = 0.6 + 0.2 * np.sin(2 * np.pi * v + phase) - swirl * (v - cy) / distance
+        vy = 0.1 * np.cos(2 * np.pi * u + phase) + swirl * (u - cx) / distance
+        depth = np.clip(0.3 + 0.2 * np.sin(np.pi * v) * (1 + 0.5 * np.sin(phase)) + bed - 0.25 * (u < 0.05), 0, None)
+        tables['velocityx'][2][str(time)] = vx
+        tables['velocityy'][2][str(time)] = vy
+        tables['depth'][2][str(time)] = depth
+    return tables
+
+
+def run_case(directory, particles, share, stages, seed=1, tiles=None, workers=None):
+    """Run one case in this process, return its measurements."""
+    perimeter, houses = laufen()
+    environment = CubeEnvironment(cube.VelocityCube.open(directory), perimeter=perimeter)
+    count = int(round(share * len(houses)))
+    started = clock.perf_counter()
+    obstacles = Obstacles.around(houses[:count]) if count else None
+    prepare = clock.perf_counter() - started
+    points = np.concatenate(perimeter)
+    center = points.mean(axis=0)
+    arguments = (environment, 20000, 13.74, 1, tuple(center), tuple(center - 1))
+    if tiles:
+        simulation = TiledSimulation(*arguments, obstacles=obstacles, seed=seed, particles=particles, tiling=Tiling.around(perimeter, *tiles), workers=workers)
+    else:
+        simulation = Simulation(*arguments, obstacles=obstacles, seed=seed, particles=particles)
+    stamps = [clock.perf_counter()]
+    sizes = []
+
+    def stamp(time, state):
+        stamps.append(clock.perf_counter())
+        sizes.append(len(state.ids))
+
+    simulation.run(1, stages, on_stage=stamp)
+    times = np.diff(stamps)
+    moved = sum(sizes[1:])
+    return {
+        'particles': particles,
+        'houses': count,
+        'tiles': list(tiles) if tiles else None,
+        'stages': len(times),
+        'obstacles_s': prepare,
+        'first_stage_s': float(times[0]),
+        'second_stage_s': times[1:].tolist(),
+        'wall_s': float(times.sum()),
+        'peak_rss_mb': profiling.peak_rss_mb(),
+        'throughput': moved / float(times[1:].sum()) if len(times) > 1 else None,
+    }
+
+
+def _case(arguments):
+    return run_case(*arguments)
+
+
+def case_key(case):
+    # Cases of different length or tiling are not comparable
+    tiles = case.get('tiles')
+    return case['particles'], case['houses'], case.get('stages'), tuple(tiles) if tiles else None
+
+
+def compare(results, baseline, tolerance=1.2):
+    """Cases whose wall time grew beyond ``tolerance`` times the baseline."""
+    reference = {case_key(case): case for case in baseline.get('cases', [])}
+    regressions = []
+    for case in results['cases']:
+        before = reference.get(case_key(case))
+        if before is None:
+            continue
+        ratio = case['wall_s'] / before['wall_s'] if before['wall_s'] else float('inf')
+        case['baseline_ratio'] = ratio
+        if ratio > tolerance:
+            regressions.append(case)
+    return regressions
+
+
+def parser():
+    arguments = argparse.ArgumentParser(prog='python -m oilspill.benchmark', description='Benchmark the stage engine on the Laufen example.')
+    arguments.add_argument('--particles', type=int, nargs='+', default=list(PARTICLES))
+    arguments.add_argument('--houses', type=float, nargs='+', default=list(HOUSES), help='Shares of the houses to use (0 to 1)')
+    arguments.add_argument('--stages', type=int, default=10, help='Stages per case (at least 2)')
+    arguments.add_argument('--tiles', type=int, nargs=2, metavar=('COLUMNS', 'ROWS'), help='Move the particles in tiles on worker processes')
+    arguments.add_argument('--workers', type=int, default=0, help='Worker processes for the tiles (0 = all cores)')
+    arguments.add_argument('--output', default='benchmark.json')
+    arguments.add_argument('--baseline', help='Earlier results to compare against')
+    arguments.add_argument('--tolerance', type=float, default=1.2, help='Allowed slow-down against the baseline')
+    return arguments
+
+
+def main(argv=None):
+    arguments = parser().parse_args(argv)
+    arguments.stages = max(2, arguments.stages)
+    perimeter, houses = laufen()
+    directory = tempfile.mkdtemp(prefix='oilspill_benchmark_')
+    cube.pack(os.path.join(directory, 'cube'), None, synthetic_tables(perimeter))
+    cases = [(os.path.join(directory, 'cube'), particles, share, arguments.stages, 1, arguments.tiles, arguments.workers or None) for particles in arguments.particles for share in arguments.houses]
+    # A fresh process per case keeps the peak RSS of the cases apart
+    context = multiprocessing.get_context('spawn')
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.platform(),
+        'houses_total': len(houses),
+        'cases': [],
+    }
+    try:
+        for setup in cases:
+            # Not a Pool: its daemonic workers could not start the tile workers
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                case = pool.submit(_case, setup).result()
+                results['cases'].append(case)
+                print('{particles:>8} particles {houses:>4} houses: {wall_s:8.2f} s, {peak_rss_mb:8.1f} MB, {throughput:12.0f} particle stages/s'.format(**dict(case, peak_rss_mb=case['peak_rss_mb'] or float('nan'))))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    status = 0
+    if arguments.baseline:
+        with open(arguments.baseline) as handle:
+            regressions = compare(results, json.load(handle), arguments.tolerance)
+        for case in regressions:
+            print('Regression: {particles} particles, {houses} houses, {baseline_ratio:.2f} x the baseline'.format(**case))
+        status = 1 if regressions else 0
+    with open(arguments.output, 'w') as handle:
+        json.dump(results, handle, indent=1)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
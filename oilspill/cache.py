@@ -0,0 +1,138 @@
+"""Content-addressed cache for gridded rasters.
+
+The models grid the same depth and velocity layers again for every stage,
+although neither the source layers nor the time field change in between.
+Every gridding result is stored under a hash of what it was computed from
+(algorithm, layer source and modification time, parameters such as the Z
+field, extent and resolution).  Repeated stages and repeated scenarios on
+the same hydrodynamic run then find the raster in the cache.
+
+Entries are plain files named after their key, or directories such as
+the velocity cubes of the batch runner; the modification time doubles as
+the "last used" stamp, so several QGIS sessions or worker processes can
+share one cache directory.  The oldest entries are evicted once the
+directory grows beyond its size limit.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+
+def _size(entry):
+    # Bytes of a file, or of everything inside a directory
+    if entry.is_dir(follow_symlinks=False):
+        return sum(_size(child) for child in os.scandir(entry.path))
+    return entry.stat(follow_symlinks=False).st_size
+
+
+def _remove(entry):
+    if entry.is_dir(follow_symlinks=False):
+        shutil.rmtree(entry.path)
+    else:
+        os.remove(entry.path)
+
+
+class RasterCache:
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        text = json.dumps(parts, sort_keys=True, default=repr)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def path(self, key, suffix='.tif'):
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key, suffix='.tif'):
+        path = self.path(key, suffix)
+        with self.lock:
+            if not os.path.exists(path):
+                self.misses += 1
+                return None
+            self.hits += 1
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return path
+
+    def put(self, key, source, suffix='.tif'):
+        """Copy ``source`` into the cache and return the cached path."""
+        path = self.path(key, suffix)
+        partial = '{}.{}.part'.format(path, os.getpid())
+        shutil.copyfile(source, partial)
+        os.replace(partial, path)
+        self.evict()
+        return path
+
+    def fetch(self, key, compute, suffix='.tif'):
+        """Cached path for ``key``, calling ``compute()`` (returning a file path) on a miss."""
+        path = self.get(key, suffix)
+        if path is None:
+            path = self.put(key, compute(), suffix)
+        return path
+
+    def size(self):
+        return sum(_size(entry) for entry in os.scandir(self.directory))
+
+    def touch(self, path):
+        """Mark the entry at ``path`` (e.g. a directory) as just used."""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def evict(self, keep=()):
+        """Remove the least recently used entries beyond the size limit, except ``keep``."""
+        keep = set(os.path.abspath(path) for path in keep)
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.part'):
+                    continue
+                try:
+                    entries.append((entry.stat(follow_symlinks=False).st_mtime, _size(entry), entry))
+                except OSError:
+                    continue
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries, key=lambda item: item[0]):
+                if total <= self.max_bytes:
+                    break
+                if os.path.abspath(entry.path) in keep:
+                    continue
+                try:
+                    _remove(entry)
+                except OSError:
+                    continue
+                total -= size
+
+    def clear(self):
+        with self.lock:
+            for entry in os.scandir(self.directory):
+                _remove(entry)
+
+
+_default = None
+
+
+def default_cache():
+    """Cache shared by all algorithms of the session.
+
+    OILSPILL_CACHE_DIR and OILSPILL_CACHE_MB override location and size.
+    """
+    global _default
+    if _default is None:
+        directory = os.environ.get('OILSPILL_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'oilspill_cache')
+        max_bytes = float(os.environ.get('OILSPILL_CACHE_MB', 1024)) * 1024 * 1024
+        _default = RasterCache(directory, max_bytes)
+    return _default
@@ -0,0 +1,100 @@
+"""Particle state of a simulation written after every stage.
+
+A checkpoint is one ``.npz`` file per stage with the particle arrays
+(ids, coordinates, mass and whatever else :attr:`STATE` lists), the time
+of the stage and the state of the random generator.  A simulation restored
+from it continues exactly where the original run was, so a cancelled or
+failed run is resumed from its latest checkpoint, and "what-if" branches
+start from any intermediate stage with other parameters (temperature,
+houses, velocity fields) without recomputing the stages before it.
+"""
+import json
+import os
+import re
+
+import numpy as np
+
+from oilspill.particles import ACTIVE
+from oilspill.particles import DTYPES
+from oilspill.particles import STRANDED
+from oilspill.particles import Particles
+
+
+STATE = tuple(name for name, _ in DTYPES)
+
+PATTERN = re.compile(r'^stage_(\d+\.\d+)\.npz$')
+
+
+def path(directory, time):
+    return os.path.join(directory, 'stage_{:011.4f}.npz'.format(time))
+
+
+def save(directory, simulation):
+    """Write the state of ``simulation`` at its current time, return the path."""
+    os.makedirs(directory, exist_ok=True)
+    target = path(directory, simulation.time)
+    arrays = simulation.store.arrays()
+    meta = {'time': simulation.time, 'random': simulation.random.bit_generator.state}
+    partial = target + '.part.npz'
+    np.savez(partial, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(partial, target)
+    return target
+
+
+def times(directory):
+    """Times of all checkpoints in ``directory``, sorted."""
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for name in os.listdir(directory):
+        match = PATTERN.match(name)
+        if match:
+            found.append(float(match.group(1)))
+    return sorted(found)
+
+
+def latest(directory):
+    found = times(directory)
+    return found[-1] if found else None
+
+
+def restore(simulation, directory, time=None):
+    """Load the checkpoint at ``time`` (default the latest) into ``simulation``.
+
+    Raises ``FileNotFoundError`` when there is no such checkpoint.
+    """
+    if time is None:
+        time = latest(directory)
+        if time is None:
+            raise FileNotFoundError('No checkpoint in {}'.format(directory))
+    else:
+        # Match the time as it is written in the file name
+        candidates = [found for found in times(directory) if abs(found - time) < 5e-5]
+        if not candidates:
+            raise FileNotFoundError('No checkpoint at {} in {}'.format(time, directory))
+        time = candidates[0]
+    with np.load(path(directory, time)) as data:
+        meta = json.loads(str(data['meta']))
+        arrays = {name: data[name].copy() for name in STATE if name in data}
+        if 'state' not in arrays and 'stranded' in data:
+            # Checkpoint from before the particle store
+            arrays['state'] = np.where(data['stranded'], STRANDED, ACTIVE)
+    simulation.store = Particles(**arrays)
+    simulation.shape.moved()
+    simulation.time = meta['time']
+    simulation.random.bit_generator.state = meta['random']
+    return simulation
+
+
+class Writer:
+    """``on_stage`` callback writing a checkpoint after every stage."""
+
+    def __init__(self, directory, every=1):
+        self.directory = directory
+        self.every = max(1, int(every))
+        self.count = 0
+
+    def __call__(self, time, simulation):
+        self.count += 1
+        if self.count % self.every == 0:
+            save(self.directory, simulation)
@@ -0,0 +1,171 @@
+"""Time-indexed velocity and depth fields stored as memory-mapped arrays.
+
+The models only ever grid the single attribute column picked with the
+``date`` / ``timeaffterspillinminutes`` parameter.  A cube holds every time
+column of the velocity x, velocity y and depth layers as ``(time, y, x)``
+arrays in ``.npy`` files.  They are opened memory-mapped, so a long
+simulation only pages in the slices around the times it asks for, and the
+fields are interpolated linearly in time between two slices.
+"""
+import json
+import os
+
+import numpy as np
+
+from oilspill import idw
+from oilspill.grid import Grid
+from oilspill.grid import GridSpec
+
+
+FIELDS = ('velocityx', 'velocityy', 'depth')
+
+
+def bracket(times, time):
+    """Indices of the two slices around ``time`` and the weight of the second.
+
+    Times outside ``times`` (sorted) are clamped to the first or last slice.
+    """
+    if len(times) == 1 or time <= times[0]:
+        return 0, 0, 0.0
+    if time >= times[-1]:
+        last = len(times) - 1
+        return last, last, 0.0
+    upper = int(np.searchsorted(times, time, side='right'))
+    lower = upper - 1
+    weight = (time - times[lower]) / (times[upper] - times[lower])
+    return lower, upper, float(weight)
+
+
+class VelocityCube:
+
+    def __init__(self, directory, spec, times, arrays, signature=None, nodata=0):
+        self.directory = directory
+        self.spec = spec
+        self.times = np.asarray(times, dtype=np.float64)
+        self.arrays = arrays
+        self.signature = signature
+        self.nodata = nodata
+
+    @classmethod
+    def create(cls, directory, spec, times, signature=None, nodata=0):
+        """Empty cube on disk, to be filled with :meth:`write`.
+
+        ``cube.json`` is only written by :meth:`save_metadata` once every
+        slice is in, so a cube left half written is never opened again.
+        """
+        os.makedirs(directory, exist_ok=True)
+        metadata = os.path.join(directory, 'cube.json')
+        if os.path.exists(metadata):
+            os.remove(metadata)
+        order = np.argsort(times)
+        times = np.asarray(times, dtype=np.float64)[order]
+        arrays = {
+            name: np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=np.float32, shape=(len(times),) + spec.shape)
+            for name in FIELDS
+        }
+        return cls(directory, spec, times, arrays, signature, nodata)
+
+    @classmethod
+    def open(cls, directory):
+        with open(os.path.join(directory, 'cube.json')) as handle:
+            metadata = json.load(handle)
+        arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in FIELDS}
+        return cls(directory, GridSpec(*metadata['spec']), metadata['times'], arrays, metadata.get('signature'), metadata.get('nodata', 0))
+
+    def __reduce__(self):
+        # Worker processes map the files themselves instead of receiving copies
+        return VelocityCube.open, (self.directory,)
+
+    def save_metadata(self):
+        metadata = {'spec': list(self.spec.key()), 'times': self.times.tolist(), 'signature': self.signature, 'nodata': self.nodata}
+        path = os.path.join(self.directory, 'cube.json')
+        with open(path + '.tmp', 'w') as handle:
+            json.dump(metadata, handle)
+        os.replace(path + '.tmp', path)
+
+    def write(self, name, time, values):
+        index = int(np.flatnonzero(self.times == time)[0])
+        self.arrays[name][index] = values
+
+    def flush(self):
+        for array in self.arrays.values():
+            if hasattr(array, 'flush'):
+                array.flush()
+
+    def bracket(self, time):
+        return bracket(self.times, time)
+
+    def field(self, name, time, window=None):
+        """Linearly interpolated field ``name`` at ``time`` as a :class:`Grid`.
+
+        ``window`` (rows and columns as from :meth:`GridSpec.window`) reads
+        only that part of the slices.
+        """
+        lower, upper, weight = self.bracket(time)
+        array = self.arrays[name]
+        spec = self.spec
+        cells = (slice(None), slice(None))
+        if window is not None:
+            r0, r1, c0, c1 = window
+            spec = spec.subgrid(r0, r1, c0, c1)
+            cells = (slice(r0, r1), slice(c0, c1))
+        values = np.asarray(array[lower][cells], dtype=np.float64)
+        if weight:
+            values = values + weight * (np.asarray(array[upper][cells], dtype=np.float64) - values)
+        return Grid(spec, values, self.nodata)
+
+    def at(self, time, window=None):
+        return tuple(self.field(name, time, window) for name in FIELDS)
+
+
+def time_columns(names):
+    """(time, name) of every column whose name is a number of minutes."""
+    columns = []
+    for name in names:
+        try:
+            columns.append((float(name), name))
+        except (TypeError, ValueError):
+            continue
+    return sorted(columns)
+
+
+def existing(directory, signature):
+    """The cube in ``directory`` if it was built with ``signature``, else None."""
+    if signature is None:
+        return None
+    try:
+        cube = VelocityCube.open(directory)
+    except (OSError, ValueError, KeyError):
+        return None
+    return cube if cube.signature == json.loads(json.dumps(signature)) else None
+
+
+def pack(directory, signature, tables, neighbours=12, radius=None, log=None):
+    """Grid every common time column of the point tables into a cube.
+
+    ``tables`` maps each of :data:`FIELDS` to ``(x, y, columns)`` with
+    ``columns`` a dict of column name to values.  Velocities are gridded by
+    inverse distance and the depth by nearest neighbour, each with weights
+    computed once per mesh.  A cube that was already built in ``directory``
+    with the same ``signature`` is reused; a ``signature`` of None never is.
+    """
+    built = existing(directory, signature)
+    if built is not None:
+        return built
+    common = set.intersection(*(set(name for _, name in time_columns(tables[field][2])) for field in FIELDS))
+    columns = time_columns(common)
+    if not columns:
+        raise ValueError('The velocity and depth layers have no common time columns')
+    x, y, _ = tables['velocityx']
+    spec = GridSpec.around(x, y)
+    cube = VelocityCube.create(directory, spec, [time for time, _ in columns], signature)
+    for field in FIELDS:
+        x, y, values = tables[field]
+        weights = idw.weights(x, y, spec, neighbours=1 if field == 'depth' else neighbours, radius=radius or None)
+        for time, name in columns:
+            cube.write(field, time, weights.interpolate(np.asarray(values[name], dtype=float)).values)
+        if log is not None:
+            log('Packed {} time slices of {}'.format(len(columns), field))
+    cube.flush()
+    cube.save_metadata()
+    return cube
@@ -0,0 +1,127 @@
+"""Child algorithm steps declared as a dependency graph.
+
+The exported models run their child algorithms one after the other and
+collect the results in one ``outputs`` dict, although gridding the depth,
+gridding the two velocity components and seeding the particles do not
+depend on each other.  Here every step is added with a unique key and the
+keys of the steps it needs; steps whose inputs are ready run concurrently
+on a thread pool (the gdal and saga algorithms run as external programs,
+so threads are enough to keep several cores busy).
+"""
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+
+class Step:
+
+    def __init__(self, key, function, after=(), home=False):
+        self.key = key
+        self.function = function
+        self.after = tuple(after)
+        self.home = home
+
+
+class Graph:
+
+    def __init__(self):
+        self.steps = {}
+
+    def __len__(self):
+        return len(self.steps)
+
+    def add(self, key, function, after=(), home=False):
+        """Add ``function(outputs)`` under ``key``, to run after the steps ``after``.
+
+        ``home`` steps always run in the calling thread, e.g. those changing
+        the selection of a project layer.
+        """
+        if key in self.steps:
+            raise ValueError('Duplicate step {!r}'.format(key))
+        for dependency in after:
+            if dependency not in self.steps:
+                raise ValueError('Step {!r} depends on unknown step {!r}'.format(key, dependency))
+        self.steps[key] = Step(key, function, after, home)
+        return key
+
+    def order(self):
+        # Steps can only depend on steps added before them, so the order
+        # of insertion is a topological order
+        return list(self.steps)
+
+    def chains(self):
+        """Keys of the steps linked by dependencies, one list per group.
+
+        Groups do not depend on each other; within a group the keys are in
+        insertion order.
+        """
+        root = {}
+
+        def find(key):
+            while root[key] != key:
+                key = root[key]
+            return key
+
+        for key, step in self.steps.items():
+            root[key] = key
+            for dependency in step.after:
+                root[find(dependency)] = find(key)
+        chains = {}
+        for key in self.order():
+            chains.setdefault(find(key), []).append(key)
+        return list(chains.values())
+
+    def run(self, call=None, workers=None, canceled=None, done=None):
+        """Run all steps and return their results by key.
+
+        ``call(step, outputs)`` runs one step (default ``step.function(outputs)``),
+        ``canceled()`` is polled between steps and stops the run, returning
+        None, and ``done(key, result)`` is called in the calling thread after
+        every step.  With ``workers`` 1 the steps run in insertion order in
+        the calling thread; otherwise only the ``home`` steps do.
+        """
+        call = call or (lambda step, outputs: step.function(outputs))
+        outputs = {}
+        if workers == 1:
+            for key in self.order():
+                if canceled is not None and canceled():
+                    return None
+                outputs[key] = call(self.steps[key], outputs)
+                if done is not None:
+                    done(key, outputs[key])
+            return outputs
+        pending = dict(self.steps)
+        running = {}
+        with ThreadPoolExecutor(workers) as pool:
+            while pending or running:
+                if canceled is not None and canceled():
+                    for future in running:
+                        future.cancel()
+                    return None
+                home = []
+                for key, step in list(pending.items()):
+                    if all(dependency in outputs for dependency in step.after):
+                        del pending[key]
+                        if step.home:
+                            home.append(step)
+                        else:
+                            running[pool.submit(call, step, outputs)] = key
+                # While the pool is busy with the others
+                for step in home:
+                    outputs[step.key] = call(step, outputs)
+                    if done is not None:
+                        done(step.key, outputs[step.key])
+                if not running:
+                    continue
+                finished, _ = wait(running, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key = running.pop(future)
+                    try:
+                        outputs[key] = future.result()
+                    except BaseException:
+                        for other in running:
+                            other.cancel()
+                        raise
+                    if done is not None:
+                        done(key, outputs[key])
+        return outputs
@@ -0,0 +1,132 @@
+"""Monte Carlo ensemble of simulations on a process pool.
+
+One run of the model is one sample: the particles are seeded at random in
+the buffer and evaporation removes a random selection of them.  An ensemble
+runs ``members`` simulations with independent random streams (spawned from
+one seed, so the whole ensemble is reproducible) and reduces them to
+
+* the probability of presence, the fraction of members that have oil in a
+  cell at the end of the run, and
+* percentile footprints, the cells reached by at least a given fraction of
+  the members, together with the percentiles of the footprint areas.
+
+The members only exchange a boolean raster with the parent process, never
+their particles.
+"""
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from oilspill.grid import Grid
+from oilspill.simulation import Simulation
+from oilspill.weathering import WeatheringTable
+
+
+LEVELS = (10, 50, 90)
+
+
+_setup = None
+
+
+def _initialize(setup):
+    global _setup
+    _setup = setup
+
+
+def _member(seed):
+    return run_member(_setup, seed)
+
+
+def run_member(setup, seed):
+    """Boolean presence raster of one member; ``setup`` holds the simulation arguments."""
+    simulation = Simulation(
+        setup['environment'], setup['volume'], setup['temperature'], setup['timespan'],
+        setup['source'], setup['tank'], obstacles=setup.get('obstacles'), seed=seed, particles=setup.get('particles'),
+        integrator=setup.get('integrator', 'euler'), courant=setup.get('courant'), weathering=setup.get('weathering')
+    )
+    _, x, y = simulation.run(setup['start'], setup['end'])
+    return setup['spec'].histogram(x, y) > 0
+
+
+def python_executable():
+    # Inside QGIS sys.executable is the QGIS binary; workers need the Python
+    # interpreter that ships with it
+    name = 'python.exe' if os.name == 'nt' else 'python3'
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return sys.executable
+    for folder in (sys.exec_prefix, os.path.join(sys.exec_prefix, 'bin')):
+        candidate = os.path.join(folder, name)
+        if os.path.exists(candidate):
+            return candidate
+    return sys.executable
+
+
+class Ensemble:
+
+    def __init__(self, setup, members=100, seed=None, workers=None):
+        """``setup`` holds the :class:`Simulation` arguments (environment, volume,
+        temperature, timespan, source, tank, obstacles, particles), ``start``/``end`` and
+        the output grid ``spec``."""
+        if setup.get('weathering') is None:
+            # All members evaporate and spread alike
+            setup = dict(setup, weathering=WeatheringTable.for_stages([setup['temperature']], [setup['volume']], setup['start'], setup['end'], setup['timespan']))
+        self.setup = setup
+        self.members = members
+        self.seeds = np.random.SeedSequence(seed).spawn(members)
+        self.workers = os.cpu_count() if workers is None else workers
+        self.hits = np.zeros(setup['spec'].shape, dtype=np.int32)
+        self.areas = []
+        self.done = 0
+
+    def add(self, presence):
+        spec = self.setup['spec']
+        self.hits += presence
+        self.areas.append(presence.sum() * spec.cellsize_x * spec.cellsize_y)
+        self.done += 1
+
+    def run(self, feedback=None):
+        """Run all members; with fewer than two workers they run in this process."""
+        if self.workers < 2 or self.members < 2:
+            for seed in self.seeds:
+                if feedback is not None and feedback.isCanceled():
+                    break
+                self.add(run_member(self.setup, seed))
+                self.progress(feedback)
+            return self
+        context = multiprocessing.get_context('spawn')
+        context.set_executable(python_executable())
+        with ProcessPoolExecutor(min(self.workers, self.members), mp_context=context, initializer=_initialize, initargs=(self.setup,)) as pool:
+            for presence in pool.map(_member, self.seeds):
+                self.add(presence)
+                self.progress(feedback)
+                if feedback is not None and feedback.isCanceled():
+                    pool.shutdown(cancel_futures=True)
+                    break
+        return self
+
+    def progress(self, feedback):
+        if feedback is not None:
+            feedback.setProgress(100 * self.done / self.members)
+
+    @property
+    def probability(self):
+        return Grid(self.setup['spec'], self.hits / max(self.done, 1), None)
+
+    def footprint(self, level):
+        """Cells reached by at least ``level`` percent of the members."""
+        return self.hits * 100 >= level * max(self.done, 1)
+
+    def footprints(self, levels=LEVELS):
+        """Raster holding for every cell the highest of ``levels`` it reaches, 0 elsewhere."""
+        values = np.zeros(self.setup['spec'].shape, dtype=np.float64)
+        for level in sorted(levels):
+            values[self.footprint(level) & (self.hits > 0)] = level
+        return Grid(self.setup['spec'], values, 0)
+
+    def area_percentiles(self, levels=LEVELS):
+        if not self.areas:
+            return {level: 0.0 for level in levels}
+        return dict(zip(levels, np.percentile(self.areas, levels).tolist()))
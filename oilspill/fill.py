@@ -0,0 +1,112 @@
+"""Gap filling of grids with an index map that is built only once.
+
+gdal:fillnodata (DISTANCE 10, no smoothing iterations) fills every nodata
+cell from the valid cells around it: it looks in four directions up to the
+distance and weights what it finds by inverse distance squared.  The
+nodata cells of the nearest neighbour grids come from the mesh footprint
+and repeat from one time column to the next, so for a given nodata mask the
+fill is a fixed gather.  A :class:`FillMap` records for every nodata cell the
+nearest valid cell in each quadrant around it within the distance and its
+weight; filling a grid is then one gather and weighted sum.  Maps are kept
+per mask, so a grid with another nodata pattern gets a map of its own.
+"""
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from oilspill.grid import Grid
+
+
+# Search distance in cells, as DISTANCE of the models
+DISTANCE = 10
+
+# Nearest valid cells looked at per nodata cell to find one in each quadrant
+CANDIDATES = 32
+
+
+def valid_cells(grid):
+    """Mask of the cells holding a value."""
+    valid = np.isfinite(grid.values)
+    if grid.nodata is not None:
+        valid &= grid.values != grid.nodata
+    return valid
+
+
+class FillMap:
+
+    def __init__(self, valid, distance=DISTANCE):
+        from scipy.spatial import cKDTree
+
+        self.shape = valid.shape
+        self.distance = distance
+        rows, columns = np.nonzero(valid)
+        empty_rows, empty_columns = np.nonzero(~valid)
+        self.target = np.flatnonzero(~valid.ravel())
+        self.sources = np.empty((0, 4), dtype=np.intp)
+        self.weights = np.empty((0, 4))
+        if not len(rows) or not len(self.target):
+            self.target = self.target[:0]
+            return
+        tree = cKDTree(np.column_stack((rows, columns)))
+        # Only the nodata cells with a valid cell in reach are searched further
+        nearest, _ = tree.query(np.column_stack((empty_rows, empty_columns)), distance_upper_bound=distance)
+        reach = np.isfinite(nearest)
+        self.target = self.target[reach]
+        empty_rows = empty_rows[reach]
+        empty_columns = empty_columns[reach]
+        if not len(self.target):
+            return
+        count = min(CANDIDATES, len(rows))
+        found, index = tree.query(np.column_stack((empty_rows, empty_columns)), k=count, distance_upper_bound=distance)
+        found = found.reshape(len(self.target), count)
+        index = index.reshape(len(self.target), count)
+        hit = np.isfinite(found)
+        safe = np.where(hit, index, 0)
+        dr = rows[safe] - empty_rows[:, None]
+        dc = columns[safe] - empty_columns[:, None]
+        # Half-open quadrants turning around the cell, so that every
+        # direction belongs to exactly one of them
+        quadrant = np.select([(dr >= 0) & (dc > 0), (dr > 0) & (dc <= 0), (dr <= 0) & (dc < 0)], [0, 1, 2], 3)
+        self.sources = np.zeros((len(self.target), 4), dtype=np.intp)
+        self.weights = np.zeros((len(self.target), 4))
+        # The candidates come sorted by distance: the first one of a quadrant
+        # is its nearest
+        for number in range(4):
+            inside = hit & (quadrant == number)
+            first = np.argmax(inside, axis=1)
+            has = inside[np.arange(len(first)), first]
+            chosen = safe[np.arange(len(first)), first]
+            self.sources[has, number] = rows[chosen[has]] * self.shape[1] + columns[chosen[has]]
+            self.weights[has, number] = 1 / found[has, first[has]] ** 2
+        self.weights /= self.weights.sum(axis=1)[:, None]
+
+    def fill(self, grid):
+        """Copy of ``grid`` with the nodata cells in reach filled."""
+        values = grid.values.astype(np.float64).ravel()
+        # Quadrants without a source have weight 0 and point at cell 0, which
+        # may be NaN
+        values[self.target] = np.where(self.weights > 0, values[self.sources] * self.weights, 0).sum(axis=1)
+        return Grid(grid.spec, values.reshape(self.shape), grid.nodata)
+
+
+_maps = OrderedDict()
+
+
+def fill_map(valid, distance=DISTANCE, cache_size=8):
+    """:class:`FillMap` of a nodata mask, shared between calls."""
+    digest = hashlib.sha1(np.packbits(valid).tobytes()).hexdigest()
+    key = (digest, valid.shape, distance)
+    if key in _maps:
+        _maps.move_to_end(key)
+        return _maps[key]
+    result = FillMap(valid, distance)
+    _maps[key] = result
+    while len(_maps) > cache_size:
+        _maps.popitem(last=False)
+    return result
+
+
+def filled(grid, distance=DISTANCE):
+    """``grid`` with its nodata cells filled like gdal:fillnodata without smoothing."""
+    return fill_map(valid_cells(grid), distance).fill(grid)
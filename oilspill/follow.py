@@ -0,0 +1,204 @@
+"""Live forecast that follows the velocity snapshots as they are published.
+
+    python -m oilspill.follow incoming/ \
+        --velocityx 'vx_*.shp' --velocityy 'vy_*.shp' --depth 'depth_*.shp' \
+        --perimeter perimeter.shp --sourcex 2611000 --sourcey 1262000 \
+        --volume 2000 --output forecast.gpkg --checkpoints forecast/
+
+During an incident the hydrodynamic model keeps publishing point layers
+with further time columns, as new files or by rewriting the same ones.  The
+directory is polled for files matching the three patterns that are new or
+changed since the last poll, and only their time columns after the last
+slice known for the field are read and appended to a
+:class:`~oilspill.mesh.MeshEnvironment`; the mesh points are triangulated
+once, so no slice is ever gridded.  The particles then advance from their
+last stage up to the latest time all three fields cover, and every stage is
+appended to one GeoPackage layer (:mod:`oilspill.stagestore`) and
+checkpointed.  An update thus costs the new stages only, and a follower
+that was stopped continues from its latest checkpoint.
+"""
+import argparse
+import glob
+import os
+import sys
+import time as clock
+
+from oilspill import batch
+from oilspill import checkpoint
+from oilspill import kernel
+from oilspill.cube import FIELDS
+from oilspill.mesh import MeshEnvironment
+from oilspill.obstacles import Obstacles
+from oilspill.simulation import Simulation
+from oilspill.stagestore import StageStore
+
+
+def stamp(path):
+    # A publisher adding time columns to a shapefile rewrites its .dbf only,
+    # which the signature covers
+    return batch.signature(path)
+
+
+class Snapshots:
+    """Files of ``directory`` matching the pattern of each field.
+
+    ``patterns`` maps each of :data:`oilspill.cube.FIELDS` to a glob
+    pattern.  Files written to less than ``settle`` seconds ago are left for
+    a later poll, so that a half written file is not read.
+    """
+
+    def __init__(self, directory, patterns, settle=2.0):
+        self.directory = directory
+        self.patterns = patterns
+        self.settle = settle
+        self.seen = {}
+
+    def changed(self):
+        """(field, path, stamp) of the new or rewritten files, oldest first."""
+        now = clock.time()
+        found = []
+        for field, pattern in self.patterns.items():
+            for path in glob.glob(os.path.join(self.directory, pattern)):
+                current = stamp(path)
+                if self.seen.get(path) == current or now - max(modified for _, modified, _ in current) < self.settle:
+                    continue
+                found.append((max(modified for _, modified, _ in current), path, field, current))
+        return [(field, path, current) for _, path, field, current in sorted(found)]
+
+
+class Follower:
+    """Mesh environment, simulation and outputs of one live forecast.
+
+    ``scenario`` holds the values of :data:`oilspill.batch.COLUMNS`.
+    """
+
+    def __init__(self, snapshots, scenario, perimeter, store, obstacles=None, checkpoints=None, log=print):
+        self.snapshots = snapshots
+        self.scenario = scenario
+        self.perimeter = perimeter
+        self.store = store
+        self.obstacles = obstacles
+        self.checkpoints = checkpoints
+        self.log = log
+        self.pending = {}
+        self.environment = None
+        self.simulation = None
+
+    def ingest(self):
+        """Read the new time columns of the changed files, return the slices added."""
+        added = 0
+        for field, path, current in self.snapshots.changed():
+            if self.environment is None:
+                x, y, columns = batch.read_points(path)
+                if field in self.pending:
+                    # Further columns of the same points
+                    columns = dict(self.pending[field][2], **columns)
+                self.pending[field] = (x, y, columns)
+            else:
+                times = self.environment.series[field][0]
+                try:
+                    added += self.environment.extend({field: batch.read_points(path, times[-1])})
+                except ValueError as error:
+                    self.log('{}: {}'.format(path, error))
+            self.snapshots.seen[path] = current
+        if self.environment is None and all(self.pending.get(field, (None, None, {}))[2] for field in FIELDS):
+            houses = None if self.obstacles is None else self.obstacles.buildings
+            self.environment = MeshEnvironment.from_tables(self.pending, self.perimeter, houses, offset=self.scenario['spilltime'])
+            self.pending = {}
+            added = sum(len(times) for times, _ in self.environment.series.values())
+            self.start()
+        return added
+
+    def start(self):
+        scenario = self.scenario
+        self.simulation = Simulation(
+            self.environment, scenario['volume'], scenario['temperature'], scenario['timestep'],
+            (scenario['sourcex'], scenario['sourcey']), (scenario['tankx'], scenario['tanky']),
+            obstacles=self.obstacles, seed=scenario['seed'], particles=scenario['particles'],
+            integrator=scenario['integrator'], courant=scenario['courant']
+        )
+        if self.checkpoints is not None and checkpoint.latest(self.checkpoints.directory) is not None:
+            checkpoint.restore(self.simulation, self.checkpoints.directory)
+            self.log('Continuing after the stage at {} minutes'.format(self.simulation.time))
+
+    def advance(self):
+        """Run the stages the slices now cover, return how many ran."""
+        count = [0]
+
+        def publish(time, state):
+            count[0] += 1
+            self.store(time, state)
+            if self.checkpoints is not None:
+                self.checkpoints(time, state)
+
+        end = min(self.scenario['end'], self.environment.horizon())
+        self.simulation.run(self.scenario['start'], end, on_stage=publish)
+        return count[0]
+
+    def finished(self):
+        simulation = self.simulation
+        return simulation is not None and simulation.time is not None and simulation.time + simulation.timespan > self.scenario['end']
+
+    def follow(self, interval=30.0, once=False):
+        """Poll until the end of the scenario is reached (or once)."""
+        while not self.finished():
+            started = clock.perf_counter()
+            added = self.ingest()
+            if added and self.simulation is not None:
+                stages = self.advance()
+                self.log('{} new time slices, {} stages up to {} minutes in {:.2f} s'.format(
+                    added, stages, self.simulation.time, clock.perf_counter() - started
+                ))
+            if once:
+                break
+            if not self.finished():
+                clock.sleep(interval)
+
+
+def parser():
+    arguments = argparse.ArgumentParser(prog='python -m oilspill.follow', description='Extend a running oil spill forecast as new velocity time slices arrive.')
+    arguments.add_argument('directory', help='Folder the hydrodynamic model publishes its point layers to')
+    arguments.add_argument('--velocityx', required=True, help='File pattern of the velocity x point layers, e.g. "vx_*.shp"')
+    arguments.add_argument('--velocityy', required=True, help='File pattern of the velocity y point layers')
+    arguments.add_argument('--depth', required=True, help='File pattern of the depth point layers')
+    arguments.add_argument('--perimeter', required=True, help='Perimeter polygons')
+    arguments.add_argument('--breaklines', help='Houses breaklines (polygons or closed lines)')
+    arguments.add_argument('--output', required=True, help='GeoPackage the stages are appended to')
+    arguments.add_argument('--checkpoints', help='Folder for per-stage checkpoints, to continue after a restart')
+    arguments.add_argument('--interval', type=float, default=30.0, help='Seconds between two polls')
+    arguments.add_argument('--settle', type=float, default=2.0, help='Seconds a file has to be unchanged before it is read')
+    arguments.add_argument('--once', action='store_true', help='Poll once and stop')
+    arguments.add_argument('--cellsize', type=float, default=1.0, help='Cell size of the houses raster')
+    # The spill is given like one scenario row of the batch runner
+    for name, kind, default in batch.COLUMNS:
+        if name == 'name':
+            continue
+        if default is None:
+            arguments.add_argument('--' + name, type=kind, required=True)
+        else:
+            arguments.add_argument('--' + name, type=kind, default=1440 if name == 'end' else None if default == '' else default)
+    return arguments
+
+
+def main(argv=None):
+    arguments = parser().parse_args(argv)
+    scenario = {name: getattr(arguments, name) for name, _, _ in batch.COLUMNS if name != 'name'}
+    if scenario['integrator'] not in kernel.INTEGRATORS:
+        raise SystemExit('The integrator must be one of {}'.format(', '.join(kernel.INTEGRATORS)))
+    scenario['tankx'] = scenario['sourcex'] if scenario['tankx'] is None else scenario['tankx']
+    scenario['tanky'] = scenario['sourcey'] if scenario['tanky'] is None else scenario['tanky']
+    perimeter = [ring for rings in batch.read_rings(arguments.perimeter) for ring in rings]
+    obstacles = None
+    if arguments.breaklines:
+        buildings = batch.read_rings(arguments.breaklines, close_lines=True)
+        if buildings:
+            obstacles = Obstacles.around(buildings, arguments.cellsize)
+    snapshots = Snapshots(arguments.directory, dict(zip(FIELDS, (arguments.velocityx, arguments.velocityy, arguments.depth))), arguments.settle)
+    checkpoints = checkpoint.Writer(arguments.checkpoints) if arguments.checkpoints else None
+    with StageStore(arguments.output, batch.read_crs(arguments.perimeter)) as store:
+        Follower(snapshots, scenario, perimeter, store, obstacles, checkpoints).follow(arguments.interval, arguments.once)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
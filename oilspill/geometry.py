@@ -0,0 +1,152 @@
+"""Vectorized geometry helpers on coordinate arrays."""
+import numpy as np
+
+
+def inside(x, y, polygon):
+    """Even-odd point in polygon test of all particles against a ring list."""
+    result = np.zeros(x.shape, dtype=bool)
+    for ring in polygon:
+        xmin, ymin = ring.min(axis=0)
+        xmax, ymax = ring.max(axis=0)
+        candidates = np.flatnonzero((x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax))
+        if not len(candidates):
+            continue
+        px = x[candidates]
+        py = y[candidates]
+        crossing = np.zeros(len(candidates), dtype=bool)
+        for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+            if y1 == y2:
+                continue
+            straddle = (y1 > py) != (y2 > py)
+            crossing ^= straddle & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+        result[candidates] ^= crossing
+    return result
+
+
+def hull_indices(x, y):
+    """Indices of the convex hull vertices, counter-clockwise (quickhull).
+
+    The ring starts at the leftmost point; points on an edge and coincident
+    points are left out, so points on one line give the two end points.
+    Points with a NaN or infinite coordinate are skipped.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.isfinite(x) & np.isfinite(y)
+    if not finite.all():
+        index = np.flatnonzero(finite)
+        return index[hull_indices(x[index], y[index])]
+    if not len(x):
+        return np.empty(0, dtype=np.intp)
+    # Leftmost point, the lowest of them, and the rightmost, the highest
+    left = np.flatnonzero(x == x.min())
+    right = np.flatnonzero(x == x.max())
+    first = left[np.argmin(y[left])]
+    last = right[np.argmax(y[right])]
+    if first == last or (x[first] == x[last] and y[first] == y[last]):
+        return np.array([first], dtype=np.intp)
+
+    def side(i, j, index):
+        # Twice the signed area of (i, j, point), negative right of i -> j
+        return (x[j] - x[i]) * (y[index] - y[i]) - (y[j] - y[i]) * (x[index] - x[i])
+
+    def chain(i, j, index):
+        # Vertices between i and j of the hull of the points right of i -> j;
+        # every segment is split at its farthest point, one array pass each
+        vertices = []
+        stack = [(i, j, index)]
+        while stack:
+            item = stack.pop()
+            if not isinstance(item, tuple):
+                vertices.append(item)
+                continue
+            i, j, index = item
+            if not len(index):
+                continue
+            distance = side(i, j, index)
+            ties = index[distance == distance.min()]
+            # Points equally far from i -> j lie on a line parallel to it, of
+            # which only the ends are vertices: take the one farthest along it
+            far = ties[np.argmax((x[ties] - x[i]) * (x[j] - x[i]) + (y[ties] - y[i]) * (y[j] - y[i]))]
+            stack.append((far, j, index[side(far, j, index) < 0]))
+            stack.append(far)
+            stack.append((i, far, index[side(i, far, index) < 0]))
+        return vertices
+
+    everything = np.arange(len(x))
+    if len(x) > 64:
+        # Points inside the octagon of the extreme points cannot be on the
+        # hull; dropping them first saves most of the passes
+        corners = [first, np.argmin(x + y), np.argmin(y), np.argmax(x - y), last, np.argmax(x + y), np.argmax(y), np.argmin(x - y)]
+        octagon = np.column_stack([x[corners + corners[:1]], y[corners + corners[:1]]])
+        keep = ~inside(x, y, [octagon])
+        keep[corners] = True
+        everything = np.flatnonzero(keep)
+    position = side(first, last, everything)
+    lower = chain(first, last, everything[position < 0])
+    upper = chain(last, first, everything[position > 0])
+    return np.array([first] + lower + [last] + upper, dtype=np.intp)
+
+
+def convex_hull(x, y):
+    """Closed ring of the convex hull of the points, see :func:`hull_indices`."""
+    vertices = hull_indices(x, y)
+    ring = np.column_stack([np.asarray(x, dtype=float)[vertices], np.asarray(y, dtype=float)[vertices]])
+    if len(vertices) < 3:
+        return ring
+    return np.vstack([ring, ring[:1]])
+
+
+def centroid(ring):
+    """Area centroid of a closed ring, the mean for degenerate rings like QGIS."""
+    if len(ring) < 4:
+        return ring.mean(axis=0)
+    x = ring[:, 0] - ring[0, 0]
+    y = ring[:, 1] - ring[0, 1]
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    area = cross.sum() / 2
+    if area == 0:
+        return ring[:-1].mean(axis=0)
+    cx = ((x[:-1] + x[1:]) * cross).sum() / (6 * area)
+    cy = ((y[:-1] + y[1:]) * cross).sum() / (6 * area)
+    return np.array([cx + ring[0, 0], cy + ring[0, 1]])
+
+
+class SlickHull:
+    """Convex hull and centroid of the particles, kept between stages.
+
+    The hull is remembered as indices into the particle arrays.  Removing
+    particles keeps it as long as all its vertices survive, only moving the
+    particles makes it computed again, on the next request.
+    """
+
+    def __init__(self):
+        self.vertices = None
+        self._centroid = None
+
+    def moved(self):
+        self.vertices = None
+        self._centroid = None
+
+    def keep(self, mask):
+        """Follow the removal of particles, ``mask`` as for the particle arrays."""
+        if self.vertices is None:
+            return
+        mask = np.asarray(mask)
+        index = np.flatnonzero(mask) if mask.dtype == bool else mask
+        position = np.minimum(np.searchsorted(index, self.vertices), max(len(index) - 1, 0))
+        if not len(index) or not np.array_equal(index[position], self.vertices):
+            self.moved()
+            return
+        self.vertices = position
+
+    def ring(self, x, y):
+        if self.vertices is None:
+            self.vertices = hull_indices(x, y)
+        ring = np.column_stack([x[self.vertices], y[self.vertices]])
+        return np.vstack([ring, ring[:1]]) if len(ring) >= 3 else ring
+
+    def centroid(self, x, y):
+        if self._centroid is None:
+            self._centroid = centroid(self.ring(x, y))
+        return self._centroid
@@ -0,0 +1,131 @@
+"""Regular grids as used by the gdal:grid* steps of the models."""
+import numpy as np
+
+
+class GridSpec:
+    """Extent and size of a north-up grid.
+
+    Rows run from the top (``ymax``) downwards, values are taken at the cell
+    centres like in gdal_grid.  Without an explicit size gdal_grid writes
+    256 x 256 cells over the extent of the input points, so that is the
+    default here as well.
+    """
+
+    def __init__(self, xmin, ymin, xmax, ymax, width=256, height=256):
+        self.xmin = float(xmin)
+        self.ymin = float(ymin)
+        self.xmax = float(xmax)
+        self.ymax = float(ymax)
+        self.width = int(width)
+        self.height = int(height)
+
+    @classmethod
+    def around(cls, x, y, width=256, height=256):
+        return cls(np.min(x), np.min(y), np.max(x), np.max(y), width, height)
+
+    @classmethod
+    def with_cellsize(cls, xmin, ymin, xmax, ymax, cellsize):
+        """Grid of square cells covering the extent, grown to whole cells."""
+        width = max(1, int(np.ceil((xmax - xmin) / cellsize)))
+        height = max(1, int(np.ceil((ymax - ymin) / cellsize)))
+        return cls(xmin, ymin, xmin + width * cellsize, ymin + height * cellsize, width, height)
+
+    @classmethod
+    def from_geotransform(cls, geotransform, width, height):
+        xmin, cellsize_x, _, ymax, _, cellsize_y = geotransform
+        return cls(xmin, ymax + cellsize_y * height, xmin + cellsize_x * width, ymax, width, height)
+
+    @property
+    def shape(self):
+        return self.height, self.width
+
+    @property
+    def cellsize_x(self):
+        return (self.xmax - self.xmin) / self.width
+
+    @property
+    def cellsize_y(self):
+        return (self.ymax - self.ymin) / self.height
+
+    def key(self):
+        return (self.xmin, self.ymin, self.xmax, self.ymax, self.width, self.height)
+
+    def geotransform(self):
+        return (self.xmin, self.cellsize_x, 0.0, self.ymax, 0.0, -self.cellsize_y)
+
+    def window(self, xmin, ymin, xmax, ymax, margin=1):
+        """Rows and columns ``(r0, r1, c0, c1)`` of the cells covering the extent.
+
+        ``margin`` more cells on every side keep the cell centres around any
+        point of the extent, which bilinear sampling needs.
+        """
+        c0 = int(np.floor((xmin - self.xmin) / self.cellsize_x)) - margin
+        c1 = int(np.floor((xmax - self.xmin) / self.cellsize_x)) + 1 + margin
+        r0 = int(np.floor((self.ymax - ymax) / self.cellsize_y)) - margin
+        r1 = int(np.floor((self.ymax - ymin) / self.cellsize_y)) + 1 + margin
+        # An extent beside the grid keeps its nearest row or column
+        r0 = min(max(r0, 0), self.height - 1)
+        c0 = min(max(c0, 0), self.width - 1)
+        return r0, max(min(r1, self.height), r0 + 1), c0, max(min(c1, self.width), c0 + 1)
+
+    def subgrid(self, r0, r1, c0, c1):
+        """Spec of the cells ``r0:r1``, ``c0:c1``, on the same lattice."""
+        return GridSpec(
+            self.xmin + c0 * self.cellsize_x, self.ymax - r1 * self.cellsize_y,
+            self.xmin + c1 * self.cellsize_x, self.ymax - r0 * self.cellsize_y,
+            c1 - c0, r1 - r0
+        )
+
+    def histogram(self, x, y, weights=None):
+        """Sum of ``weights`` (or the number of points) per cell, points outside are dropped."""
+        column = np.floor((x - self.xmin) / self.cellsize_x).astype(np.intp)
+        row = np.floor((self.ymax - y) / self.cellsize_y).astype(np.intp)
+        within = (column >= 0) & (column < self.width) & (row >= 0) & (row < self.height)
+        if weights is not None:
+            weights = np.broadcast_to(weights, np.shape(x))[within]
+        counts = np.bincount(row[within] * self.width + column[within], weights=weights, minlength=self.width * self.height)
+        return counts.reshape(self.shape)
+
+    def centers(self):
+        """x and y of all cell centres, each of shape ``(height, width)``."""
+        cx = self.xmin + (np.arange(self.width) + 0.5) * self.cellsize_x
+        cy = self.ymax - (np.arange(self.height) + 0.5) * self.cellsize_y
+        return np.meshgrid(cx, cy)
+
+
+class Grid:
+    """Values of one raster band on a :class:`GridSpec`."""
+
+    def __init__(self, spec, values, nodata=None):
+        self.spec = spec
+        self.values = values
+        self.nodata = nodata
+
+    def crop(self, xmin, ymin, xmax, ymax):
+        """The cells covering the extent (see :meth:`GridSpec.window`)."""
+        r0, r1, c0, c1 = self.spec.window(xmin, ymin, xmax, ymax)
+        return Grid(self.spec.subgrid(r0, r1, c0, c1), self.values[r0:r1, c0:c1], self.nodata)
+
+    @classmethod
+    def read(cls, path, band=1):
+        from osgeo import gdal
+
+        dataset = gdal.Open(str(path))
+        raster = dataset.GetRasterBand(band)
+        spec = GridSpec.from_geotransform(dataset.GetGeoTransform(), dataset.RasterXSize, dataset.RasterYSize)
+        return cls(spec, raster.ReadAsArray().astype(np.float64), raster.GetNoDataValue())
+
+    def write(self, path, crs_wkt=None):
+        from osgeo import gdal
+
+        driver = gdal.GetDriverByName('GTiff')
+        dataset = driver.Create(str(path), self.spec.width, self.spec.height, 1, gdal.GDT_Float32)
+        dataset.SetGeoTransform(self.spec.geotransform())
+        if crs_wkt:
+            dataset.SetProjection(crs_wkt)
+        band = dataset.GetRasterBand(1)
+        if self.nodata is not None:
+            band.SetNoDataValue(self.nodata)
+        band.WriteArray(self.values.astype(np.float32))
+        dataset.FlushCache()
+        return str(path)
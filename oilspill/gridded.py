@@ -0,0 +1,75 @@
+"""Oil thickness and mass concentration rasters of the particles.
+
+The particle volumes (litres) are summed per cell with one histogram and
+divided by the cell area: one litre per square metre is a film of one
+millimetre, and with the density of the oil the same sum gives grams per
+square metre.  The grid is fixed for a run, so every stage yields rasters
+of the same small size whatever the number of particles.
+"""
+import os
+
+import numpy as np
+
+from oilspill.grid import Grid
+from oilspill.grid import GridSpec
+
+
+# Heating oil, kg per litre
+DENSITY = 0.85
+
+PRODUCTS = ('thickness', 'concentration')
+
+
+def spec_around(rings, cellsize):
+    """Grid of ``cellsize`` cells over the extent of a ring list (the perimeter)."""
+    points = np.concatenate(rings)
+    (xmin, ymin), (xmax, ymax) = points.min(axis=0), points.max(axis=0)
+    return GridSpec.with_cellsize(xmin, ymin, xmax, ymax, cellsize)
+
+
+def volume(spec, x, y, mass):
+    """Litres of oil per cell."""
+    return spec.histogram(x, y, mass)
+
+
+def thickness(spec, x, y, mass):
+    """Film thickness in millimetres (litres per square metre)."""
+    return grids(spec, x, y, mass, ['thickness'])['thickness']
+
+
+def concentration(spec, x, y, mass, density=DENSITY):
+    """Mass of oil in grams per square metre."""
+    return grids(spec, x, y, mass, ['concentration'], density)['concentration']
+
+
+def grids(spec, x, y, mass, products=PRODUCTS, density=DENSITY):
+    """The requested products from a single histogram, by name."""
+    litres = volume(spec, x, y, mass) / (spec.cellsize_x * spec.cellsize_y)
+    result = {}
+    if 'thickness' in products:
+        result['thickness'] = Grid(spec, litres)
+    if 'concentration' in products:
+        result['concentration'] = Grid(spec, litres * density * 1000)
+    return result
+
+
+class StageRasters:
+    """Writes the rasters of every stage to ``directory``, usable as ``on_stage``.
+
+    ``products`` is a subset of :data:`PRODUCTS`; the files are named
+    ``thickness_0012.0.tif`` and so on after the stage time.
+    """
+
+    def __init__(self, directory, spec, crs_wkt=None, products=PRODUCTS, density=DENSITY):
+        self.directory = directory
+        self.spec = spec
+        self.crs_wkt = crs_wkt
+        self.products = tuple(products)
+        self.density = density
+        self.written = []
+        os.makedirs(directory, exist_ok=True)
+
+    def __call__(self, time, state):
+        for name, grid in grids(self.spec, state.x, state.y, state.mass, self.products, self.density).items():
+            path = os.path.join(self.directory, '{}_{:07.1f}.tif'.format(name, time))
+            self.written.append(grid.write(path, self.crs_wkt))
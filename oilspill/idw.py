@@ -0,0 +1,96 @@
+"""Inverse distance weighting with weights that are computed only once.
+
+gdal:gridinversedistance with MAX_POINTS 0 and RADIUS_1 0 lets every cell
+look at every mesh point.  The mesh never moves, only the values attached to
+its points change from one timestamp to the next, so the weights are built
+once from a KD-tree query (k nearest points, optionally limited to a radius)
+and kept as a sparse cells x points matrix.  Gridding a timestamp is then a
+single sparse matrix-vector product.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from oilspill.grid import Grid
+
+
+class IdwWeights:
+
+    def __init__(self, x, y, spec, power=2, neighbours=12, radius=None, nodata=0):
+        from scipy import sparse
+        from scipy.spatial import cKDTree
+
+        self.spec = spec
+        self.nodata = nodata
+        points = np.column_stack((x, y))
+        cx, cy = spec.centers()
+        cells = np.column_stack((cx.ravel(), cy.ravel()))
+        neighbours = min(neighbours, len(points))
+        distance, index = cKDTree(points).query(cells, k=neighbours, distance_upper_bound=np.inf if not radius else radius)
+        distance = distance.reshape(len(cells), neighbours)
+        index = index.reshape(len(cells), neighbours)
+        found = np.isfinite(distance)
+        # A cell on top of a point takes the point value like gdal_grid does
+        exact = found & (distance == 0)
+        with np.errstate(divide='ignore'):
+            weights = np.where(found, 1 / distance ** power, 0)
+        on_point = exact.any(axis=1)
+        weights[on_point] = exact[on_point].astype(float)
+        total = weights.sum(axis=1)
+        self.empty = total == 0
+        weights = weights / np.where(self.empty, 1, total)[:, None]
+        rows = np.repeat(np.arange(len(cells)), neighbours)
+        keep = weights.ravel() > 0
+        self.matrix = sparse.csr_matrix(
+            (weights.ravel()[keep], (rows[keep], index.ravel()[keep])),
+            shape=(len(cells), len(points))
+        )
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    def interpolate(self, values):
+        """Grid the point ``values`` (one per mesh point, NaN for NULL)."""
+        values = np.asarray(values, dtype=np.float64)
+        valid = np.isfinite(values)
+        if valid.all():
+            result = self.matrix @ values
+            empty = self.empty
+        else:
+            # NULL points are skipped by renormalising over the valid ones
+            weight = self.matrix @ valid.astype(np.float64)
+            result = (self.matrix @ np.where(valid, values, 0)) / np.where(weight > 0, weight, 1)
+            empty = weight == 0
+        result[empty] = self.nodata
+        return Grid(self.spec, result.reshape(self.spec.shape), self.nodata)
+
+
+_weights = OrderedDict()
+# The velocity components are gridded on concurrent threads
+_lock = threading.Lock()
+
+
+def weights(x, y, spec, power=2, neighbours=12, radius=None, nodata=0, cache_size=8):
+    """:class:`IdwWeights` for the given points, shared between calls.
+
+    Velocity x and velocity y come from the same mesh, so both components and
+    every later stage reuse the same matrix.
+    """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(y, dtype=np.float64).tobytes())
+    key = (digest.hexdigest(), spec.key(), power, neighbours, radius, nodata)
+    # Held while the weights are built, so that the second component waits
+    # for them instead of building them again
+    with _lock:
+        if key in _weights:
+            _weights.move_to_end(key)
+            return _weights[key]
+        result = IdwWeights(x, y, spec, power=power, neighbours=neighbours, radius=radius, nodata=nodata)
+        _weights[key] = result
+        while len(_weights) > cache_size:
+            _weights.popitem(last=False)
+    return result
@@ -0,0 +1,424 @@
+"""Conversion between QGIS point layers and coordinate arrays."""
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from qgis.core import QgsFeature
+from qgis.core import QgsFeatureSink
+from qgis.core import QgsField
+from qgis.core import QgsFields
+from qgis.core import QgsGeometry
+from qgis.core import QgsPointXY
+from qgis.core import QgsProcessingContext
+from qgis.core import QgsProcessingException
+from qgis.core import QgsProcessingFeedback
+from qgis.core import QgsProcessingUtils
+from qgis.core import QgsVectorLayer
+from qgis.core import QgsWkbTypes
+from qgis.PyQt.QtCore import QThread
+from qgis.PyQt.QtCore import Qt
+from qgis.PyQt.QtCore import QVariant
+import processing
+
+from oilspill import cache
+from oilspill import dag
+from oilspill import idw
+from oilspill import profiling
+from oilspill import cube
+from oilspill.cube import time_columns
+from oilspill.grid import GridSpec
+from oilspill.mesh import MeshEnvironment
+from oilspill.obstacles import Obstacles
+from oilspill.particles import Particles
+
+
+def rings(geometry):
+    """Exterior and interior rings of a (multi)polygon as coordinate arrays."""
+    polygons = geometry.asMultiPolygon() if geometry.isMultipart() else [geometry.asPolygon()]
+    return [np.array([(point.x(), point.y()) for point in ring]) for polygon in polygons for ring in polygon]
+
+
+def layer_rings(layer):
+    return [ring for feature in layer.getFeatures() for ring in rings(feature.geometry())]
+
+
+def building_rings(geometry):
+    """Rings of a house: polygons as they are, closed lines are taken as outlines."""
+    if geometry.type() == QgsWkbTypes.PolygonGeometry:
+        return rings(geometry)
+    lines = geometry.asMultiPolyline() if geometry.isMultipart() else [geometry.asPolyline()]
+    outlines = []
+    for line in lines:
+        ring = np.array([(point.x(), point.y()) for point in line])
+        if len(ring) < 3:
+            continue
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        outlines.append(ring)
+    return outlines
+
+
+_obstacles = OrderedDict()
+
+
+def layer_obstacles(layer, cellsize=1.0, cache_size=8):
+    """:class:`Obstacles` of the houses in ``layer``, kept for later stages.
+
+    Layers that cannot be keyed on their source (memory layers) are rasterized
+    on every call.
+    """
+    signature = source_signature(layer)
+    key = None if signature is None else json.dumps([signature, cellsize])
+    if key is not None and key in _obstacles:
+        _obstacles.move_to_end(key)
+        return _obstacles[key]
+    buildings = [building_rings(feature.geometry()) for feature in layer.getFeatures() if feature.hasGeometry()]
+    buildings = [building for building in buildings if building]
+    if not buildings:
+        return None
+    obstacles = Obstacles.around(buildings, cellsize)
+    if key is not None:
+        _obstacles[key] = obstacles
+        while len(_obstacles) > cache_size:
+            _obstacles.popitem(last=False)
+    return obstacles
+
+
+def id_fields(mass=False):
+    # Same single "id" field the refactorfields steps cut the particles down
+    # to, plus the oil volume of each particle when they carry mass
+    fields = QgsFields()
+    fields.append(QgsField('id', QVariant.Int, len=10))
+    if mass:
+        fields.append(QgsField('mass', QVariant.Double, len=20, prec=8))
+    return fields
+
+
+def has_mass(layer):
+    return layer.fields().indexOf('mass') >= 0
+
+
+def layer_arrays(layer, attributes=()):
+    """Return ids, x, y and the requested attributes of a point layer.
+
+    Missing attribute values become NaN.
+    """
+    ids = []
+    xs = []
+    ys = []
+    values = {name: [] for name in attributes}
+    for feature in layer.getFeatures():
+        point = feature.geometry().asPoint()
+        ids.append(feature['id'])
+        xs.append(point.x())
+        ys.append(point.y())
+        for name in attributes:
+            value = feature[name]
+            values[name].append(np.nan if value is None else value)
+    columns = {name: np.asarray(column, dtype=float) for name, column in values.items()}
+    return np.asarray(ids, dtype=np.int64), np.asarray(xs, dtype=float), np.asarray(ys, dtype=float), columns
+
+
+def features(fields, ids, x, y, mass=None):
+    masses = [None] * len(ids) if mass is None else mass.tolist()
+    for fid, px, py, pm in zip(ids.tolist(), x.tolist(), y.tolist(), masses):
+        feature = QgsFeature(fields)
+        feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(px, py)))
+        feature['id'] = fid
+        if pm is not None:
+            feature['mass'] = pm
+        yield feature
+
+
+def write_sink(sink, ids, x, y, fields=None, mass=None):
+    fields = fields or id_fields(mass is not None)
+    sink.addFeatures(list(features(fields, ids, x, y, mass)), QgsFeatureSink.FastInsert)
+
+
+def layer_particles(layer):
+    """:class:`Particles` of a point layer, with their mass if it has a mass field."""
+    ids, x, y, columns = layer_arrays(layer, ['mass'] if has_mass(layer) else [])
+    return Particles(ids, x, y, columns.get('mass'))
+
+
+def write_particles(sink, particles, mass=True, fields=None):
+    """Write the particles as points with their id and, with ``mass``, their volume."""
+    write_sink(sink, particles.ids, particles.x, particles.y, fields, particles.mass if mass else None)
+
+
+def hull_fields():
+    # Like the output of qgis:minimumboundinggeometry
+    fields = QgsFields()
+    fields.append(QgsField('area', QVariant.Double, len=20, prec=6))
+    fields.append(QgsField('perimeter', QVariant.Double, len=20, prec=6))
+    return fields
+
+
+def write_hull(sink, ring, fields=None):
+    """Write the closed ``ring`` as a polygon; nothing for fewer than three points."""
+    if len(ring) < 4:
+        return False
+    fields = fields or hull_fields()
+    feature = QgsFeature(fields)
+    feature.setGeometry(QgsGeometry.fromPolygonXY([[QgsPointXY(px, py) for px, py in ring.tolist()]]))
+    feature['area'] = feature.geometry().area()
+    feature['perimeter'] = feature.geometry().length()
+    return sink.addFeature(feature, QgsFeatureSink.FastInsert)
+
+
+def crs_epsg(crs):
+    """EPSG code of a QgsCoordinateReferenceSystem, None for other authorities."""
+    authority, _, code = crs.authid().partition(':')
+    return int(code) if authority == 'EPSG' and code.isdigit() else None
+
+
+def memory_layer(name, crs, ids, x, y, context=None, mass=None):
+    """Point layer holding the particles, registered with the context so that
+    child algorithms can take it as input."""
+    layer = QgsVectorLayer('Point', name, 'memory')
+    layer.setCrs(crs)
+    fields = id_fields(mass is not None)
+    layer.dataProvider().addAttributes(fields.toList())
+    layer.updateFields()
+    layer.dataProvider().addFeatures(list(features(layer.fields(), ids, x, y, mass)))
+    if context is not None:
+        context.temporaryLayerStore().addMapLayer(layer)
+    return layer
+
+
+def point_table(layer, fields):
+    """x, y and a points x fields matrix of a point layer, NaN for NULL."""
+    xs = []
+    ys = []
+    rows = []
+    for feature in layer.getFeatures():
+        point = feature.geometry().asPoint()
+        xs.append(point.x())
+        ys.append(point.y())
+        rows.append([np.nan if feature[field] is None else feature[field] for field in fields])
+    return np.asarray(xs, dtype=float), np.asarray(ys, dtype=float), np.asarray(rows, dtype=float).reshape(len(xs), len(fields))
+
+
+def point_values(layer, field):
+    """x, y and the values of ``field`` of a point layer, NaN for NULL."""
+    x, y, values = point_table(layer, [field])
+    return x, y, values[:, 0]
+
+
+def sparse_idw(layer, field, power=2, neighbours=12, radius=None, nodata=0):
+    """Grid ``field`` with precomputed IDW weights, return the GeoTIFF path."""
+    x, y, values = point_values(layer, field)
+    return sparse_idw_points(x, y, values, '{}_{}'.format(layer.name(), field), layer.crs().toWkt(), power, neighbours, radius, nodata)
+
+
+def sparse_idw_points(x, y, values, name, crs_wkt, power=2, neighbours=12, radius=None, nodata=0):
+    # Touches no layer, so it can run in any thread
+    weights = idw.weights(x, y, GridSpec.around(x, y), power=power, neighbours=neighbours, radius=radius or None, nodata=nodata)
+    path = QgsProcessingUtils.generateTempFilename('{}.tif'.format(name))
+    return weights.interpolate(values).write(path, crs_wkt)
+
+
+def source_signature(layer):
+    """What a gridding of ``layer`` depends on, None if it cannot be cached.
+
+    Memory layers have no file and no modification time to key on.
+    """
+    path = layer.source().split('|')[0]
+    if layer.providerType() == 'memory' or not os.path.exists(path):
+        return None
+    signature = [layer.source(), os.path.getmtime(path), layer.extent().toString(17)]
+    # The attributes of a shapefile are in its .dbf, which saving edited
+    # values rewrites without touching the .shp
+    table = os.path.splitext(path)[0] + '.dbf'
+    if path.lower().endswith('.shp') and os.path.exists(table):
+        stat = os.stat(table)
+        signature += [stat.st_mtime, stat.st_size]
+    return signature
+
+
+def cached_run(algorithm, alg_params, signature, context, feedback, output='OUTPUT'):
+    """processing.run for raster producing steps, backed by the raster cache.
+
+    ``signature`` stands for the input (see :func:`source_signature`, or the
+    ``CACHE_KEY`` of an earlier cached result); the remaining parameters,
+    e.g. Z field and resolution, are part of the key as well.
+    """
+    if signature is None:
+        return processing.run(algorithm, alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+    rasters = cache.default_cache()
+    settings = {name: value for name, value in alg_params.items() if name not in ('INPUT', output)}
+    key = rasters.key(algorithm, signature, settings)
+    path = rasters.get(key)
+    if path is not None:
+        feedback.pushInfo('{}: using cached raster {}'.format(algorithm, path))
+    else:
+        result = processing.run(algorithm, alg_params, context=context, feedback=feedback, is_child_algorithm=True)
+        path = rasters.put(key, result[output])
+    return {output: path, 'CACHE_KEY': key}
+
+
+def ingest_cube(directory, velocityx, velocityy, depth, neighbours=12, radius=None, feedback=None):
+    """Pack all time columns of the three point layers into a :class:`VelocityCube`.
+
+    A cube that was already built in ``directory`` from the same, unchanged
+    layers is reused.
+    """
+    signature = [source_signature(layer) for layer in (velocityx, velocityy, depth)]
+    if None in signature:
+        signature = None
+    built = cube.existing(directory, signature)
+    if built is not None:
+        return built
+    try:
+        return cube.pack(directory, signature, mesh_tables(velocityx, velocityy, depth), neighbours, radius, feedback.pushInfo if feedback is not None else None)
+    except ValueError as error:
+        raise QgsProcessingException(str(error))
+
+
+def mesh_tables(velocityx, velocityy, depth):
+    """x, y and the time columns by name of the three point layers, by field."""
+    tables = {}
+    for field, layer in zip(cube.FIELDS, (velocityx, velocityy, depth)):
+        names = [name for _, name in time_columns(layer.fields().names())]
+        x, y, values = point_table(layer, names)
+        tables[field] = (x, y, {name: values[:, index] for index, name in enumerate(names)})
+    return tables
+
+
+def mesh_environment(velocityx, velocityy, depth, perimeter=None, houses=None):
+    """:class:`MeshEnvironment` of the three point layers, without any gridding."""
+    try:
+        return MeshEnvironment.from_tables(mesh_tables(velocityx, velocityy, depth), perimeter, houses)
+    except ValueError as error:
+        raise QgsProcessingException(str(error))
+
+
+def feature_count(result, context):
+    """Features of the vector layers among the values of a step result, None if there are none."""
+    counts = []
+    for value in (result or {}).values():
+        if not isinstance(value, str):
+            continue
+        layer = QgsProcessingUtils.mapLayerFromString(value, context)
+        if isinstance(layer, QgsVectorLayer):
+            counts.append(layer.featureCount())
+    return sum(counts) if counts else None
+
+
+class StepFeedback(QgsProcessingFeedback):
+    """Feedback of steps on a worker thread.
+
+    The messages are kept and passed on to the feedback of the algorithm in
+    its own thread with :meth:`replay`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def pushInfo(self, info):
+        self.messages.append(('pushInfo', info))
+
+    def pushWarning(self, warning):
+        self.messages.append(('pushWarning', warning))
+
+    def pushCommandInfo(self, info):
+        self.messages.append(('pushCommandInfo', info))
+
+    def pushDebugInfo(self, info):
+        self.messages.append(('pushDebugInfo', info))
+
+    def pushConsoleInfo(self, info):
+        self.messages.append(('pushConsoleInfo', info))
+
+    def reportError(self, error, fatalError=False):
+        self.messages.append(('reportError', error, fatalError))
+
+    def replay(self, feedback):
+        for name, *arguments in self.messages:
+            getattr(feedback, name)(*arguments)
+        self.messages = []
+
+
+def run_graph(graph, context, feedback, workers=1, profiler=None):
+    """Run a :class:`oilspill.dag.Graph` of child algorithm steps.
+
+    Every step is called as ``function(outputs, context, feedback)``.  With
+    ``workers`` 1 all steps run in order with ``context`` itself, as in the
+    exported models.  Otherwise the steps linked by dependencies (see
+    :meth:`oilspill.dag.Graph.chains`) run in order in one context of their
+    own, so that a step finds the temporary layers of the steps before it,
+    and the chains run concurrently; the temporary layers and messages of a
+    chain are handed to ``context`` and ``feedback`` once it is done.  A
+    chain with a ``home`` step runs with ``context`` in the calling thread.
+    ``feedback`` is expected to be a multi-step feedback with one step per
+    graph step.  Every step is measured with ``profiler`` and its timing
+    pushed to the feedback.  Returns None when the run was cancelled.
+    """
+    home = QThread.currentThread()
+    profiler = profiler or profiling.Profiler()
+    records = {}
+    finished = []
+    counts = {}
+
+    def call(step, outputs, step_context, step_feedback):
+        with profiler.measure(step.key) as record:
+            records[step.key] = record
+            return step.function(outputs, step_context, step_feedback)
+
+    def report(key, result):
+        finished.append(key)
+        feedback.setCurrentStep(len(finished))
+        counts[key] = feature_count(result, context)
+        inputs = [counts[dependency] for dependency in graph.steps[key].after if counts.get(dependency) is not None]
+        record = records[key]
+        record['inputs'] = sum(inputs) if inputs else None
+        record['outputs'] = counts[key]
+        feedback.pushInfo(profiler.summary(record))
+
+    if workers == 1:
+        return graph.run(lambda step, outputs: call(step, outputs, context, feedback), 1, canceled=feedback.isCanceled, done=report)
+
+    members = {}
+    chains = dag.Graph()
+    for keys in graph.chains():
+        members[keys[0]] = keys
+        chains.add(keys[0], None, home=any(graph.steps[key].home for key in keys))
+    contexts = {}
+
+    def run_chain(chain, _):
+        outputs = {}
+        if chain.home:
+            for key in members[chain.key]:
+                outputs[key] = call(graph.steps[key], outputs, context, feedback)
+            return outputs
+        child = QgsProcessingContext()
+        child.copyThreadSafeSettings(context)
+        child_feedback = StepFeedback()
+        feedback.canceled.connect(child_feedback.cancel, Qt.DirectConnection)
+        try:
+            for key in members[chain.key]:
+                if child_feedback.isCanceled():
+                    break
+                outputs[key] = call(graph.steps[key], outputs, child, child_feedback)
+        finally:
+            feedback.canceled.disconnect(child_feedback.cancel)
+        child.pushToThread(home)
+        contexts[chain.key] = (child, child_feedback)
+        return outputs
+
+    def done(key, outputs):
+        if key in contexts:
+            child, child_feedback = contexts.pop(key)
+            context.takeResultsFrom(child)
+            child_feedback.replay(feedback)
+        for member in members[key]:
+            if member in outputs:
+                report(member, outputs[member])
+
+    results = chains.run(run_chain, workers, canceled=feedback.isCanceled, done=done)
+    if results is None or feedback.isCanceled():
+        return None
+    return {key: result for outputs in results.values() for key, result in outputs.items()}
@@ -0,0 +1,298 @@
+"""Velocity and depth sampled directly on the mesh points.
+
+The models grid the mesh point values (inverse distance, nearest neighbour
+and fillnodata) before the particles can use them, which costs time and
+smooths the field.  Here the mesh points are triangulated once and every
+particle takes the barycentric interpolation of the three corners of the
+triangle it lies in.  Triangles whose centre lies outside the perimeter or
+inside a house are left out, so velocities are not blended across walls.
+
+Points are located with a walk: it starts at the triangle noted for the
+bucket of a coarse grid the point falls in and steps to the neighbour
+across the edge the point lies behind, which takes a few steps per point
+and is done for all points at once.
+"""
+import hashlib
+
+import numpy as np
+
+from oilspill.cube import bracket
+from oilspill.cube import time_columns
+from oilspill.cube import FIELDS
+from oilspill.geometry import inside
+
+
+# Walk steps before a point is given up as not on the mesh
+MAX_WALK = 1000
+
+# Barycentric coordinates this far below zero still count as inside
+TOLERANCE = 1e-9
+
+
+class Triangulation:
+    """Triangulated mesh points with a bucket grid of start triangles.
+
+    ``neighbors`` holds for every triangle the one across the edge opposite
+    each corner, -1 at the edge of the mesh; ``origin`` and ``matrix`` are
+    the affine maps to the first two barycentric coordinates, one array per
+    coefficient.  Triangles that are not ``valid`` are walked through but
+    give no values.
+    """
+
+    def __init__(self, x, y, triangles, neighbors, origin, matrix, valid):
+        from scipy.spatial import cKDTree
+
+        self.x = x
+        self.y = y
+        self.triangles = triangles
+        self.neighbors = neighbors
+        self.origin = origin
+        self.matrix = matrix
+        self.valid = valid
+        # Start triangles: the one nearest to the centre of every bucket
+        cx, cy = self.centres()
+        self.xmin = x.min()
+        self.ymin = y.min()
+        side = max(1, int(np.sqrt(len(triangles))))
+        self.bucket = max(x.max() - self.xmin, y.max() - self.ymin, 1e-9) / side
+        self.columns = int((x.max() - self.xmin) / self.bucket) + 1
+        self.rows = int((y.max() - self.ymin) / self.bucket) + 1
+        bx, by = np.meshgrid(self.xmin + (np.arange(self.columns) + 0.5) * self.bucket, self.ymin + (np.arange(self.rows) + 0.5) * self.bucket)
+        self.starts = cKDTree(np.column_stack((cx, cy))).query(np.column_stack((bx.ravel(), by.ravel())))[1].astype(np.intp)
+        following = np.roll(triangles, 1, axis=1)
+        edges = np.hypot(x[triangles] - x[following], y[triangles] - y[following])
+        self.spacing = float(np.median(edges[valid] if valid.any() else edges))
+
+    @classmethod
+    def build(cls, x, y, perimeter=None, houses=None):
+        """Delaunay triangulation of the points; triangles whose centre lies
+        outside the perimeter or in a house are not valid."""
+        from scipy.spatial import Delaunay
+
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        delaunay = Delaunay(np.column_stack((x, y)))
+        transform = delaunay.transform
+        triangles = delaunay.simplices.astype(np.intp)
+        cx = x[triangles].mean(axis=1)
+        cy = y[triangles].mean(axis=1)
+        valid = np.ones(len(triangles), dtype=bool)
+        if perimeter is not None:
+            valid &= inside(cx, cy, perimeter)
+        for house in houses or []:
+            valid &= ~inside(cx, cy, house)
+        return cls(
+            x, y, triangles, delaunay.neighbors.astype(np.intp),
+            (transform[:, 2, 0].copy(), transform[:, 2, 1].copy()),
+            (transform[:, 0, 0].copy(), transform[:, 0, 1].copy(), transform[:, 1, 0].copy(), transform[:, 1, 1].copy()),
+            valid
+        )
+
+    def centres(self):
+        return self.x[self.triangles].mean(axis=1), self.y[self.triangles].mean(axis=1)
+
+    def crop(self, xmin, ymin, xmax, ymax):
+        """The triangles reaching into the extent, unchanged, and the indices
+        of the points they use."""
+        tx = self.x[self.triangles]
+        ty = self.y[self.triangles]
+        keep = np.flatnonzero((tx.max(axis=1) >= xmin) & (tx.min(axis=1) <= xmax) & (ty.max(axis=1) >= ymin) & (ty.min(axis=1) <= ymax))
+        points = np.unique(self.triangles[keep])
+        number = np.full(len(self.triangles) + 1, -1, dtype=np.intp)
+        number[keep] = np.arange(len(keep))
+        # Neighbours that were cut off become the edge of the mesh (-1 maps
+        # to the extra last entry)
+        neighbors = number[self.neighbors[keep]]
+        cropped = Triangulation(
+            self.x[points], self.y[points], np.searchsorted(points, self.triangles[keep]), neighbors,
+            tuple(array[keep] for array in self.origin), tuple(array[keep] for array in self.matrix), self.valid[keep]
+        )
+        # Same sub-steps on every tile as on the whole mesh
+        cropped.spacing = self.spacing
+        return cropped, points
+
+    def barycentric(self, triangle, x, y):
+        a, b, c, d = self.matrix
+        dx = x - self.origin[0][triangle]
+        dy = y - self.origin[1][triangle]
+        b0 = a[triangle] * dx + b[triangle] * dy
+        b1 = c[triangle] * dx + d[triangle] * dy
+        return np.column_stack((b0, b1, 1 - b0 - b1))
+
+    def locate(self, x, y):
+        """Triangle of every point and its barycentric weights; -1 off the mesh."""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        column = np.clip(np.nan_to_num((x - self.xmin) / self.bucket), 0, self.columns - 1).astype(np.intp)
+        row = np.clip(np.nan_to_num((y - self.ymin) / self.bucket), 0, self.rows - 1).astype(np.intp)
+        triangle = self.starts[row * self.columns + column]
+        weights = np.zeros((len(x), 3))
+        finite = np.isfinite(x) & np.isfinite(y)
+        triangle[~finite] = -1
+        walking = np.flatnonzero(finite)
+        for _ in range(MAX_WALK):
+            if not len(walking):
+                break
+            current = triangle[walking]
+            b = self.barycentric(current, x[walking], y[walking])
+            behind = np.argmin(b, axis=1)
+            found = b[np.arange(len(walking)), behind] >= -TOLERANCE
+            weights[walking[found]] = b[found]
+            # Step across the edge opposite the most negative coordinate;
+            # past the hull of the mesh there is no neighbour
+            following = self.neighbors[current[~found], behind[~found]]
+            walking = walking[~found]
+            triangle[walking] = following
+            walking = walking[following >= 0]
+        triangle[walking] = -1
+        off = triangle < 0
+        off[~off] = ~self.valid[triangle[~off]]
+        triangle[off] = -1
+        weights[off] = 0
+        return triangle, weights
+
+    def interpolate(self, values, triangle, weights):
+        """Barycentric interpolation of point ``values``, NaN off the mesh.
+
+        Corners without a value (NaN) are left out and the weights of the
+        others renormalised, like bilinear sampling does with nodata.
+        """
+        result = np.full(len(triangle), np.nan)
+        on = triangle >= 0
+        corners = values[self.triangles[triangle[on]]]
+        w = np.where(np.isnan(corners), 0, weights[on])
+        total = w.sum(axis=1)
+        result[on] = np.where(total > 0, (w * np.nan_to_num(corners)).sum(axis=1) / np.where(total > 0, total, 1), np.nan)
+        return result
+
+
+def series(columns):
+    """Times and the list of point values of the time columns of a point table."""
+    found = time_columns(columns)
+    times = np.array([time for time, _ in found], dtype=np.float64)
+    return times, [np.asarray(columns[name], dtype=np.float64) for _, name in found]
+
+
+class MeshEnvironment:
+    """Velocity x, velocity y and depth interpolated on the mesh per particle.
+
+    ``mesh`` maps each of :data:`oilspill.cube.FIELDS` to its
+    :class:`Triangulation` and ``series`` to the times and the list of the
+    point values at these times; the fields are interpolated linearly in
+    time between the slices.  ``offset`` is the time of the spill in the
+    series.
+    """
+
+    method = 'mesh'
+
+    def __init__(self, mesh, series, perimeter=None, offset=0):
+        self.mesh = mesh
+        self.series = series
+        self.perimeter = perimeter
+        self.offset = offset
+        self.current = {}
+        self.update(0)
+
+    @classmethod
+    def from_tables(cls, tables, perimeter=None, houses=None, offset=0):
+        """Environment of point tables as for :func:`oilspill.cube.pack`.
+
+        Every column named by a number of minutes is a time slice; fields on
+        the same points share one triangulation.
+        """
+        meshes = {}
+        mesh = {}
+        values = {}
+        for field in FIELDS:
+            x, y, columns = tables[field]
+            values[field] = series(columns)
+            if not len(values[field][0]):
+                raise ValueError('No time columns for {}'.format(field))
+            digest = hashlib.sha1()
+            digest.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+            digest.update(np.ascontiguousarray(y, dtype=np.float64).tobytes())
+            key = digest.hexdigest()
+            if key not in meshes:
+                meshes[key] = Triangulation.build(x, y, perimeter, houses)
+            mesh[field] = meshes[key]
+        return cls(mesh, values, perimeter, offset)
+
+    def extend(self, tables):
+        """Append the time columns later than the last slice of each field.
+
+        ``tables`` as for :meth:`from_tables`, on the same points; returns
+        the number of slices added.  Earlier columns are left as they are.
+        """
+        added = 0
+        for field, (x, y, columns) in tables.items():
+            mesh = self.mesh[field]
+            if len(x) != len(mesh.x) or not (np.array_equal(x, mesh.x) and np.array_equal(y, mesh.y)):
+                raise ValueError('The points of {} are not those of the mesh'.format(field))
+            times, values = self.series[field]
+            last = times[-1] if len(times) else -np.inf
+            found = [(time, name) for time, name in time_columns(columns) if time > last]
+            if not found:
+                continue
+            values.extend(np.asarray(columns[name], dtype=np.float64) for _, name in found)
+            self.series[field] = (np.append(times, [time for time, _ in found]), values)
+            added += len(found)
+        return added
+
+    def horizon(self):
+        """Last time (after the spill) all fields have values for."""
+        return min(times[-1] for times, _ in self.series.values()) - self.offset
+
+    def update(self, time):
+        for field in FIELDS:
+            times, values = self.series[field]
+            lower, upper, weight = bracket(times, time + self.offset)
+            current = values[lower]
+            if weight:
+                current = current + weight * (values[upper] - current)
+            self.current[field] = current
+
+    def sample(self, fields, x, y):
+        located = {}
+        result = []
+        for field in fields:
+            mesh = self.mesh[field]
+            if id(mesh) not in located:
+                located[id(mesh)] = mesh.locate(x, y)
+            result.append(mesh.interpolate(self.current[field], *located[id(mesh)]))
+        return result
+
+    def values(self, x, y):
+        """velocity x, velocity y and depth per particle, NaN off the mesh."""
+        return tuple(self.sample(FIELDS, x, y))
+
+    def depth(self, x, y):
+        return self.sample(['depth'], x, y)[0]
+
+    def floodable(self, x, y):
+        """False where the interpolated depth cannot be above 0: no corner is wet."""
+        mesh = self.mesh['depth']
+        triangle, _ = mesh.locate(x, y)
+        wet = np.nan_to_num(self.current['depth'], nan=0) > 0
+        result = np.zeros(len(triangle), dtype=bool)
+        on = triangle >= 0
+        result[on] = wet[mesh.triangles[triangle[on]]].any(axis=1)
+        return result
+
+    @property
+    def cellsize(self):
+        """Median edge length of the finest mesh, the length scale of the CFL condition."""
+        return min(mesh.spacing for mesh in self.mesh.values())
+
+    def crop(self, xmin, ymin, xmax, ymax):
+        """The same environment on the triangles reaching into the extent."""
+        cropped = {}
+        mesh = {}
+        values = {}
+        for field in FIELDS:
+            key = id(self.mesh[field])
+            if key not in cropped:
+                cropped[key] = self.mesh[field].crop(xmin, ymin, xmax, ymax)
+            mesh[field], points = cropped[key]
+            times, slices = self.series[field]
+            values[field] = (times, [window[points] for window in slices])
+        return MeshEnvironment(mesh, values, self.perimeter, self.offset)
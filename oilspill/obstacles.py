@@ -0,0 +1,140 @@
+"""Building footprints as a boolean obstacle raster with a bucket index.
+
+Model2 finds particles that ended up in a house with saga:difference,
+native:extractbylocation, a join, randompointsinsidepolygons and
+removeduplicatesbyattribute on every stage.  Here the breaklines are
+prepared once:
+
+* a boolean raster marks the cells whose centre lies in a building, and a
+  second one the cells lying completely inside one,
+* cells crossed by a building outline are flagged as boundary cells and
+  point to the buildings touching them (a grid bucket index, which plays
+  the part of an STR tree and needs nothing beyond NumPy).
+
+A lookup is then one raster index per particle, with an exact point in
+polygon test only for the few particles that sit in a boundary cell.
+"""
+import numpy as np
+
+from oilspill.geometry import inside
+from oilspill.grid import GridSpec
+
+
+class Obstacles:
+
+    def __init__(self, buildings, spec):
+        """``buildings`` is a list of buildings, each a list of coordinate rings."""
+        self.buildings = [building for building in buildings if building]
+        self.spec = spec
+        self.mask = np.zeros(spec.shape, dtype=bool)
+        self.boundary = np.zeros(spec.shape, dtype=bool)
+        self.solid = np.zeros(spec.shape, dtype=bool)
+        buckets = {}
+        cx, cy = spec.centers()
+        for number, building in enumerate(self.buildings):
+            points = np.concatenate(building)
+            r0, c0 = self.cell(points[:, 0].min(), points[:, 1].max())
+            r1, c1 = self.cell(points[:, 0].max(), points[:, 1].min())
+            block = (slice(r0, r1 + 1), slice(c0, c1 + 1))
+            covered = inside(cx[block].ravel(), cy[block].ravel(), building).reshape(cx[block].shape)
+            self.mask[block] |= covered
+            outline = np.zeros(spec.shape, dtype=bool)
+            for row, column in self.outline_cells(building):
+                outline[row, column] = True
+                buckets.setdefault(row * spec.width + column, []).append(number)
+            self.boundary |= outline
+            # Cells lying completely inside this building
+            self.solid[block] |= covered & ~outline[block]
+        # Buckets as CSR arrays: cell -> building numbers
+        cells = np.array(sorted(buckets), dtype=np.int64)
+        self.bucket_cells = cells
+        self.bucket_start = np.zeros(len(cells) + 1, dtype=np.int64)
+        self.bucket_start[1:] = np.cumsum([len(set(buckets[cell])) for cell in cells])
+        self.bucket_buildings = np.array([number for cell in cells for number in sorted(set(buckets[cell]))], dtype=np.int64)
+
+    @classmethod
+    def around(cls, buildings, cellsize=1.0, margin=1.0):
+        points = np.concatenate([ring for building in buildings for ring in building])
+        xmin, ymin = points.min(axis=0) - margin
+        xmax, ymax = points.max(axis=0) + margin
+        return cls(buildings, GridSpec.with_cellsize(xmin, ymin, xmax, ymax, cellsize))
+
+    def cell(self, x, y):
+        spec = self.spec
+        column = np.clip(np.floor((np.asarray(x) - spec.xmin) / spec.cellsize_x).astype(np.intp), 0, spec.width - 1)
+        row = np.clip(np.floor((spec.ymax - np.asarray(y)) / spec.cellsize_y).astype(np.intp), 0, spec.height - 1)
+        return row, column
+
+    def outline_cells(self, building):
+        # Cells touched by the outline: every segment is walked in steps of
+        # half a cell and the cells found are grown by one in all directions,
+        # so that segments clipping a cell corner between two steps are caught
+        step = 0.5 * min(self.spec.cellsize_x, self.spec.cellsize_y)
+        cells = set()
+        for ring in building:
+            for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+                count = max(1, int(np.ceil(np.hypot(x2 - x1, y2 - y1) / step)))
+                t = np.linspace(0, 1, count + 1)
+                rows, columns = self.cell(x1 + t * (x2 - x1), y1 + t * (y2 - y1))
+                cells.update(zip(rows.tolist(), columns.tolist()))
+        grown = set()
+        for row, column in cells:
+            for drow in (-1, 0, 1):
+                for dcolumn in (-1, 0, 1):
+                    if 0 <= row + drow < self.spec.height and 0 <= column + dcolumn < self.spec.width:
+                        grown.add((row + drow, column + dcolumn))
+        return grown
+
+    def contains(self, x, y):
+        """True for every point that lies inside a building."""
+        spec = self.spec
+        result = np.zeros(np.shape(x), dtype=bool)
+        within = (x >= spec.xmin) & (x < spec.xmax) & (y > spec.ymin) & (y <= spec.ymax)
+        index = np.flatnonzero(within)
+        if not len(index):
+            return result
+        rows, columns = self.cell(x[index], y[index])
+        result[index] = self.solid[rows, columns]
+        edge = self.boundary[rows, columns] & ~result[index]
+        if not edge.any():
+            return result
+        # Exact test for the particles in boundary cells, grouped by building
+        index = index[edge]
+        flat = rows[edge] * spec.width + columns[edge]
+        slot = np.searchsorted(self.bucket_cells, flat)
+        exact = np.zeros(len(index), dtype=bool)
+        starts = self.bucket_start[slot]
+        counts = self.bucket_start[slot + 1] - starts
+        for offset in range(int(counts.max())):
+            has = counts > offset
+            numbers = self.bucket_buildings[starts[has] + offset]
+            members = np.flatnonzero(has)
+            for number in np.unique(numbers):
+                chosen = members[numbers == number]
+                exact[chosen] |= inside(x[index[chosen]], y[index[chosen]], self.buildings[number])
+        result[index] |= exact
+        return result
+
+    def deflect(self, x0, y0, x, y):
+        """Move particles that ended up in a building out of it, in place.
+
+        A particle first tries to slide along the wall, keeping only the x or
+        only the y part of its displacement; if both are blocked it stays at
+        its previous position.  Returns the mask of deflected particles.
+        """
+        hit = self.contains(x, y)
+        index = np.flatnonzero(hit)
+        if not len(index):
+            return hit
+        for along_x in (True, False):
+            slide_x = x[index] if along_x else x0[index]
+            slide_y = y0[index] if along_x else y[index]
+            free = ~self.contains(slide_x, slide_y)
+            x[index[free]] = slide_x[free]
+            y[index[free]] = slide_y[free]
+            index = index[~free]
+            if not len(index):
+                return hit
+        x[index] = x0[index]
+        y[index] = y0[index]
+        return hit
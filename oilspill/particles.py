@@ -0,0 +1,72 @@
+"""Particles as one typed array per attribute.
+
+The models hold the particles as features of temporary memory layers, and
+every refactor or join step copies all of them together with attributes
+nobody reads again.  Here a particle is one entry in each of a handful of
+contiguous arrays: its id, coordinates, oil volume, age and state, 37 bytes
+in all.  QGIS layers are only read into (:func:`oilspill.layers.layer_particles`)
+and written from (:func:`oilspill.layers.write_particles`) this container at
+the ends of a model.
+"""
+import numpy as np
+
+
+# Values of ``state``
+ACTIVE = 0
+STRANDED = 1
+
+DTYPES = (
+    ('ids', np.int64),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('mass', np.float64),
+    ('age', np.float32),
+    ('state', np.uint8),
+)
+
+
+class Particles:
+    """``ids``, ``x``, ``y``, ``mass`` (litres), ``age`` (minutes since
+    seeding) and ``state`` of the particles; missing mass is NaN, missing
+    age 0 and the state :data:`ACTIVE`."""
+
+    def __init__(self, ids, x, y, mass=None, age=None, state=None):
+        count = len(ids)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.mass = np.full(count, np.nan) if mass is None else np.asarray(mass, dtype=np.float64)
+        self.age = np.zeros(count, dtype=np.float32) if age is None else np.asarray(age, dtype=np.float32)
+        self.state = np.full(count, ACTIVE, dtype=np.uint8) if state is None else np.asarray(state, dtype=np.uint8)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, dtype=np.int64), np.empty(0), np.empty(0))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def arrays(self):
+        """The arrays by name, in the order of :data:`DTYPES`."""
+        return {name: getattr(self, name) for name, _ in DTYPES}
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays().values())
+
+    @property
+    def stranded(self):
+        return self.state == STRANDED
+
+    @stranded.setter
+    def stranded(self, flags):
+        self.state = np.where(flags, STRANDED, ACTIVE).astype(np.uint8)
+
+    def keep(self, mask):
+        """Keep the particles selected by a boolean mask or an index array."""
+        for name, _ in DTYPES:
+            setattr(self, name, getattr(self, name)[mask])
+
+    def take(self, index):
+        """New container with the particles ``index``."""
+        return Particles(*(getattr(self, name)[index] for name, _ in DTYPES))
@@ -0,0 +1,132 @@
+"""Wall time, CPU time and memory of the steps of a run.
+
+Each measured step becomes a record with its wall and CPU time, the
+resident memory after it and the peak of the process while it ran, plus
+whatever the caller adds (feature counts for child algorithms).  Records
+are written as plain JSON or in the Chrome trace event format, which
+chrome://tracing and Perfetto show as a timeline with one row per thread.
+
+CPU time is that of the measuring thread plus the CPU time of child
+processes (gdal_grid, saga_cmd) that ended during the step; with steps
+running concurrently the latter cannot be told apart.  The peak memory is
+reset at the start of a step where the system allows it (Linux), and only
+when no other step is running at that time.
+"""
+import json
+import os
+import threading
+import time as clock
+from contextlib import contextmanager
+
+
+def _status(field):
+    try:
+        with open('/proc/self/status') as handle:
+            for line in handle:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def rss_mb():
+    return _status('VmRSS')
+
+
+def peak_rss_mb():
+    peak = _status('VmHWM')
+    if peak is not None:
+        return peak
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if os.uname().sysname == 'Darwin' else 1024)
+
+
+def reset_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as handle:
+            handle.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _children_cpu():
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+class Profiler:
+
+    def __init__(self):
+        self.records = []
+        self.origin = clock.perf_counter()
+        self.lock = threading.Lock()
+        self.active = 0
+
+    def start(self, name, **extra):
+        """Start measuring ``name``; pass the returned record to :meth:`stop`."""
+        with self.lock:
+            if not self.active:
+                reset_peak()
+            self.active += 1
+        record = dict(extra, name=name, thread=threading.get_ident())
+        record['_start'] = (clock.perf_counter(), clock.thread_time(), _children_cpu())
+        return record
+
+    def stop(self, record, **extra):
+        start, cpu, children = record.pop('_start')
+        record.update(extra)
+        record['start_s'] = start - self.origin
+        record['wall_s'] = clock.perf_counter() - start
+        record['cpu_s'] = clock.thread_time() - cpu
+        record['children_cpu_s'] = _children_cpu() - children
+        record['rss_mb'] = rss_mb()
+        record['peak_rss_mb'] = peak_rss_mb()
+        with self.lock:
+            self.active -= 1
+            self.records.append(record)
+        return record
+
+    @contextmanager
+    def measure(self, name, **extra):
+        """Measure the block; yields the record so the caller can add fields."""
+        record = self.start(name, **extra)
+        try:
+            yield record
+        finally:
+            self.stop(record)
+
+    @staticmethod
+    def summary(record):
+        text = '{name}: {wall_s:.2f} s wall, {cpu:.2f} s CPU'.format(cpu=record['cpu_s'] + record['children_cpu_s'], **record)
+        if record.get('peak_rss_mb') is not None:
+            text += ', {:.0f} MB peak'.format(record['peak_rss_mb'])
+        if record.get('inputs') is not None or record.get('outputs') is not None:
+            text += ', features in {} / out {}'.format(*('-' if record.get(key) is None else record[key] for key in ('inputs', 'outputs')))
+        return text
+
+    def chrome_trace(self):
+        threads = {}
+        events = []
+        for record in sorted(self.records, key=lambda record: record['start_s']):
+            tid = threads.setdefault(record['thread'], len(threads))
+            arguments = {key: value for key, value in record.items() if key not in ('name', 'thread', 'start_s', 'wall_s')}
+            events.append({
+                'name': record['name'], 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                'ts': record['start_s'] * 1e6, 'dur': record['wall_s'] * 1e6, 'args': arguments
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path, chrome=None):
+        """Write the records; ``chrome`` None picks the trace format for ``*.trace.json``."""
+        if chrome is None:
+            chrome = path.lower().endswith('.trace.json')
+        data = self.chrome_trace() if chrome else {'steps': sorted(self.records, key=lambda record: record['start_s'])}
+        with open(path, 'w') as handle:
+            json.dump(data, handle, indent=1)
+        return path
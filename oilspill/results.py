@@ -0,0 +1,76 @@
+"""One SQLite file holding the particles of many scenarios and stages.
+
+Batch runs write every stage of every scenario into the ``particles``
+table, indexed on scenario and stage time, so that one stage of one
+scenario is read back with a single index lookup.  The parameters of each
+scenario are kept as JSON in the ``scenarios`` table.
+"""
+import json
+import sqlite3
+
+import numpy as np
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenarios (
+    scenario INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    parameters TEXT
+);
+CREATE TABLE IF NOT EXISTS particles (
+    scenario INTEGER NOT NULL,
+    stage_time REAL NOT NULL,
+    id INTEGER NOT NULL,
+    x REAL NOT NULL,
+    y REAL NOT NULL,
+    mass REAL
+);
+CREATE INDEX IF NOT EXISTS particles_stage ON particles (scenario, stage_time);
+"""
+
+
+class ResultStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def scenario(self, name, parameters=None):
+        """Id of scenario ``name``; its earlier results are removed."""
+        with self.connection:
+            row = self.connection.execute('SELECT scenario FROM scenarios WHERE name = ?', (name,)).fetchone()
+            if row is not None:
+                self.connection.execute('DELETE FROM particles WHERE scenario = ?', (row[0],))
+                self.connection.execute('UPDATE scenarios SET parameters = ? WHERE scenario = ?', (json.dumps(parameters), row[0]))
+                return row[0]
+            return self.connection.execute('INSERT INTO scenarios (name, parameters) VALUES (?, ?)', (name, json.dumps(parameters))).lastrowid
+
+    def append(self, scenario, time, ids, x, y, mass=None):
+        """Add the particles of one stage in one transaction."""
+        mass = np.full(len(ids), np.nan) if mass is None else mass
+        rows = zip([scenario] * len(ids), [float(time)] * len(ids), ids.tolist(), x.tolist(), y.tolist(), mass.tolist())
+        with self.connection:
+            self.connection.executemany('INSERT INTO particles VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def names(self):
+        return [row[0] for row in self.connection.execute('SELECT name FROM scenarios ORDER BY scenario')]
+
+    def times(self, name):
+        query = 'SELECT DISTINCT stage_time FROM particles JOIN scenarios USING (scenario) WHERE name = ? ORDER BY stage_time'
+        return [row[0] for row in self.connection.execute(query, (name,))]
+
+    def stage(self, name, time):
+        """ids, x, y and mass of scenario ``name`` at ``time``."""
+        query = 'SELECT id, x, y, mass FROM particles JOIN scenarios USING (scenario) WHERE name = ? AND stage_time = ? ORDER BY id'
+        rows = np.array(self.connection.execute(query, (name, float(time))).fetchall(), dtype=float).reshape(-1, 4)
+        return rows[:, 0].astype(np.int64), rows[:, 1], rows[:, 2], rows[:, 3]
@@ -0,0 +1,156 @@
+"""Depth and velocity sampled at the particle positions.
+
+The models attach raster values to the perimeter polygon with
+saga:addrastervaluestofeatures and join them to the particles, so every
+particle inside the polygon moves with the same value.  Here the grids are
+looked up at the coordinates of each particle in one vectorized pass,
+either at the nearest cell or bilinearly between the four surrounding cell
+centres.
+"""
+import numpy as np
+
+from oilspill.geometry import inside
+
+
+def valid(grid):
+    values = grid.values
+    if grid.nodata is None:
+        return np.isfinite(values)
+    return np.isfinite(values) & (values != grid.nodata)
+
+
+def sample(grid, x, y, method='bilinear', mask=None):
+    """Values of ``grid`` at the points, NaN for nodata and outside the grid.
+
+    ``mask`` optionally restricts the valid cells further.  Bilinear weights
+    are renormalised over the valid corners.
+    """
+    spec = grid.spec
+    ok = valid(grid) if mask is None else valid(grid) & mask
+    # Continuous cell coordinates, cell centres at integer positions
+    column = (x - spec.xmin) / spec.cellsize_x - 0.5
+    row = (spec.ymax - y) / spec.cellsize_y - 0.5
+    result = np.full(np.shape(x), np.nan)
+    within = (column >= -0.5) & (column < spec.width - 0.5) & (row >= -0.5) & (row < spec.height - 0.5)
+    if method == 'nearest':
+        c = np.clip(np.rint(column[within]).astype(np.intp), 0, spec.width - 1)
+        r = np.clip(np.rint(row[within]).astype(np.intp), 0, spec.height - 1)
+        result[within] = np.where(ok[r, c], grid.values[r, c], np.nan)
+        return result
+    column = column[within]
+    row = row[within]
+    c0 = np.clip(np.floor(column).astype(np.intp), 0, spec.width - 1)
+    r0 = np.clip(np.floor(row).astype(np.intp), 0, spec.height - 1)
+    c1 = np.minimum(c0 + 1, spec.width - 1)
+    r1 = np.minimum(r0 + 1, spec.height - 1)
+    fc = np.clip(column - c0, 0, 1)
+    fr = np.clip(row - r0, 0, 1)
+    total = np.zeros(len(column))
+    weight = np.zeros(len(column))
+    for r, c, w in ((r0, c0, (1 - fr) * (1 - fc)), (r0, c1, (1 - fr) * fc), (r1, c0, fr * (1 - fc)), (r1, c1, fr * fc)):
+        corner = ok[r, c]
+        w = np.where(corner, w, 0)
+        total += w * np.where(corner, grid.values[r, c], 0)
+        weight += w
+    result[within] = np.where(weight > 0, total / np.where(weight > 0, weight, 1), np.nan)
+    return result
+
+
+class GridEnvironment:
+    """Velocity x, velocity y and depth grids sampled per particle.
+
+    ``perimeter`` (a list of coordinate rings) limits the valid area like the
+    perimeter polygon of the models: outside it particles get no values.
+    """
+
+    def __init__(self, velocityx, velocityy, depth, method='bilinear', perimeter=None):
+        self.method = method
+        self.perimeter = perimeter
+        self.masks = {}
+        self.grids = None
+        self._floodable = None
+        self.set_grids(velocityx, velocityy, depth)
+
+    def set_grids(self, velocityx, velocityy, depth):
+        self.grids = (velocityx, velocityy, depth)
+
+    @property
+    def cellsize(self):
+        """Smallest cell side of the grids, the length scale of the CFL condition."""
+        return min(min(grid.spec.cellsize_x, grid.spec.cellsize_y) for grid in self.grids)
+
+    def mask(self, spec):
+        if self.perimeter is None:
+            return None
+        key = spec.key()
+        if key not in self.masks:
+            cx, cy = spec.centers()
+            self.masks[key] = inside(cx.ravel(), cy.ravel(), self.perimeter).reshape(spec.shape)
+        return self.masks[key]
+
+    def values(self, x, y):
+        """velocity x, velocity y and depth per particle, NaN where there is no value."""
+        return tuple(sample(grid, x, y, self.method, self.mask(grid.spec)) for grid in self.grids)
+
+    def depth(self, x, y):
+        grid = self.grids[2]
+        return sample(grid, x, y, self.method, self.mask(grid.spec))
+
+    def floodable(self, x, y):
+        """False where the sampled depth cannot be above 0, one cell lookup per point.
+
+        A cell is floodable when one of the cells whose centres surround it
+        is wet, so the answer is conservative for both sampling methods.
+        """
+        grid = self.grids[2]
+        if self._floodable is None or self._floodable[0] is not grid:
+            spec = grid.spec
+            mask = self.mask(spec)
+            wet = valid(grid) & (np.nan_to_num(grid.values, nan=0) > 0)
+            if mask is not None:
+                wet &= mask
+            near = wet.copy()
+            near[:, :-1] |= wet[:, 1:]
+            near[:-1, :] |= near[1:, :].copy()
+            self._floodable = (grid, near)
+        spec = grid.spec
+        column = np.floor((x - spec.xmin) / spec.cellsize_x - 0.5)
+        row = np.floor((spec.ymax - y) / spec.cellsize_y - 0.5)
+        within = (column >= -1) & (column < spec.width) & (row >= -1) & (row < spec.height)
+        result = np.zeros(np.shape(x), dtype=bool)
+        result[within] = self._floodable[1][
+            np.clip(row[within].astype(np.intp), 0, spec.height - 1),
+            np.clip(column[within].astype(np.intp), 0, spec.width - 1)
+        ]
+        return result
+
+    def update(self, time):
+        pass
+
+    def crop(self, xmin, ymin, xmax, ymax):
+        """The same environment with the grids cut down to the extent."""
+        return GridEnvironment(*(grid.crop(xmin, ymin, xmax, ymax) for grid in self.grids), method=self.method, perimeter=self.perimeter)
+
+
+class CubeEnvironment(GridEnvironment):
+    """Grids taken from a :class:`VelocityCube` at the time of every stage.
+
+    ``offset`` is the time of the spill in the cube, so a spill can start at
+    any time of the hydrodynamic run.  With ``extent`` only the part of the
+    cube covering it is read.
+    """
+
+    def __init__(self, cube, method='bilinear', perimeter=None, offset=0, extent=None):
+        self.cube = cube
+        self.offset = offset
+        self.extent = extent
+        self.window = None if extent is None else cube.spec.window(*extent)
+        first = cube.at(cube.times[0] + offset, self.window)
+        super().__init__(*first, method=method, perimeter=perimeter)
+
+    def update(self, time):
+        self.set_grids(*self.cube.at(time + self.offset, self.window))
+
+    def crop(self, xmin, ymin, xmax, ymax):
+        # Only the window of the slices is read on every update
+        return CubeEnvironment(self.cube, self.method, self.perimeter, self.offset, (xmin, ymin, xmax, ymax))
@@ -0,0 +1,41 @@
+"""Geometry of ESRI shapefiles read with the standard library.
+
+The Laufen example data ships as bare ``.shp`` files without ``.shx`` and
+``.dbf``, which OGR refuses to open without extra configuration.  Only the
+geometry is needed for the benchmark, so the main file is read directly.
+"""
+import struct
+
+import numpy as np
+
+
+POINT = 1
+POLYLINE = 3
+POLYGON = 5
+
+
+def read(path):
+    """Shape type and the shapes, each a list of parts as ``(n, 2)`` arrays.
+
+    Points are returned as a single part with one coordinate pair; the Z and
+    M variants are read as their 2D counterpart.
+    """
+    with open(path, 'rb') as handle:
+        data = handle.read()
+    kind = struct.unpack('<i', data[32:36])[0] % 10
+    shapes = []
+    offset = 100
+    while offset + 8 <= len(data):
+        length = struct.unpack('>i', data[offset + 4:offset + 8])[0] * 2
+        record = data[offset + 8:offset + 8 + length]
+        offset += 8 + length
+        if struct.unpack('<i', record[:4])[0] == 0:
+            continue
+        if kind == POINT:
+            shapes.append([np.array([struct.unpack('<2d', record[4:20])])])
+            continue
+        parts, points = struct.unpack('<2i', record[36:44])
+        starts = list(struct.unpack('<{}i'.format(parts), record[44:44 + 4 * parts])) + [points]
+        coordinates = np.frombuffer(record, dtype='<f8', count=2 * points, offset=44 + 4 * parts).reshape(points, 2)
+        shapes.append([coordinates[start:end].copy() for start, end in zip(starts[:-1], starts[1:])])
+    return kind, shapes
@@ -0,0 +1,214 @@
+"""In-process chaining of the first and the second stage.
+
+The two Processing models move the particles through a series of child
+algorithms and temporary layers.  This module reproduces the same stage
+logic on particle arrays that stay in memory between the stages, so that
+a whole simulation only needs QGIS for the one-off preparation of the
+environment and for writing the results; the stages themselves run on
+NumPy alone, also in worker processes.
+"""
+import numpy as np
+
+from oilspill import kernel
+from oilspill.geometry import SlickHull
+from oilspill.geometry import inside
+from oilspill.particles import ACTIVE
+from oilspill.particles import STRANDED
+from oilspill.particles import Particles
+from oilspill.weathering import WeatheringTable
+from oilspill.weathering import initial_radius
+
+
+def _stored(name):
+    # Attribute of the simulation that is the array of the particle store
+    return property(lambda self: getattr(self.store, name), lambda self, value: setattr(self.store, name, value))
+
+
+class Simulation:
+    """Particle state of one spill, advanced stage by stage.
+
+    Particles are kept in ``store``, a :class:`~oilspill.particles.Particles`
+    whose arrays ``ids``, ``x``, ``y``, ``mass`` (litres of oil), ``age`` and
+    ``stranded`` (those left on dry ground) are also attributes of the
+    simulation.  Without a ``particles`` budget there is one particle per litre
+    and evaporation removes particles like the random selection of the
+    models; with a budget the spill is split into that many particles and
+    evaporation reduces their mass instead.  ``run`` calls
+    ``on_stage(time, simulation)`` after every stage, which is where the
+    caller writes snapshots if it wants them.
+
+    The advection of a stage is one Euler step like in the models unless
+    ``courant`` is given: the stage is then split into sub-steps along which
+    no particle crosses more than that fraction of a grid cell, integrated
+    with ``integrator`` (see :func:`kernel.advect`).
+
+    ``weathering`` is a :class:`~oilspill.weathering.WeatheringTable` with the
+    evaporation and spreading of the stages precomputed, which ensembles and
+    sweeps share between their runs.
+    """
+
+    def __init__(self, environment, volume, temperature, timespan, source, tank, obstacles=None, seed=None, particles=None, integrator='euler', courant=None, weathering=None):
+        self.environment = environment
+        self.volume = volume
+        self.temperature = temperature
+        self.timespan = timespan
+        self.source = source
+        self.tank = tank
+        self.obstacles = obstacles
+        self.budget = particles or None
+        self.integrator = integrator
+        self.courant = courant or None
+        self.weathering = weathering or WeatheringTable()
+        self.substeps = 0
+        self.random = np.random.default_rng(seed)
+        self.store = Particles.empty()
+        self.shape = SlickHull()
+        self.time = None
+
+    @property
+    def particles(self):
+        return self.ids, self.x, self.y
+
+    ids = _stored('ids')
+    x = _stored('x')
+    y = _stored('y')
+    mass = _stored('mass')
+    age = _stored('age')
+    stranded = _stored('stranded')
+
+    def keep(self, mask):
+        self.store.keep(mask)
+        self.shape.keep(mask)
+
+    def seed(self):
+        # Zufällige Punkte in Polygonen: one particle per litre inside the buffer
+        count = int(self.budget or self.volume)
+        radius = initial_radius(self.volume)
+        distance = radius * np.sqrt(self.random.random(count))
+        angle = 2 * np.pi * self.random.random(count)
+        self.store = Particles(
+            np.arange(count, dtype=np.int64),
+            self.source[0] + distance * np.cos(angle),
+            self.source[1] + distance * np.sin(angle),
+            np.full(count, self.volume / count)
+        )
+        self.shape.moved()
+
+    def evaporate(self, percent):
+        percent = max(0, min(100, percent))
+        if self.budget is not None:
+            self.mass *= percent / 100
+            return
+        # Zufällige Auswahl: keep the given percentage of the particles
+        keep = int(round(len(self.ids) * percent / 100))
+        self.keep(np.sort(self.random.choice(len(self.ids), keep, replace=False)))
+
+    def hull(self):
+        """Closed ring of the convex hull of the particles."""
+        return self.shape.ring(self.x, self.y)
+
+    def centroid(self):
+        return self.shape.centroid(self.x, self.y)
+
+    def advect(self, x, y, threshold, obstacles=None):
+        """Advect ``x`` and ``y`` over one stage, return the depth at the start positions."""
+        depth, self.substeps = kernel.advect(
+            x, y, self.environment.values, self.timespan, threshold,
+            integrator=self.integrator, courant=self.courant,
+            cellsize=self.environment.cellsize if self.courant else None,
+            obstacles=obstacles if self.courant else None
+        )
+        return depth
+
+    def active(self):
+        """Indices of the particles on wet ground.
+
+        Particles where the depth is not above 0 neither spread nor drift, so
+        they are marked as stranded.  Stranded particles are only sampled
+        again where the depth grid is wet nearby (the water may have risen),
+        which late in an event leaves most of the oil out of the stage.
+        """
+        state = self.store.state
+        stranded = np.flatnonzero(state == STRANDED)
+        if len(stranded):
+            state[stranded[self.environment.floodable(self.x[stranded], self.y[stranded])]] = ACTIVE
+        index = np.flatnonzero(state != STRANDED)
+        depth = self.environment.depth(self.x[index], self.y[index])
+        wet = kernel.wet(depth, 0)
+        state[index[~wet]] = STRANDED
+        return index[wet]
+
+    def first_stage(self, time):
+        self.seed()
+        kernel.translate(self.x, self.y, origin=self.tank, distance=self.weathering.spreading_distance(self.volume, time, self.timespan))
+        self.evaporate(self.weathering.kept_percent(self.temperature, time))
+        # Particles outside the perimeter are discarded like by the join with
+        # DISCARD_NONMATCHING, dry ones inside stay where they are
+        self.keep(self.move_first(time))
+        self.time = time
+
+    def move_first(self, time):
+        """Advect the new particles, return the mask of those inside the perimeter."""
+        self.environment.update(time)
+        perimeter = self.environment.perimeter
+        keep = np.ones(len(self.x), dtype=bool) if perimeter is None else inside(self.x, self.y, perimeter)
+        self.advect(self.x, self.y, 0)
+        self.shape.moved()
+        return keep
+
+    def second_stage(self, time):
+        self.store.age += self.timespan
+        previous = max(time - self.timespan, 1)
+        self.evaporate(self.weathering.kept_percent(self.temperature, time, previous))
+        if not len(self.ids):
+            self.time = time
+            return
+        # Spreading direction away from the slick centroid, taken from the
+        # hull kept since the last stage when evaporation left its vertices
+        self.move(time, self.centroid())
+        self.time = time
+
+    def move(self, time, center):
+        """Spread the particles away from ``center`` and advect them."""
+        self.environment.update(time)
+        # Each active particle is spread and advected with the values at its
+        # own position, sampled again after the spreading
+        index = self.active()
+        x = self.x[index]
+        y = self.y[index]
+        x0 = x.copy()
+        y0 = y.copy()
+        kernel.translate(x, y, origin=tuple(center), distance=self.weathering.spreading_distance(self.volume, time, self.timespan))
+        self.advect(x, y, 0.001, self.obstacles)
+        if self.obstacles is not None:
+            # Particles that ended up inside a house slide along its wall
+            self.obstacles.deflect(x0, y0, x, y)
+        self.x[index] = x
+        self.y[index] = y
+        if len(index):
+            self.shape.moved()
+
+    def run(self, start, end, feedback=None, on_stage=None):
+        """Run the stages from ``start`` to ``end``.
+
+        A simulation restored from a checkpoint continues with the stage
+        after its own time, ``start`` is then ignored.
+        """
+        resumed = self.time is not None
+        times = [self.time + self.timespan if resumed else start]
+        while times[-1] + self.timespan <= end:
+            times.append(times[-1] + self.timespan)
+        if times[0] > end:
+            return self.particles
+        for step, time in enumerate(times):
+            if feedback is not None and feedback.isCanceled():
+                break
+            if step == 0 and not resumed:
+                self.first_stage(time)
+            else:
+                self.second_stage(time)
+            if on_stage is not None:
+                on_stage(time, self)
+            if feedback is not None:
+                feedback.setProgress(100 * (step + 1) / len(times))
+        return self.particles
@@ -0,0 +1,189 @@
+"""All stages of a run appended to one GeoPackage point layer.
+
+Instead of one layer per stage, the particles of every stage go into the
+same ``particles`` table with their ``stage_time``, one transaction per
+stage, and an index on ``stage_time`` makes reading one stage back a single
+index lookup.  The file is written with the standard library's sqlite3
+following the GeoPackage encoding (a small header in front of the
+little-endian WKB point), so QGIS opens it as an ordinary point layer and
+filters it by ``stage_time``.  The geometry blobs of a whole stage are
+built at once with numpy; the table is only appended to, so writing a
+stage takes the same time at the end of a long run as at its start.
+"""
+import sqlite3
+
+import numpy as np
+
+
+# "GP", version 0, flags (little endian, no envelope), srs id, then the WKB
+# point: byte order, geometry type 1, x, y
+BLOB = np.dtype([
+    ('magic', 'S2'), ('version', 'u1'), ('flags', 'u1'), ('srs', '<i4'),
+    ('order', 'u1'), ('type', '<u4'), ('x', '<f8'), ('y', '<f8'),
+])
+
+# Spatial reference systems every GeoPackage has to define
+SPATIAL_REF_SYS = (
+    ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system'),
+    ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system'),
+    ('WGS 84 geodetic', 4326, 'EPSG', 4326, 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["degree",0.0174532925199433]]', 'longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid'),
+)
+
+# srs_id of a CRS without an EPSG code
+CUSTOM_SRS = 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+    srs_name TEXT NOT NULL,
+    srs_id INTEGER PRIMARY KEY,
+    organization TEXT NOT NULL,
+    organization_coordsys_id INTEGER NOT NULL,
+    definition TEXT NOT NULL,
+    description TEXT
+);
+CREATE TABLE IF NOT EXISTS gpkg_contents (
+    table_name TEXT NOT NULL PRIMARY KEY,
+    data_type TEXT NOT NULL,
+    identifier TEXT UNIQUE,
+    description TEXT DEFAULT '',
+    last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+    min_x DOUBLE,
+    min_y DOUBLE,
+    max_x DOUBLE,
+    max_y DOUBLE,
+    srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id)
+);
+CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (
+    table_name TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    geometry_type_name TEXT NOT NULL,
+    srs_id INTEGER NOT NULL,
+    z TINYINT NOT NULL,
+    m TINYINT NOT NULL,
+    CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name)
+);
+"""
+
+TABLE = """
+CREATE TABLE IF NOT EXISTS "{0}" (
+    fid INTEGER PRIMARY KEY AUTOINCREMENT,
+    geom POINT,
+    stage_time REAL NOT NULL,
+    id INTEGER NOT NULL,
+    mass REAL
+);
+CREATE INDEX IF NOT EXISTS "{0}_stage_time" ON "{0}" (stage_time);
+"""
+
+
+def geometry_blobs(x, y, srs_id):
+    """GeoPackage point geometries of the coordinates, one bytes object each."""
+    blobs = np.zeros(len(x), dtype=BLOB)
+    blobs['magic'] = b'GP'
+    blobs['flags'] = 1
+    blobs['srs'] = srs_id
+    blobs['order'] = 1
+    blobs['type'] = 1
+    blobs['x'] = x
+    blobs['y'] = y
+    data = blobs.tobytes()
+    size = BLOB.itemsize
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+def points(blobs):
+    """x and y of geometry blobs written by :func:`geometry_blobs`."""
+    if not blobs:
+        return np.empty(0), np.empty(0)
+    if any(len(blob) != BLOB.itemsize for blob in blobs):
+        raise ValueError('Not a point geometry without envelope')
+    decoded = np.frombuffer(b''.join(blobs), dtype=BLOB)
+    return decoded['x'].astype(np.float64), decoded['y'].astype(np.float64)
+
+
+class StageStore:
+    """GeoPackage layer ``table`` in ``path`` the stages are appended to.
+
+    ``epsg`` names the CRS of the coordinates; without it ``crs_wkt`` is
+    stored as a custom CRS.  An existing file is appended to, so stages
+    written by separate runs of the second stage model end up in one layer;
+    a stage time written again replaces the earlier particles.  Usable as
+    ``on_stage`` of :meth:`oilspill.simulation.Simulation.run`.
+    """
+
+    def __init__(self, path, crs_wkt=None, epsg=None, table='particles'):
+        self.path = path
+        self.table = table
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA application_id = 1196444487')
+        self.connection.execute('PRAGMA user_version = 10200')
+        self.connection.executescript(SCHEMA)
+        self.connection.executescript(TABLE.format(table))
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', SPATIAL_REF_SYS)
+            row = self.connection.execute('SELECT srs_id FROM gpkg_geometry_columns WHERE table_name = ?', (table,)).fetchone()
+            if row is not None:
+                self.srs_id = row[0]
+            else:
+                self.srs_id = self.add_srs(crs_wkt, epsg)
+                self.connection.execute('INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) VALUES (?, ?, ?, ?)', (table, 'features', table, self.srs_id))
+                self.connection.execute('INSERT INTO gpkg_geometry_columns VALUES (?, ?, ?, ?, 0, 0)', (table, 'geom', 'POINT', self.srs_id))
+
+    def add_srs(self, crs_wkt, epsg):
+        if epsg:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)',
+                ('EPSG:{}'.format(epsg), int(epsg), 'EPSG', int(epsg), crs_wkt or 'undefined', None)
+            )
+            return int(epsg)
+        if not crs_wkt:
+            return -1
+        row = self.connection.execute('SELECT srs_id FROM gpkg_spatial_ref_sys WHERE definition = ?', (crs_wkt,)).fetchone()
+        if row is not None:
+            return row[0]
+        srs_id = max(CUSTOM_SRS, self.connection.execute('SELECT MAX(srs_id) + 1 FROM gpkg_spatial_ref_sys').fetchone()[0])
+        self.connection.execute('INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', ('Custom', srs_id, 'NONE', srs_id, crs_wkt, None))
+        return srs_id
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, time, ids, x, y, mass=None):
+        """Add the particles of one stage in one transaction."""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        masses = [None] * len(ids) if mass is None else np.asarray(mass, dtype=np.float64).tolist()
+        rows = zip(geometry_blobs(x, y, self.srs_id), [float(time)] * len(ids), np.asarray(ids).tolist(), masses)
+        query = 'INSERT INTO "{}" (geom, stage_time, id, mass) VALUES (?, ?, ?, ?)'.format(self.table)
+        with self.connection:
+            self.connection.execute('DELETE FROM "{}" WHERE stage_time = ?'.format(self.table), (float(time),))
+            self.connection.executemany(query, rows)
+            if len(x):
+                # The extent in gpkg_contents grows with the stages
+                self.connection.execute(
+                    'UPDATE gpkg_contents SET min_x = MIN(IFNULL(min_x, :min_x), :min_x), min_y = MIN(IFNULL(min_y, :min_y), :min_y), '
+                    'max_x = MAX(IFNULL(max_x, :max_x), :max_x), max_y = MAX(IFNULL(max_y, :max_y), :max_y), '
+                    "last_change = strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE table_name = :table",
+                    {'min_x': float(x.min()), 'min_y': float(y.min()), 'max_x': float(x.max()), 'max_y': float(y.max()), 'table': self.table}
+                )
+
+    def __call__(self, time, state):
+        self.append(time, state.ids, state.x, state.y, state.mass)
+
+    def times(self):
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT stage_time FROM "{}" ORDER BY stage_time'.format(self.table))]
+
+    def stage(self, time):
+        """ids, x, y and mass of the stage at ``time``, mass NaN where not stored."""
+        query = 'SELECT id, geom, mass FROM "{}" WHERE stage_time = ? ORDER BY id'.format(self.table)
+        rows = self.connection.execute(query, (float(time),)).fetchall()
+        x, y = points([row[1] for row in rows])
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        mass = np.array([np.nan if row[2] is None else row[2] for row in rows], dtype=np.float64)
+        return ids, x, y, mass
@@ -0,0 +1,225 @@
+"""Domain decomposition of a simulation into rectangular tiles.
+
+The extent of the perimeter is split into columns x rows tiles, each
+handled by a worker process that holds only its part of the environment:
+the velocity and depth grids cut to the tile grown by a halo, and the
+houses reaching into that halo rasterized on their own.  Every stage the
+particles are assigned to the tile they lie in and moved there; particles
+that left their tile are handed over to their new tile at the next stage.
+What needs the whole slick (evaporation, the random selection and the
+slick centroid) stays with the coordinating process.
+
+The halo has to cover the way a particle goes in one stage (spreading plus
+drift), otherwise it meets the edge of the cut grids and stops there.  With
+adaptive sub-steps each tile picks its own sub-steps from its fastest
+particle.
+"""
+import multiprocessing
+
+import numpy as np
+
+from oilspill.ensemble import python_executable
+from oilspill.obstacles import Obstacles
+from oilspill.simulation import Simulation
+
+
+class Tiling:
+
+    def __init__(self, xmin, ymin, xmax, ymax, columns=2, rows=2, halo=100.0):
+        self.xmin = float(xmin)
+        self.ymin = float(ymin)
+        self.xmax = float(xmax)
+        self.ymax = float(ymax)
+        self.columns = int(columns)
+        self.rows = int(rows)
+        self.halo = float(halo)
+
+    @classmethod
+    def around(cls, rings, columns=2, rows=2, halo=100.0):
+        points = np.concatenate(rings)
+        (xmin, ymin), (xmax, ymax) = points.min(axis=0), points.max(axis=0)
+        return cls(xmin, ymin, xmax, ymax, columns, rows, halo)
+
+    def __len__(self):
+        return self.columns * self.rows
+
+    def tile(self, x, y):
+        """Tile number of every point; points beyond the extent go to the nearest tile."""
+        column = np.floor((np.asarray(x) - self.xmin) / (self.xmax - self.xmin) * self.columns)
+        row = np.floor((self.ymax - np.asarray(y)) / (self.ymax - self.ymin) * self.rows)
+        column = np.clip(np.nan_to_num(column), 0, self.columns - 1).astype(np.intp)
+        row = np.clip(np.nan_to_num(row), 0, self.rows - 1).astype(np.intp)
+        return row * self.columns + column
+
+    def extent(self, number):
+        """Extent of tile ``number`` grown by the halo."""
+        row, column = divmod(number, self.columns)
+        width = (self.xmax - self.xmin) / self.columns
+        height = (self.ymax - self.ymin) / self.rows
+        return (
+            self.xmin + column * width - self.halo, self.ymax - (row + 1) * height - self.halo,
+            self.xmin + (column + 1) * width + self.halo, self.ymax - row * height + self.halo
+        )
+
+    def split(self, x, y):
+        """Indices of the points in every tile."""
+        numbers = self.tile(x, y)
+        order = np.argsort(numbers, kind='stable')
+        bounds = np.searchsorted(numbers[order], np.arange(len(self) + 1))
+        return [order[bounds[number]:bounds[number + 1]] for number in range(len(self))]
+
+
+def _within(building, extent):
+    points = np.concatenate(building)
+    xmin, ymin, xmax, ymax = extent
+    return points[:, 0].max() >= xmin and points[:, 0].min() <= xmax and points[:, 1].max() >= ymin and points[:, 1].min() <= ymax
+
+
+class Tiles:
+    """The tiles of one worker, each with its own cut environment and houses.
+
+    ``parts`` maps tile numbers to their environment and houses, ``setup``
+    holds the remaining simulation arguments.
+    """
+
+    def __init__(self, parts, setup):
+        self.simulations = {}
+        for number, (environment, buildings) in parts.items():
+            self.simulations[number] = Simulation(
+                environment, setup['volume'], setup['temperature'], setup['timespan'], None, None,
+                obstacles=Obstacles.around(buildings, setup['cellsize']) if buildings else None,
+                integrator=setup['integrator'], courant=setup['courant']
+            )
+
+    def advance(self, first, time, center, parts):
+        """Move the particles of every tile; ``parts`` maps tile to (x, y, stranded)."""
+        moved = {}
+        for number, (x, y, stranded) in parts.items():
+            simulation = self.simulations[number]
+            simulation.x = x
+            simulation.y = y
+            simulation.stranded = stranded
+            if first:
+                stranded = simulation.move_first(time)
+            else:
+                simulation.move(time, center)
+                stranded = simulation.stranded
+            moved[number] = (simulation.x, simulation.y, stranded)
+        return moved
+
+
+def _serve(connection, parts, setup):
+    tiles = Tiles(parts, setup)
+    connection.send(True)
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        connection.send(tiles.advance(*message))
+    connection.close()
+
+
+class TiledSimulation(Simulation):
+    """:class:`Simulation` whose particles move in tiles on worker processes.
+
+    ``tiling`` is a :class:`Tiling`; with ``workers`` 1 the tiles are moved
+    one after the other in this process.  The workers are started by
+    :meth:`run` and stopped at its end.
+    """
+
+    def __init__(self, environment, volume, temperature, timespan, source, tank, obstacles=None, seed=None, particles=None, integrator='euler', courant=None, tiling=None, workers=None):
+        super().__init__(environment, volume, temperature, timespan, source, tank, obstacles, seed, particles, integrator, courant)
+        self.tiling = tiling or Tiling.around(environment.perimeter)
+        self.workers = min(workers or multiprocessing.cpu_count(), len(self.tiling))
+        self.connections = None
+        self.local = None
+
+    def setup(self):
+        return {
+            'volume': self.volume,
+            'temperature': self.temperature,
+            'timespan': self.timespan,
+            'cellsize': 1.0 if self.obstacles is None else self.obstacles.spec.cellsize_x,
+            'integrator': self.integrator,
+            'courant': self.courant,
+        }
+
+    def parts(self, numbers):
+        # Only the part of the grids and the houses each tile needs is sent;
+        # edge tiles reach out to the halo around the whole extent
+        buildings = [] if self.obstacles is None else self.obstacles.buildings
+        parts = {}
+        for number in numbers:
+            extent = self.tiling.extent(number)
+            parts[number] = (self.environment.crop(*extent), [building for building in buildings if _within(building, extent)])
+        return parts
+
+    def start(self):
+        if self.workers < 2:
+            self.local = Tiles(self.parts(range(len(self.tiling))), self.setup())
+            return
+        context = multiprocessing.get_context('spawn')
+        context.set_executable(python_executable())
+        self.connections = []
+        self.processes = []
+        for worker in range(self.workers):
+            mine, theirs = context.Pipe()
+            parts = self.parts(range(worker, len(self.tiling), self.workers))
+            process = context.Process(target=_serve, args=(theirs, parts, self.setup()), daemon=True)
+            process.start()
+            self.connections.append(mine)
+            self.processes.append(process)
+        for connection in self.connections:
+            connection.recv()
+
+    def stop(self):
+        if self.connections is not None:
+            for connection in self.connections:
+                connection.send(None)
+            for process in self.processes:
+                process.join()
+        self.connections = None
+        self.local = None
+
+    def advance(self, first, time, center, index):
+        """Move the particles ``index`` in their tiles, return their new state."""
+        x = self.x[index]
+        y = self.y[index]
+        stranded = self.stranded[index]
+        tiles = self.tiling.split(x, y)
+        parts = {number: (x[chosen], y[chosen], stranded[chosen]) for number, chosen in enumerate(tiles) if len(chosen)}
+        if self.local is not None:
+            moved = self.local.advance(first, time, center, parts)
+        else:
+            for worker, connection in enumerate(self.connections):
+                connection.send((first, time, center, {number: part for number, part in parts.items() if number % self.workers == worker}))
+            moved = {}
+            for connection in self.connections:
+                moved.update(connection.recv())
+        # Back into the order of the particles
+        result = [np.empty(len(index)), np.empty(len(index)), np.empty(len(index), dtype=bool)]
+        for number, (x, y, flags) in moved.items():
+            result[0][tiles[number]] = x
+            result[1][tiles[number]] = y
+            result[2][tiles[number]] = flags
+        return result
+
+    def move_first(self, time):
+        x, y, keep = self.advance(True, time, None, np.arange(len(self.ids)))
+        self.x = x
+        self.y = y
+        self.shape.moved()
+        return keep
+
+    def move(self, time, center):
+        # The tiles tell stranded particles apart themselves, with their part
+        # of the depth grid
+        self.x, self.y, self.stranded = self.advance(False, time, tuple(center), np.arange(len(self.ids)))
+        self.shape.moved()
+
+    def run(self, start, end, feedback=None, on_stage=None):
+        self.start()
+        try:
+            return super().run(start, end, feedback, on_stage)
+        finally:
+            self.stop()
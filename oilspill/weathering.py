@@ -0,0 +1,112 @@
+"""Evaporation and spreading laws of the models on NumPy arrays.
+
+The models evaluate these laws as expression strings per run:
+
+* the evaporated percentage ``(5.91 + 0.045 * T) * ln(t)`` after ``t``
+  minutes at ``T`` °C, of which a stage removes the increase since the
+  stage before,
+* the radius of the slick ``((V/1000)^2 * 9.81 * 0.1793 * (t/60)^1.5 /
+  nu^0.5)^(1/3)`` that sets the spreading of a stage, and
+* the radius ``((V/1000) * 4 / (3 pi))^(1/3)`` of the buffer the oil is
+  poured into.
+
+Here every law takes arrays of temperatures, volumes and times (any shapes
+that broadcast) as well as plain numbers.  A :class:`WeatheringTable` holds
+them precomputed on a grid of temperatures, volumes and times, for sweeps
+and ensembles that evaluate the same stages over and over; values off the
+grid are computed as they are asked for.
+"""
+import numpy as np
+
+
+KINEMATIC_VISCOSITY = 0.000001139
+
+
+def evaporated_percent(temperature, time):
+    return (5.91 + 0.045 * np.asarray(temperature, dtype=np.float64)) * np.log(time)
+
+
+def kept_percent(temperature, time, previous=None, evaporated=evaporated_percent):
+    """Share of the oil left by the stage at ``time``.
+
+    The first stage (``previous`` None) keeps ``100 - floor(E(t))``, a later
+    one ``100 - floor(E(t) - E(previous))``, like the random selection of the
+    models.  ``evaporated`` computes E.
+    """
+    lost = evaporated(temperature, time)
+    if previous is not None:
+        lost = lost - evaporated(temperature, previous)
+    return 100 - np.floor(lost)
+
+
+def initial_radius(volume):
+    # Radius of the "Puffer" around the pouring point
+    return ((np.asarray(volume, dtype=np.float64) / 1000) * 4 / (np.pi * 3)) ** (1 / 3)
+
+
+def spreading_radius(volume, time):
+    # sqrt((pi()*1.21^2*(((V/1000)^2*9.81*0.1793*((1/60)*t)^1.5)/nu^0.5)^(1/3))/pi())
+    volume = np.asarray(volume, dtype=np.float64)
+    return np.sqrt((np.pi * 1.21 ** 2 * (((volume / 1000) ** 2 * 9.81 * 0.1793 * ((1 / 60) * np.asarray(time, dtype=np.float64)) ** 1.5) / KINEMATIC_VISCOSITY ** 0.5) ** (1 / 3)) / np.pi)
+
+
+def spreading_distance(volume, time, timespan):
+    # radius / 60 * 60 * timespan
+    return spreading_radius(volume, time) / 60 * 60 * timespan
+
+
+def stage_times(start, end, timespan):
+    """Times of the stages from ``start`` to ``end``, as :meth:`Simulation.run` takes them."""
+    times = [start]
+    while times[-1] + timespan <= end:
+        times.append(times[-1] + timespan)
+    return np.array(times if start <= end else [], dtype=np.float64)
+
+
+def _lookup(axis, other, table, a, b, law):
+    # Values at grid nodes come from the table, the others from the law
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64))
+    if not len(axis) or not len(other):
+        return law(a, b)[()]
+    row = np.clip(np.searchsorted(axis, a), 0, len(axis) - 1)
+    column = np.clip(np.searchsorted(other, b), 0, len(other) - 1)
+    hit = (axis[row] == a) & (other[column] == b)
+    result = np.empty(a.shape)
+    result[hit] = table[row[hit], column[hit]]
+    result[~hit] = law(a[~hit], b[~hit])
+    return result[()]
+
+
+class WeatheringTable:
+    """The laws precomputed on a grid, with the interface of the functions.
+
+    The evaporated percentage is held over ``temperatures`` x ``times`` and
+    the spreading radius over ``volumes`` x ``times``; without any grid
+    every value is computed.
+    """
+
+    def __init__(self, temperatures=(), times=(), volumes=()):
+        self.temperatures = np.unique(np.asarray(temperatures, dtype=np.float64))
+        self.volumes = np.unique(np.asarray(volumes, dtype=np.float64))
+        self.times = np.unique(np.asarray(times, dtype=np.float64))
+        self.evaporated = evaporated_percent(self.temperatures[:, None], self.times[None, :])
+        self.radius = spreading_radius(self.volumes[:, None], self.times[None, :])
+
+    @classmethod
+    def for_stages(cls, temperatures, volumes, start, end, timespan):
+        """Table covering the stages of runs from ``start`` to ``end``, and the
+        times before them the evaporation of a stage starts from."""
+        times = stage_times(start, end, timespan)
+        return cls(temperatures, np.concatenate([times, np.maximum(times - timespan, 1)]), volumes)
+
+    def evaporated_percent(self, temperature, time):
+        return _lookup(self.temperatures, self.times, self.evaporated, temperature, time, evaporated_percent)
+
+    def kept_percent(self, temperature, time, previous=None):
+        return kept_percent(temperature, time, previous, self.evaporated_percent)
+
+    def spreading_radius(self, volume, time):
+        return _lookup(self.volumes, self.times, self.radius, volume, time, spreading_radius)
+
+    def spreading_distance(self, volume, time, timespan):
+        return self.spreading_radius(volume, time) / 60 * 60 * timespan